@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+
+"""
+Generate the golden corpus: article pages of every spider and the items loaded from them.
+
+    python -m benchmarks.corpus [--pages benchmarks/pages] [--articles 3] [--spiders g1,uol]
+
+Pages are written to `<pages>/<spider>/<n>.html`, served by `benchmarks.portal`
+at `http://<first allowed domain>/ze-bench/<n>`. The elements of each field
+are rendered from its first valid selector in the spider `parses`, with an
+article body using the markup cleaned by CleanHTML (captions, embeds, the
+media of each portal). The page generation is deterministic.
+
+The items loaded by `ZeSpider.load_item` are saved next to the pages
+(`<n>.json`), `benchmarks.suite` checks the spiders still load them. Run it
+again, and review the diff, when a spider or processor changes its items on
+purpose.
+"""
+
+import os
+import json
+import zlib
+import random
+import argparse
+from xml.sax.saxutils import escape, quoteattr
+from cssselect import parse, SelectorError
+from cssselect.parser import (Element, Class, Hash, Attrib, CombinedSelector,
+                              Pseudo, Function, Negation, FunctionalPseudoElement)
+from scrapy.http import HtmlResponse, Request
+from scrapy.utils.test import get_crawler
+from benchmarks.clean_html import spider_classes
+
+PAGES = os.path.join(os.path.dirname(__file__), 'pages')
+
+# Settings of the spiders loading the golden items, without persistent state
+SETTINGS = {'SEARCH_CACHE_TTL': 0, 'MEDIA_CACHE_PATH': ':memory:'}
+
+WORDS = (u'educação escola professor aluno governo ministério projeto estado '
+         u'município aula ensino política reforma currículo avaliação base '
+         u'nacional público privado pesquisa dados índice resultado').split()
+
+# Media of the portals, cleaned by the site rules of CleanHTML
+SITE_BLOCKS = {
+    'cartacapital.com.br': u'<div class="image-inline"><img data-src="http://{domain}/img/{n}-inline.jpg">'
+                           u'<span class="image-caption">Legenda da imagem</span></div>',
+    'veja.abril.com.br': u'<div class="featured-image"><img data-src="http://{domain}/img/{n}-featured.jpg">'
+                         u'<p>Legenda da imagem</p></div>',
+    'g1.globo.com': u'<div data-block-type="backstage-photo"><img class="content-media__image" '
+                    u'data-src="http://{domain}/img/{n}-photo.jpg" alt="Legenda da foto"></div>',
+    'estadao.com.br': u'<div data-config=\'{{"tipo": "imagem", "id": "{n}"}}\'></div>',
+}
+
+
+def estadao_media(tipo, id):
+    """Estadão middlewareAgile response of a media, served by `benchmarks.portal`."""
+    return {'resultadoConteudo': {'conteudos': [{
+        'titulo': u'Foto %s' % id,
+        'credito': u'Agência Estado',
+        'pressets': [{'class': 'full', 'file': 'http://estadao.com.br/img/%s.jpg' % id}],
+    }]}}
+
+
+def media(html):
+    """`meta['media']` of an Estadão article, as resolved by the spider."""
+    body = HtmlResponse('http://estadao.com.br/', body=html.encode('utf-8'), encoding='utf-8')
+    resolved = {}
+    for data_config in body.css('[data-config]::attr(data-config)').extract():
+        config = json.loads(data_config)
+        found = estadao_media(**config)['resultadoConteudo']['conteudos'][0]
+        resolved['{tipo}:{id}'.format(**config)] = {
+            'src': found['pressets'][0]['file'], 'titulo': found['titulo'], 'credito': found['credito']}
+    return resolved
+
+
+def article_body(spidercls, n, rand):
+    domain = spidercls.allowed_domains[0]
+    words = lambda count: u' '.join(rand.choice(WORDS) for _ in range(count))
+    parts = []
+    for i in range(rand.randint(8, 30)):
+        parts.append(u'<p>%s <a href="http://%s/link/%d" rel="nofollow" style="color: red">%s</a> '
+                     u'%s <span>%s</span> <em><span>%s</span></em>.</p>' % (
+                         words(12).capitalize(), domain, i, words(2), words(8), words(6), words(3)))
+        if i % 7 == 3:
+            # Intertitle
+            parts.append(u'<p><strong>%s</strong></p>' % words(3).capitalize())
+        elif i == 2:
+            parts.append(u'<div class="wp-caption"><img src="http://%s/img/%d-wp.jpg">'
+                         u'<p class="wp-caption-text">%s</p></div>' % (domain, n, words(4)))
+        elif i == 4:
+            parts.append(u'<p><iframe data-lazy-src="https://www.youtubel.com/embed/v%d/x"></iframe></p>' % n)
+        elif i == 5:
+            parts.append(u'<script>var ad = %d;</script><style>p { color: blue }</style><p></p>' % i)
+        elif i == 6:
+            for site, block in SITE_BLOCKS.items():
+                if site in spidercls.allowed_domains:
+                    parts.append(block.format(domain=domain, n=n))
+    return u'\n'.join(parts)
+
+
+def field_value(field, attr, n):
+    if field in ('datePublished', 'dateModified'):
+        minute = 30 if field == 'dateModified' else 0
+        return u'2017-03-12T10:%02d:00-03:00' % minute if attr else u'12/03/2017 10h%02d' % minute
+    return {
+        'name': u'Título da notícia %d' % n,
+        'alternativeHeadline': u'Título alternativo %d' % n,
+        'description': u'Linha fina da notícia %d' % n,
+        'author': u'Por Fulano de Tal e Beltrano da Silva',
+        'image': u'http://img.example.com/%d.jpg' % n,
+        'keywords': u'Educação, Política',
+    }.get(field, u'%s %d' % (field, n))
+
+
+def render(tree, content, attrs=None):
+    """HTML of an element matched by the parsed selector `tree`, around `content`."""
+    if isinstance(tree, CombinedSelector):
+        child = render(tree.subselector, content, attrs)
+        if tree.combinator in ('+', '~'):
+            return render(tree.selector, u'') + child
+        return render(tree.selector, child)
+
+    tag, attributes = 'div', dict(attrs or {})
+    classes = []
+    while not isinstance(tree, Element):
+        if isinstance(tree, Class):
+            classes.append(tree.class_name)
+        elif isinstance(tree, Hash):
+            attributes['id'] = tree.id
+        elif isinstance(tree, Attrib):
+            value = tree.value.value if hasattr(tree.value, 'value') else tree.value
+            attributes[tree.attrib] = value if tree.operator != 'exists' else tree.attrib
+        elif not isinstance(tree, (Pseudo, Function, Negation)):
+            raise ValueError('Unsupported selector %r' % tree)
+        tree = tree.selector
+    if tree.element:
+        tag = tree.element
+    elif 'content' in attributes:
+        tag = 'meta'
+    if classes:
+        attributes['class'] = u' '.join(reversed(classes))
+
+    html = u'<%s%s>' % (tag, u''.join(u' %s=%s' % (k, quoteattr(v)) for k, v in sorted(attributes.items())))
+    if tag in ('meta', 'img', 'link'):
+        return html
+    return u'%s%s</%s>' % (html, content, tag)
+
+
+def render_field(field, selectors, html_field, n, rand, body):
+    """HTML of the first selector of `field` that can be rendered."""
+    for css in selectors:
+        try:
+            selector, = parse(css)
+        except (SelectorError, ValueError):
+            continue
+        pseudo = selector.pseudo_element
+        attr = pseudo.arguments[0].value if isinstance(pseudo, FunctionalPseudoElement) else None
+        if pseudo is None and not html_field or pseudo not in (None, 'text') and attr is None:
+            continue
+        value = field_value(field, attr, n)
+        try:
+            if attr:
+                return render(selector.parsed_tree, u'', {attr: value})
+            return render(selector.parsed_tree, body if pseudo is None else escape(value))
+        except ValueError:
+            continue
+    return u''
+
+
+def page(spidercls, n):
+    rand = random.Random(zlib.crc32(('%s/%d' % (spidercls.name, n)).encode('utf-8')))
+    parts = []
+    for p in spidercls.parses:
+        for item_class, args in p.items():
+            item_fields = spider_item_fields(item_class)
+            for field, selectors in args['fields'].items():
+                html_field = bool(item_fields.get(field, {}).get('html'))
+                body = article_body(spidercls, n, rand) if html_field else u''
+                parts.append(render_field(field, selectors, html_field, n, rand, body))
+    return (u'<!DOCTYPE html>\n<html><head><meta charset="utf-8"><title>%s</title></head>\n'
+            u'<body>\n%s\n</body></html>\n' % (spidercls.name, u'\n'.join(parts)))
+
+
+def spider_item_fields(item_class):
+    import ze.utils
+    return ze.utils.import_class(item_class).fields
+
+
+def load_items(spider, url, html):
+    """
+    Items of `html` loaded by `spider`, as dicts, or the name of the exception
+    raised (e.g. by an invalid selector of the spider).
+    """
+    response = HtmlResponse(url, body=html.encode('utf-8'), encoding='utf-8',
+                            request=Request(url, meta={'media': media(html)}))
+    try:
+        return [dict(spider.load_item(response, plan.item_class, plan.args, plan))
+                for plan in spider.plan]
+    except Exception as e:
+        return type(e).__name__
+
+
+def golden_pages(spidercls, pages=PAGES):
+    """(url, html, golden items path) of the corpus of `spidercls`."""
+    directory = os.path.join(pages, spidercls.name)
+    names = [f[:-5] for f in os.listdir(directory) if f.endswith('.html')] if os.path.isdir(directory) else []
+    for name in sorted(names, key=lambda name: (len(name), name)):
+        with open(os.path.join(directory, name + '.html'), 'rb') as f:
+            html = f.read().decode('utf-8')
+        url = 'http://%s/ze-bench/%s' % (spidercls.allowed_domains[0], name)
+        yield url, html, os.path.join(directory, name + '.json')
+
+
+def summary(spidercls, items):
+    if not isinstance(items, list):
+        return 'error: %s' % items
+    fields = set(field for p in spidercls.parses for args in p.values() for field in args['fields'])
+    empty = sorted(fields - set(field for item in items for field, value in item.items() if value))
+    return 'empty: %s' % ', '.join(empty) if empty else 'ok'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--pages', default=PAGES)
+    parser.add_argument('--articles', type=int, default=3)
+    parser.add_argument('--spiders', help='comma separated names, all by default')
+    args = parser.parse_args()
+
+    for spidercls in spider_classes():
+        if args.spiders and spidercls.name not in args.spiders.split(','):
+            continue
+        directory = os.path.join(args.pages, spidercls.name)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        for n in range(args.articles):
+            with open(os.path.join(directory, '%d.html' % n), 'wb') as f:
+                f.write(page(spidercls, n).encode('utf-8'))
+
+        spider = spidercls.from_crawler(get_crawler(spidercls, SETTINGS))
+        for url, html, golden in golden_pages(spidercls, args.pages):
+            items = load_items(spider, url, html)
+            with open(golden, 'w') as f:
+                json.dump(items, f, indent=2, sort_keys=True, ensure_ascii=False)
+            print('%-20s %-40s %s' % (spidercls.name, url, summary(spidercls, items)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+
+"""
+End-to-end crawl of the spiders against `benchmarks.portal`, without network.
+
+    python -m benchmarks.crawl [--spiders g1,uol] [--articles 100] [--latency 0.05]
+                               [--jitter 0] [-s CONCURRENT_REQUESTS=32] [--output crawl.json]
+
+The spiders run with the project settings and the `own` search engine, reading
+the news sitemap of each portal, through the portal server as HTTP proxy.
+Google Cloud, the caches and the fingerprints are disabled. Reports the items
+by second (first request to last item), the p50/p99 latency of the items
+(article request scheduled to item scraped) and the peak RSS of the process.
+Exits with 1 when no item was scraped or an error was logged.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import subprocess
+from collections import Counter
+from scrapy import signals
+from scrapy.crawler import CrawlerProcess
+from scrapy.utils.project import get_project_settings
+from benchmarks.clean_html import spider_classes
+from benchmarks.corpus import PAGES
+
+
+def percentile(values, p):
+    """Nearest-rank percentile `p` (0-100) of `values`."""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, min(len(values) - 1, int(round(p / 100.0 * len(values))) - 1))]
+
+
+class CrawlMetrics(object):
+
+    def __init__(self):
+        self.started = None
+        self.finished = None
+        self.latencies = []
+        self.items = Counter()
+
+    def connect(self, crawler):
+        crawler.signals.connect(self.request_scheduled, signal=signals.request_scheduled)
+        crawler.signals.connect(self.item_scraped, signal=signals.item_scraped)
+
+    def request_scheduled(self, request, spider):
+        request.meta.setdefault('bench_scheduled', time.time())
+        if self.started is None:
+            self.started = time.time()
+
+    def item_scraped(self, item, response, spider):
+        self.finished = time.time()
+        # Estadão items are loaded from the response of their last media
+        article = response.meta.get('article', response)
+        self.latencies.append(self.finished - article.meta['bench_scheduled'])
+        self.items[spider.name] += 1
+
+    def report(self, crawlers):
+        elapsed = (self.finished or time.time()) - self.started if self.started else 0
+        return {
+            'items': sum(self.items.values()),
+            'items_by_spider': dict(self.items),
+            'errors': sum(value for c in crawlers for key, value in c.stats.get_stats().items()
+                          if key.startswith('spider_exceptions/') or key == 'downloader/exception_count'),
+            # Every crawler counts the logs of the whole process
+            'logged_errors': max([sum(c.stats.get_value(key, 0) for key in
+                                      ('log_count/ERROR', 'log_count/CRITICAL'))
+                                  for c in crawlers] or [0]),
+            'elapsed': elapsed,
+            'items_per_second': sum(self.items.values()) / elapsed if elapsed > 0 else 0,
+            'latency_p50': percentile(self.latencies, 50),
+            'latency_p99': percentile(self.latencies, 99),
+            # Kilobytes on Linux
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+        }
+
+
+def start_portal(args):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    portal = subprocess.Popen(
+        [sys.executable, '-m', 'benchmarks.portal', '--port', '0', '--pages', args.pages,
+         '--articles', str(args.articles), '--latency', str(args.latency), '--jitter', str(args.jitter)],
+        cwd=root, stdout=subprocess.PIPE, universal_newlines=True)
+    line = portal.stdout.readline()
+    if not line.startswith('Listening on '):
+        portal.kill()
+        raise RuntimeError('Portal server not started')
+    return portal, line.split()[-1]
+
+
+def crawl(args, proxy, state_dir):
+    # Read by HttpProxyMiddleware when the crawlers are created
+    os.environ['http_proxy'] = proxy
+    settings = get_project_settings()
+    settings.setdict({
+        'GOOGLE_CLOUD_ENABLED': False,
+        'FINGERPRINTS_ENABLED': False,
+        'SEARCH_CACHE_TTL': 0,
+        'MEDIA_CACHE_PATH': os.path.join(state_dir, 'media.db'),
+        'SELECTOR_STATS_ENABLED': True,
+        'SELECTOR_STATS_DIR': os.path.join(state_dir, 'selectors'),
+        'TELNETCONSOLE_ENABLED': False,
+        'LOG_LEVEL': args.loglevel,
+    }, priority='cmdline')
+    for setting in args.set:
+        name, value = setting.split('=', 1)
+        settings.set(name, value, priority='cmdline')
+
+    process = CrawlerProcess(settings)
+    metrics = CrawlMetrics()
+    crawlers = []
+    for spidercls in spider_classes():
+        if args.spiders and spidercls.name not in args.spiders.split(','):
+            continue
+        crawler = process.create_crawler(spidercls)
+        metrics.connect(crawler)
+        crawlers.append(crawler)
+        process.crawl(crawler, search={
+            'engine': 'own',
+            'feeds': ['http://%s/ze-bench/sitemap.xml' % spidercls.allowed_domains[0]],
+        })
+    process.start()
+    return metrics.report(crawlers)
+
+
+def run(args):
+    portal, proxy = start_portal(args)
+    state_dir = tempfile.mkdtemp(prefix='ze-bench-')
+    try:
+        return crawl(args, proxy, state_dir)
+    finally:
+        portal.terminate()
+        portal.wait()
+        shutil.rmtree(state_dir, ignore_errors=True)
+
+
+def add_arguments(parser):
+    parser.add_argument('--spiders', help='comma separated names, all by default')
+    parser.add_argument('--pages', default=PAGES)
+    parser.add_argument('--articles', type=int, default=100, help='articles by spider')
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--jitter', type=float, default=0)
+    parser.add_argument('-s', '--set', action='append', default=[], metavar='NAME=VALUE')
+    parser.add_argument('--loglevel', default='WARNING')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    add_arguments(parser)
+    parser.add_argument('--output', help='JSON file of the results')
+    args = parser.parse_args()
+
+    result = run(args)
+    print(json.dumps(result, indent=2, sort_keys=True))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+    if not result['items'] or result['logged_errors']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compare the item extraction of every spider before and after the extraction plans.
+
+Pages are read from `<pages>/<spider name>/*.html`, as in `clean_html`.
+
+    python -m benchmarks.extraction [--pages benchmarks/pages] [--repeat 10]
+
+`before` imports the item class by name and translates every CSS selector on
+each response, with the processors of the Scrapy item loader; `after` runs
+`ZeSpider.load_item` with the plan compiled when the spider is created. Both
+run the processors (CleanHTML included) and must load the same items, pages
+failing with both (e.g. an invalid selector) are not timed.
+"""
+
+import os
+import glob
+import timeit
+import argparse
+from scrapy.http import HtmlResponse, Request
+from scrapy.loader import ItemLoader as ScrapyItemLoader
+from scrapy.utils.test import get_crawler
+import ze.utils
+from ze.items import ItemLoader
+from benchmarks.clean_html import spider_classes
+
+
+class LegacyItemLoader(ItemLoader):
+    """Item loader with the processors wrapped by Scrapy on every value."""
+
+    def _process_input_value(self, field_name, value):
+        return ScrapyItemLoader._process_input_value(self, field_name, value)
+
+    def get_output_value(self, field_name):
+        return ScrapyItemLoader.get_output_value(self, field_name)
+
+
+def legacy_parse(spider, response):
+    items = []
+    for p in spider.parses:
+        for item_class, args in p.items():
+            ItemClass = ze.utils.import_class(item_class)
+            il = LegacyItemLoader(item=ItemClass(), response=response,
+                crawler_stats=spider.crawler.stats,
+                allowed_domains=spider.allowed_domains,
+                media=response.meta.get('media', {}),
+                clean_html_backend=spider.settings.get('CLEAN_HTML_BACKEND', 'bs4'),
+                deferred_processing=False)
+            for field, selectors in args['fields'].items():
+                for i, s in enumerate(selectors):
+                    il.add_css(field, s) if i == 0 else il.add_fallback_css(field, s)
+            il.add_value('url', spider.canonical_url(response.url))
+            items.append(il.load_item())
+    return items
+
+
+def plan_parse(spider, response):
+    return [spider.load_item(response, plan.item_class, plan.args, plan) for plan in spider.plan]
+
+
+def outcome(parse, spider, response):
+    try:
+        return [dict(item) for item in parse(spider, response)]
+    except Exception as e:
+        return type(e).__name__
+
+
+def responses(spidercls, pages):
+    for path in sorted(glob.glob(os.path.join(pages, spidercls.name, '*.html'))):
+        url = 'http://%s/article' % spidercls.allowed_domains[0]
+        with open(path, 'rb') as f:
+            yield HtmlResponse(url, body=f.read(), encoding='utf-8', request=Request(url))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--pages', default=os.path.join(os.path.dirname(__file__), 'pages'))
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+
+    settings = {'SEARCH_CACHE_TTL': 0, 'MEDIA_CACHE_PATH': ':memory:'}
+    print('%-20s %6s %12s %12s %8s %6s' % ('spider', 'pages', 'before (ms)', 'after (ms)', 'speedup', 'same'))
+    for spidercls in spider_classes():
+        pages = list(responses(spidercls, args.pages))
+        if not pages:
+            print('%-20s %6d %12s %12s %8s %6s' % (spidercls.name, 0, '-', '-', '-', '-'))
+            continue
+
+        spider = spidercls.from_crawler(get_crawler(spidercls, settings))
+        outcomes = [(outcome(legacy_parse, spider, r), outcome(plan_parse, spider, r)) for r in pages]
+        same = all(legacy == plan for legacy, plan in outcomes)
+        pages = [r for r, (legacy, _) in zip(pages, outcomes) if isinstance(legacy, list)]
+        if not pages:
+            print('%-20s %6d %12s %12s %8s %6s' % (spidercls.name, 0, '-', '-', '-', same))
+            continue
+
+        before = timeit.timeit(lambda: [legacy_parse(spider, r) for r in pages],
+                               number=args.repeat) / args.repeat / len(pages) * 1000
+        after = timeit.timeit(lambda: [plan_parse(spider, r) for r in pages],
+                              number=args.repeat) / args.repeat / len(pages) * 1000
+        print('%-20s %6d %12.2f %12.2f %7.1fx %6s' % (spidercls.name, len(pages), before, after,
+                                                       before / after, same))
+
+
+if __name__ == '__main__':
+    main()
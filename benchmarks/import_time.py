@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+"""
+Import time of the spider listing and crawl startup paths, with `python -X importtime`.
+
+    python -m benchmarks.import_time [--repeat 5] [--top 10] [--budget-ms 0]
+
+`list` imports the spider modules, as `scrapy list`; `crawl` also imports the
+pipelines, extensions and downloader middlewares of the settings, as `scrapy
+crawl` does before the first request. Times are the best of `--repeat` runs,
+without the interpreter startup. Exits with 1 when a path imports one of the
+HEAVY modules, only needed by disabled backends, or takes more than
+`--budget-ms` (0 for no budget).
+"""
+
+import os
+import re
+import sys
+import argparse
+import subprocess
+
+# Loaded by the first Google search, the Mongo and Pub/Sub pipelines when the
+# spider opens, and the dates not matching the Portuguese patterns
+HEAVY = ('GoogleScraper', 'pymongo', 'google.cloud.pubsub', 'dateparser')
+
+LIST = """
+from scrapy.spiderloader import SpiderLoader
+from scrapy.utils.project import get_project_settings
+settings = get_project_settings()
+SpiderLoader.from_settings(settings).list()
+"""
+
+CRAWL = LIST + """
+from scrapy.utils.misc import load_object
+for name in ('ITEM_PIPELINES', 'EXTENSIONS', 'DOWNLOADER_MIDDLEWARES'):
+    for path, order in settings.getdict(name).items():
+        if order is not None:
+            load_object(path)
+"""
+
+PATHS = (('list', LIST), ('crawl', CRAWL))
+
+LINE_RE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)$')
+
+
+def import_times(code):
+    """Cumulative microseconds of the modules imported by `code`, top level first."""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=root,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if process.returncode:
+        raise RuntimeError(process.stderr)
+    modules = {}
+    top_level = []
+    for line in process.stderr.splitlines():
+        match = LINE_RE.match(line)
+        if match:
+            _, cumulative, indent, name = match.groups()
+            modules[name] = int(cumulative)
+            if not indent:
+                top_level.append(name)
+    return modules, top_level
+
+
+def best_run(code, repeat):
+    runs = [import_times(code) for _ in range(repeat)]
+    return min(runs, key=lambda run: sum(run[0][name] for name in run[1]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10)
+    parser.add_argument('--budget-ms', type=float, default=0)
+    args = parser.parse_args()
+
+    startup_modules, startup = best_run('pass', args.repeat)
+    failed = False
+    for name, code in PATHS:
+        modules, top_level = best_run(code, args.repeat)
+        top_level = [m for m in top_level if m not in startup]
+        total = sum(modules[m] for m in top_level) / 1000.0
+        heavy = [m for m in HEAVY if m in modules]
+        print('%-6s %8.1f ms  heavy: %s' % (name, total, ', '.join(heavy) or '-'))
+        for module in sorted(top_level, key=modules.get, reverse=True)[:args.top]:
+            print('    %-40s %8.1f ms' % (module, modules[module] / 1000.0))
+        if heavy or (args.budget_ms and total > args.budget_ms):
+            failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
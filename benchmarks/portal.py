@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+"""
+Local HTTP server standing in for the news portals, serving the golden corpus.
+
+    python -m benchmarks.portal [--port 8800] [--articles 100] [--latency 0.05] [--jitter 0]
+
+Used as the HTTP proxy of the crawl (`http_proxy`), so the spiders request
+their real domains. For every portal (by the allowed domains of the spiders):
+
+- `/ze-bench/sitemap.xml`: news sitemap of `--articles` articles, updated now;
+- `/ze-bench/<n>`: page `n` of the corpus of the spider, pages are reused
+  when there are fewer than `--articles`;
+- `/middlewareAgile/...`: the Estadão media of `tipo_midia` and `idAgile`.
+
+Each response is sent after `--latency` seconds, plus up to `--jitter`.
+"""
+
+import sys
+import json
+import time
+import random
+import argparse
+import urllib.parse
+from twisted.internet import reactor
+from twisted.web import resource, server
+from benchmarks.clean_html import spider_classes
+from benchmarks.corpus import PAGES, golden_pages, estadao_media
+
+
+class Portal(resource.Resource):
+
+    isLeaf = True
+
+    def __init__(self, pages, articles, latency=0, jitter=0):
+        resource.Resource.__init__(self)
+        self.articles = articles
+        self.latency = latency
+        self.jitter = jitter
+        # Pages of each allowed domain, longest domains first (folha.uol.com.br
+        # before uol.com.br)
+        self.pages = []
+        for spidercls in spider_classes():
+            htmls = [html.encode('utf-8') for _, html, _ in golden_pages(spidercls, pages)]
+            if htmls:
+                for domain in spidercls.allowed_domains:
+                    self.pages.append((domain, spidercls.allowed_domains[0], htmls))
+        self.pages.sort(key=lambda entry: -len(entry[0]))
+
+    def render_GET(self, request):
+        delay = self.latency + random.uniform(0, self.jitter)
+        reactor.callLater(delay, self.respond, request)
+        return server.NOT_DONE_YET
+
+    def respond(self, request):
+        uri = urllib.parse.urlsplit(request.uri.decode('latin-1'))
+        host = (uri.hostname or (request.getHeader('host') or '').split(':')[0]).lower()
+        path = uri.path.rstrip('/')
+        content_type, body = self.route(host, path, urllib.parse.parse_qs(uri.query))
+        if body is None:
+            request.setResponseCode(404)
+            body = b'Not found'
+        request.setHeader('Content-Type', content_type)
+        request.write(body)
+        request.finish()
+
+    def route(self, host, path, query):
+        if path.startswith('/middlewareAgile/'):
+            media = estadao_media(query.get('tipo_midia', [''])[0], query.get('idAgile', [''])[0])
+            return 'application/json', json.dumps(media).encode('utf-8')
+
+        for domain, first_domain, htmls in self.pages:
+            if host == domain or host.endswith('.' + domain):
+                break
+        else:
+            return 'text/plain', None
+
+        if path == '/ze-bench/sitemap.xml':
+            return 'application/xml', self.sitemap(first_domain)
+        if path.startswith('/ze-bench/') and path[len('/ze-bench/'):].isdigit():
+            return 'text/html; charset=utf-8', htmls[int(path[len('/ze-bench/'):]) % len(htmls)]
+        return 'text/plain', None
+
+    def sitemap(self, domain):
+        lastmod = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+        urls = ''.join('<url><loc>http://%s/ze-bench/%d</loc><lastmod>%s</lastmod></url>' % (domain, n, lastmod)
+                       for n in range(self.articles))
+        return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">%s</urlset>' % urls).encode('utf-8')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--port', type=int, default=8800)
+    parser.add_argument('--pages', default=PAGES)
+    parser.add_argument('--articles', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--jitter', type=float, default=0)
+    args = parser.parse_args()
+
+    portal = Portal(args.pages, args.articles, args.latency, args.jitter)
+    port = reactor.listenTCP(args.port, server.Site(portal), interface='127.0.0.1')
+    # Read by `benchmarks.crawl` to know the server is ready
+    print('Listening on http://127.0.0.1:%d' % port.getHost().port)
+    sys.stdout.flush()
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()
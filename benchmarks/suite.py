@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+
+"""
+Offline benchmark suite: golden items, micro-benchmarks and the end-to-end crawl.
+
+    python -m benchmarks.suite [--output results.json] [--compare previous.json]
+                               [--repeat 10] [--no-crawl] [crawl options, see benchmarks.crawl]
+
+On the golden corpus (see `benchmarks.corpus`):
+
+- `golden`: spiders whose items differ from the saved ones;
+- `load_item_ms`: `ZeSpider.load_item` by page, response parsing included;
+- `clean_html_ms`: CleanHTML of the article body, by backend;
+- `process_date_time_us`, `process_authors_us`: by value, the date cache
+  cleared on each repeat;
+- `crawl`: `benchmarks.crawl`, run in another process for its peak RSS.
+
+Results are written as JSON with the commit, `--compare` prints the change of
+every metric from a previous file. Exits with 1 when a golden item changed or
+the crawl failed (no item, or errors logged).
+"""
+
+import os
+import sys
+import json
+import time
+import timeit
+import argparse
+import platform
+import tempfile
+import subprocess
+from scrapy.http import HtmlResponse, Request
+from scrapy.utils.test import get_crawler
+from ze.processors.article import ArticleProcessor
+from ze.processors.common import CommonProcessor
+from benchmarks import crawl
+from benchmarks.clean_html import spider_classes, article_bodies, cleaner
+from benchmarks.corpus import SETTINGS, golden_pages, load_items, media
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Dates as found in the portals, every tier of `CommonProcessor.parse_date_time`
+DATES = (
+    u'2017-03-12T10:30:00-03:00',
+    u'2017-03-12 10:30:00',
+    u'12/03/2017 10h30',
+    u'Atualizado: 12/03/2017 | 10h30',
+    u'12 de março de 2017 10h30',
+    u'12 Mar 2017 10:30',
+    u'domingo, 12 de março de 2017',
+)
+
+AUTHORS = (
+    u'Por Fulano de Tal e Beltrano da Silva',
+    u'Fulano de Tal, O Estado de S.Paulo',
+    u'Fulano de Tal / RIO',
+    u'Ciclana Souza - estadão.com.br',
+)
+
+
+def per_call(function, values, repeat, setup=None):
+    """Seconds by value of `function` over `values`, best of `repeat`."""
+    def run():
+        if setup:
+            setup()
+        for value in values:
+            function(value)
+    return min(timeit.repeat(run, number=1, repeat=repeat)) / len(values)
+
+
+def check_golden(spider, pages):
+    changed = []
+    for url, html, golden in pages:
+        with open(golden) as f:
+            expected = json.load(f)
+        if json.loads(json.dumps(load_items(spider, url, html))) != expected:
+            changed.append(url)
+    return changed
+
+
+def micro(args):
+    results = {'golden': {}, 'load_item_ms': {}, 'clean_html_ms': {}}
+    clean_html = cleaner()
+    for spidercls in spider_classes():
+        pages = list(golden_pages(spidercls, args.pages))
+        if not pages:
+            continue
+        spider = spidercls.from_crawler(get_crawler(spidercls, SETTINGS))
+        changed = check_golden(spider, pages)
+        results['golden'][spidercls.name] = changed or 'ok'
+
+        def load(page):
+            url, html, _ = page
+            response = HtmlResponse(url, body=html.encode('utf-8'), encoding='utf-8',
+                                    request=Request(url, meta={'media': media(html)}))
+            try:
+                for plan in spider.plan:
+                    spider.load_item(response, plan.item_class, plan.args, plan)
+            except Exception:
+                # Invalid selectors of the spider, kept in the golden items
+                pass
+        results['load_item_ms'][spidercls.name] = per_call(load, pages, args.repeat) * 1000
+
+        bodies = [selected for _, selected in article_bodies(spidercls, args.pages)]
+        if bodies:
+            context = {'allowed_domains': spidercls.allowed_domains}
+            results['clean_html_ms'][spidercls.name] = {
+                'bs4': per_call(lambda s: clean_html(s.extract(), context), bodies, args.repeat) * 1000,
+                'lxml': per_call(lambda s: clean_html(s.root, context), bodies, args.repeat) * 1000,
+            }
+
+    results['process_date_time_us'] = per_call(CommonProcessor.process_date_time, DATES, args.repeat,
+                                               setup=CommonProcessor.parse_date_time.cache_clear) * 1e6
+    results['process_authors_us'] = per_call(ArticleProcessor.process_authors, AUTHORS, args.repeat) * 1e6
+    return results
+
+
+def run_crawl(args):
+    with tempfile.NamedTemporaryFile(suffix='.json') as output:
+        command = [sys.executable, '-m', 'benchmarks.crawl', '--output', output.name,
+                   '--pages', args.pages, '--articles', str(args.articles),
+                   '--latency', str(args.latency), '--jitter', str(args.jitter),
+                   '--loglevel', args.loglevel]
+        if args.spiders:
+            command += ['--spiders', args.spiders]
+        for setting in args.set:
+            command += ['-s', setting]
+        # Exits with 1 on a failed crawl, the results are written anyway
+        returncode = subprocess.call(command, cwd=ROOT, stdout=subprocess.DEVNULL)
+        if not os.path.getsize(output.name):
+            raise subprocess.CalledProcessError(returncode, command)
+        with open(output.name) as f:
+            return json.load(f)
+
+
+def commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def flatten(results, prefix=''):
+    for key, value in sorted(results.items()):
+        if isinstance(value, dict):
+            for item in flatten(value, '%s%s/' % (prefix, key)):
+                yield item
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield prefix + key, value
+
+
+def compare(previous, results):
+    before = dict(flatten(previous))
+    print('%-40s %12s %12s %8s' % ('metric', 'before', 'after', 'change'))
+    for key, value in flatten(results):
+        if key in before:
+            change = '%+7.1f%%' % ((value - before[key]) / before[key] * 100) if before[key] else '-'
+            print('%-40s %12.3f %12.3f %8s' % (key, before[key], value, change))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    crawl.add_arguments(parser)
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--no-crawl', action='store_true')
+    parser.add_argument('--output', default='benchmark-%s.json' % time.strftime('%Y%m%d-%H%M%S'))
+    parser.add_argument('--compare', help='results of a previous run')
+    args = parser.parse_args()
+
+    results = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': commit(),
+        'python': platform.python_version(),
+        'arguments': {'repeat': args.repeat, 'articles': args.articles,
+                      'latency': args.latency, 'jitter': args.jitter, 'settings': args.set},
+    }
+    results.update(micro(args))
+    if not args.no_crawl:
+        results['crawl'] = run_crawl(args)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print('Results written to %s' % args.output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+    else:
+        for key, value in flatten(results):
+            print('%-40s %12.3f' % (key, value))
+
+    changed = dict((name, urls) for name, urls in results['golden'].items() if urls != 'ok')
+    for name, urls in sorted(changed.items()):
+        print('Golden items changed: %s %s' % (name, ' '.join(urls)))
+    failed = 'crawl' in results and (not results['crawl']['items'] or results['crawl']['logged_errors'])
+    if failed:
+        print('Crawl failed: %(items)d items, %(logged_errors)d errors logged' % results['crawl'])
+    sys.exit(1 if changed or failed else 0)
+
+
+if __name__ == '__main__':
+    main()
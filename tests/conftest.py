@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+from twisted.internet import defer, reactor
+from scrapy.utils.test import get_crawler
+import ze.pipelines
+
+
+@pytest.fixture
+def stats():
+    return get_crawler().stats
+
+
+@pytest.fixture
+def sync_threads(monkeypatch):
+    """Run the work sent to threads at once, without a running reactor."""
+    monkeypatch.setattr(ze.pipelines.threads, 'deferToThread', defer.maybeDeferred)
+    monkeypatch.setattr(reactor, 'callFromThread', lambda f, *args, **kw: f(*args, **kw))
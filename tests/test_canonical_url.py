@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+from ze.settings import URL_CANONICAL_RULES
+from ze.utils import canonical_url
+
+
+@pytest.mark.parametrize('url, expected', [
+    ('https://m.g1.globo.com/educacao/noticia/enem.ghtml', 'https://g1.globo.com/educacao/noticia/enem.ghtml'),
+    ('http://m.noticias.uol.com.br/educacao/enem.htm', 'http://noticias.uol.com.br/educacao/enem.htm'),
+    ('http://m.folha.uol.com.br/educacao/enem.shtml', 'http://www1.folha.uol.com.br/educacao/enem.shtml'),
+    ('http://m.estadao.com.br/noticias/enem', 'http://www.estadao.com.br/noticias/enem'),
+    ('http://m.cartacapital.com.br/educacao/enem', 'http://www.cartacapital.com.br/educacao/enem/'),
+    ('http://g1.globo.com/amp/educacao/enem.ghtml?utm_source=x#top', 'http://g1.globo.com/educacao/enem.ghtml'),
+])
+def test_canonical_url(url, expected):
+    assert canonical_url(url, URL_CANONICAL_RULES) == expected
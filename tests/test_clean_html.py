@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+import json
+import pytest
+from bs4 import BeautifulSoup
+from scrapy.utils.test import get_crawler
+from ze.processors.html import CleanHTML
+from benchmarks.clean_html import spider_classes, article_bodies, cleaner
+from benchmarks.corpus import PAGES as PAGES_DIR, SETTINGS, golden_pages, load_items
+
+PAGES = [(spidercls, url, html, golden) for spidercls in spider_classes()
+         for url, html, golden in golden_pages(spidercls)]
+BODIES = [(spidercls, path, selected) for spidercls in spider_classes()
+          for path, selected in article_bodies(spidercls, PAGES_DIR)]
+
+
+def normalized(html):
+    """Tags, attributes and whitespace-collapsed text of `html`, serialization aside."""
+    soup = BeautifulSoup(html, 'html.parser')
+    tags = [(tag.name, sorted(tag.attrs.items())) for tag in soup.find_all(True)]
+    return tags, u' '.join(soup.get_text(u' ').split())
+
+
+@pytest.mark.parametrize('spidercls, url, html, golden', PAGES,
+                         ids=[url for _, url, _, _ in PAGES])
+def test_golden_items(spidercls, url, html, golden):
+    spider = spidercls.from_crawler(get_crawler(spidercls, SETTINGS))
+    with open(golden) as f:
+        expected = json.load(f)
+    assert json.loads(json.dumps(load_items(spider, url, html))) == expected
+
+
+@pytest.mark.parametrize('spidercls, path, selected', BODIES,
+                         ids=[path.split('/pages/')[-1] for _, path, _ in BODIES])
+def test_backends(spidercls, path, selected):
+    # bs4 output is prettified, lxml output is serialized as parsed
+    clean_html = cleaner()
+    context = {'allowed_domains': spidercls.allowed_domains}
+    assert normalized(clean_html(selected.extract(), context)) == \
+        normalized(clean_html(selected.root, context))
+
+
+def test_unwrap_and_decompose():
+    html = CleanHTML()(u'<div><p><span>texto</span></p> <script>x()</script><p></p>'
+                       u'<p style="color: red">fim</p></div>',
+                       {'allowed_domains': ['g1.globo.com']})
+    assert html == u'<div>\n <p>\n  texto\n </p>\n <p>\n  fim\n </p>\n</div>'
+
+
+def test_decompose_emptied_parents():
+    # The <div> left empty once its <p> is removed goes too, as in the original cleaner
+    html = CleanHTML()(u'<section><div><p></p></div><p>x</p></section>',
+                       {'allowed_domains': ['g1.globo.com']})
+    assert html == u'<section>\n <p>\n  x\n </p>\n</section>'
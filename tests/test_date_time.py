@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import types
+import time
+import datetime
+import pytest
+from concurrent.futures import Future
+from twisted.internet.defer import Deferred
+from scrapy.settings import Settings
+from ze.items import PendingItem, load_pending_item
+from ze.pipelines import ProcessPoolPipeline
+from ze.processors.common import CommonProcessor
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    CommonProcessor.parse_date_time.cache_clear()
+    yield
+    CommonProcessor.parse_date_time.cache_clear()
+
+
+@pytest.mark.parametrize('value, expected', [
+    (u'2017-03-12T10:30:00-03:00', u'2017-03-12T10:30:00-03:00'),
+    (u'2017-03-12T10:30:00Z', u'2017-03-12T10:30:00+00:00'),
+    (u'2017-03-12 10:30:00', u'2017-03-12T10:30:00'),
+])
+def test_iso(value, expected):
+    assert CommonProcessor.parse_date_time(value) == (expected, 'iso')
+
+
+@pytest.mark.parametrize('value, expected', [
+    (u'12/03/2017 10h30', u'2017-03-12T10:30:00'),
+    (u'Atualizado: 12/03/2017 | 10h30', u'2017-03-12T10:30:00'),
+    (u'12 de março de 2017 10h30', u'2017-03-12T10:30:00'),
+    (u'12 Mar 2017 10:30', u'2017-03-12T10:30:00'),
+    # The h of junho and julho is not an hour
+    (u'12 de junho de 2017 10h', u'2017-06-12T10:00:00'),
+    (u'3 de julho de 2017 9h05', u'2017-07-03T09:05:00'),
+])
+def test_portuguese_patterns(value, expected):
+    assert CommonProcessor.parse_date_time(value) == (expected, 'pt')
+
+
+def test_dateparser(monkeypatch):
+    dateparser = types.ModuleType('dateparser')
+    dateparser.parse = lambda value, **kw: datetime.datetime(2017, 3, 12)
+    monkeypatch.setitem(sys.modules, 'dateparser', dateparser)
+    assert CommonProcessor.parse_date_time(u'há dois dias') == (u'2017-03-12T00:00:00', 'dateparser')
+
+
+def test_failed(monkeypatch):
+    dateparser = types.ModuleType('dateparser')
+    dateparser.parse = lambda value, **kw: None
+    monkeypatch.setitem(sys.modules, 'dateparser', dateparser)
+    assert CommonProcessor.parse_date_time(u' nada disso ') == (u'nada disso', 'failed')
+
+
+def test_stats(stats):
+    CommonProcessor.process_date_time(u'12/03/2017 10h30', {'crawler_stats': stats})
+    assert stats.get_value('processors/date_time/pt_count') == 1
+
+
+def test_process_pool_stats(stats):
+    # Counted in the worker, merged in the crawler stats
+    item = PendingItem(item_class='ze.items.creativework.ArticleItem',
+                       values={'datePublished': [u'12/03/2017 10h30']}, context={})
+    future = Future()
+    future.set_result(load_pending_item(item['item_class'], item['values'], item['context']))
+    pipeline = ProcessPoolPipeline(Settings({'PROCESS_POOL_ENABLED': True}), stats)
+    d = Deferred()
+    pipeline._processed(future, item, d, None, time.time())
+    assert d.result['datePublished'] == u'2017-03-12T10:30:00'
+    assert stats.get_value('processors/date_time/pt_count') == 1
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+import json
+import urllib.parse
+from twisted.python.failure import Failure
+from scrapy.http import HtmlResponse, Request, TextResponse
+from scrapy.utils.test import get_crawler
+from ze.middlewares import FingerprintMiddleware
+from ze.spiders.estadao import EstadaoSpider
+from ze.utils import url_key
+from benchmarks.corpus import SETTINGS, golden_pages, estadao_media
+
+URL, HTML, GOLDEN = next(golden_pages(EstadaoSpider))
+
+
+def media_server(request):
+    """Response of the Estadão media service, stubbed."""
+    query = urllib.parse.parse_qs(urllib.parse.urlsplit(request.url).query)
+    body = json.dumps(estadao_media(query['tipo_midia'][0], query['idAgile'][0]))
+    return TextResponse(request.url, body=body.encode('utf-8'), encoding='utf-8', request=request)
+
+
+def crawl(spider, fail=False):
+    """Items of the article, the sub-requests answered by `media_server` or failed."""
+    items, _, requests = fetch(spider, fail)
+    return [dict(item) for item in items], requests
+
+
+def fetch(spider, fail=False, headers=None):
+    """(items, response they were scraped from, number of sub-requests) of the article."""
+    request = Request(URL)
+    response = HtmlResponse(URL, body=HTML.encode('utf-8'), encoding='utf-8',
+                            headers=headers, request=request)
+    output = list(spider.parse(response))
+    requests = 0
+    while output and isinstance(output[0], Request):
+        request = output[0]
+        requests += 1
+        if fail:
+            failure = Failure(IOError('Media service not available'))
+            failure.request = request
+            output = list(request.errback(failure))
+        else:
+            response = media_server(request)
+            output = list(request.callback(response))
+    return output, response, requests
+
+
+def spider(**settings):
+    settings = dict(SETTINGS, MEDIA_CACHE_TTL=3600, **settings)
+    return EstadaoSpider.from_crawler(get_crawler(EstadaoSpider, settings))
+
+
+def test_media_resolved():
+    estadao = spider()
+    items, requests = crawl(estadao)
+    with open(GOLDEN) as f:
+        assert json.loads(json.dumps(items)) == json.load(f)
+    assert requests > 0
+    assert estadao.crawler.stats.get_value('estadao/media/requests') == requests
+
+    # Cached for the next articles
+    assert crawl(estadao) == (items, 0)
+    assert estadao.crawler.stats.get_value('estadao/media/cache_hits') == requests
+
+
+def test_media_failed():
+    estadao = spider()
+    items, requests = crawl(estadao, fail=True)
+    assert len(items) == 1 and items[0]['articleBody']
+    assert estadao.crawler.stats.get_value('estadao/media/errors') == requests
+
+
+def test_media_fingerprint(tmpdir):
+    estadao = spider(FINGERPRINTS_ENABLED=True, FINGERPRINTS_PATH=str(tmpdir.join('fingerprints.db')))
+    middleware = FingerprintMiddleware.from_crawler(estadao.crawler)
+    headers = {'ETag': '"article"', 'Last-Modified': 'Sat, 17 Oct 2026 12:00:00 GMT'}
+    items, response, _ = fetch(estadao, headers=headers)
+    assert response.url != URL
+    middleware.item_scraped(items[0], response, estadao)
+
+    # Stored as the article, not as the media endpoint the item came from
+    known = middleware.store.get(url_key(URL))
+    assert known['hash'] is not None
+    assert known['etag'] == '"article"'
+    assert known['last_modified'] == 'Sat, 17 Oct 2026 12:00:00 GMT'
+    middleware.spider_closed(estadao)
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+from scrapy import Spider
+from scrapy.utils.test import get_crawler
+from ze.pipelines import MongoPipeline
+
+pymongo = pytest.importorskip('pymongo')
+from pymongo.errors import BulkWriteError
+from pymongo.results import BulkWriteResult, InsertManyResult
+
+SPIDER = Spider('g1')
+
+
+def items(count, start=0, **values):
+    return [dict({'url': 'http://g1.globo.com/%d' % n, 'name': u'Notícia %d' % n}, **values)
+            for n in range(start, start + count)]
+
+
+def run(pipeline, items):
+    pipeline.open_spider(SPIDER)
+    results = [pipeline.process_item(item, SPIDER) for item in items]
+    pipeline.close_spider(SPIDER)
+    return results
+
+
+class FakeCollection(object):
+    """NewsArticle collection, `hidden` documents are not found (written meanwhile)."""
+
+    def __init__(self, docs=(), hidden=()):
+        self.docs = dict((doc['url_key'], doc) for doc in docs)
+        self.hidden = set(hidden)
+        self.batches = []
+
+    def create_index(self, key, unique=False):
+        pass
+
+    def find(self, query, projection):
+        keys = query['url_key']['$in']
+        return [doc for key, doc in self.docs.items() if key in keys and key not in self.hidden]
+
+    def insert_many(self, batch, ordered=True):
+        self.batches.append(batch)
+        for doc in batch:
+            self.docs[len(self.docs)] = doc
+        return InsertManyResult(list(range(len(batch))), True)
+
+    def bulk_write(self, requests, ordered=True):
+        self.batches.append(requests)
+        result = {'nUpserted': 0, 'nModified': 0, 'nInserted': 0, 'writeErrors': []}
+        for i, request in enumerate(requests):
+            key, doc = request._filter['url_key'], request._doc
+            stored = self.docs.get(key)
+            if stored is None:
+                self.docs[key] = doc
+                result['nUpserted'] += 1
+            elif (stored.get('dateModified') or '') < doc['dateModified']:
+                self.docs[key] = doc
+                result['nModified'] += 1
+            else:
+                # The filter on dateModified misses, the upsert inserts
+                result['writeErrors'].append({'index': i, 'code': 11000})
+        if result['writeErrors']:
+            raise BulkWriteError(result)
+        return BulkWriteResult(result, True)
+
+
+class FakeMongoClient(object):
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.closed = False
+
+    def __getitem__(self, name):
+        return FakeDatabase(name, self.collection)
+
+    def close(self):
+        self.closed = True
+
+
+class FakeDatabase(dict):
+
+    def __init__(self, name, collection):
+        super(FakeDatabase, self).__init__(NewsArticle=collection)
+        self.name = name
+
+
+def mongo_pipeline(collection, **settings):
+    pipeline = MongoPipeline.from_crawler(get_crawler(settings_dict=settings))
+    pipeline.client_class = lambda uri: FakeMongoClient(collection)
+    return pipeline
+
+
+def test_mongo_batches(sync_threads):
+    collection = FakeCollection()
+    pipeline = mongo_pipeline(collection, MONGO_BATCH_SIZE=100)
+    assert len(run(pipeline, items(250))) == 250
+
+    assert [len(batch) for batch in collection.batches] == [100, 100, 50]
+    assert pipeline.stats.get_value('items/mongodb/insert_count') == 250
+    assert pipeline.stats.get_value('items/mongodb/batch_count') == 3
+    assert pipeline.client.closed
+
+
+def test_mongo_upsert(sync_threads):
+    collection = FakeCollection(docs=[
+        {'url_key': 'g1.globo.com/0', 'dateModified': '2017-03-12'},
+        {'url_key': 'g1.globo.com/1', 'dateModified': '2017-03-10'},
+        {'url_key': 'g1.globo.com/2', 'dateModified': '2017-03-12'},
+    ], hidden=['g1.globo.com/2'])
+    pipeline = mongo_pipeline(collection, MONGO_UPSERT=True)
+    run(pipeline, items(4, dateModified='2017-03-11'))
+
+    # 0 is newer, 1 older, 2 newer but stored meanwhile, 3 new
+    assert collection.docs['g1.globo.com/0']['dateModified'] == '2017-03-12'
+    assert collection.docs['g1.globo.com/1']['dateModified'] == '2017-03-11'
+    assert collection.docs['g1.globo.com/2']['dateModified'] == '2017-03-12'
+    assert collection.docs['g1.globo.com/3']['name'] == u'Notícia 3'
+    assert pipeline.stats.get_value('items/mongodb/skipped_count') == 2
+    assert pipeline.stats.get_value('items/mongodb/insert_count') == 2
+    assert pipeline.stats.get_value('items/mongodb/insert_erros_count') == 0
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+
+import time
+import random
+import collections
+from ze.utils.proxies import ProxyPool
+
+
+def test_pick_by_score():
+    random.seed(0)
+    pool = ProxyPool(['http://a', 'http://b', 'http://c'])
+    pool.success('http://a', 0.1)
+    pool.success('http://b', 5.0)
+    picks = collections.Counter(pool.pick() for _ in range(3000))
+    assert picks['http://a'] > picks['http://c'] > picks['http://b'] > 0
+
+
+def test_backoff(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, 'time', lambda: now[0])
+    pool = ProxyPool(['http://a', 'http://b'], backoff=60)
+    assert pool.failure('http://a') == 60
+    assert set(pool.pick() for _ in range(100)) == {'http://b'}
+    assert pool.failure('http://b') == 60
+    assert pool.pick() is None
+
+    # A second failure of a in a row doubles its backoff
+    now[0] += 30
+    assert pool.failure('http://a') == 120
+    now[0] += 40
+    assert pool.alive() == ['http://b']
+    assert set(pool.pick() for _ in range(100)) == {'http://b'}
+    now[0] += 120
+    assert set(pool.pick() for _ in range(100)) == {'http://a', 'http://b'}
+
+
+def test_scores_of_previous_run():
+    pool = ProxyPool(['http://a', 'http://b'],
+                     scores={'http://a': {'dead_until': time.time() + 60}})
+    assert set(pool.pick() for _ in range(100)) == {'http://b'}
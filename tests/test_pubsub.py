@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+from scrapy import Spider
+from scrapy.utils.test import get_crawler
+from ze.pipelines import GooglePubSubPipeline
+
+SPIDER = Spider('g1')
+
+
+def items(count, start=0, **values):
+    return [dict({'url': 'http://g1.globo.com/%d' % n, 'name': u'Notícia %d' % n}, **values)
+            for n in range(start, start + count)]
+
+
+def run(pipeline, items):
+    pipeline.open_spider(SPIDER)
+    results = [pipeline.process_item(item, SPIDER) for item in items]
+    pipeline.close_spider(SPIDER)
+    return results
+
+
+class FakePublisher(object):
+    """Pub/Sub client, `fail` makes the publishing fail."""
+
+    def __init__(self):
+        self.topics = {}
+        self.fail = False
+
+    def __call__(self):
+        return self
+
+    def topic(self, name):
+        return self.topics.setdefault(name, FakeTopic(self))
+
+
+class FakeTopic(object):
+
+    def __init__(self, client):
+        self.client = client
+        self.created = False
+        self.batches = []
+
+    def exists(self):
+        return self.created
+
+    def create(self):
+        self.created = True
+
+    def batch(self):
+        return FakeBatch(self)
+
+
+class FakeBatch(object):
+
+    def __init__(self, topic):
+        self.topic = topic
+        self.messages = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.topic.client.fail:
+            raise IOError('Pub/Sub not available')
+        if exc_info[0] is None:
+            self.topic.batches.append(self.messages)
+
+    def publish(self, message):
+        self.messages.append(message)
+
+
+def pubsub_pipeline(publisher, **settings):
+    settings = dict({'GOOGLE_CLOUD_ENABLED': True, 'PROJECT_NAME': 'ze'}, **settings)
+    pipelinecls = type('GooglePubSubPipeline', (GooglePubSubPipeline,), {'client_class': publisher})
+    return pipelinecls.from_crawler(get_crawler(settings_dict=settings))
+
+
+def test_pubsub_batches(sync_threads):
+    publisher = FakePublisher()
+    pipeline = pubsub_pipeline(publisher, PUBSUB_BATCH_SIZE=10)
+    run(pipeline, items(25))
+
+    topic = publisher.topics['ze.g1.newsarticle']
+    assert topic.created
+    assert [len(batch) for batch in topic.batches] == [10, 10, 5]
+    assert pipeline.stats.get_value('google/pubsub/published_count') == 25
+
+
+def test_pubsub_not_configured(sync_threads, tmpdir):
+    pipeline = pubsub_pipeline(FakePublisher(), GOOGLE_CLOUD_ENABLED=False,
+                               SPOOL_ENABLED=True, SPOOL_DIR=str(tmpdir))
+    assert run(pipeline, items(3)) == items(3)
+    assert pipeline.spool is None and not tmpdir.listdir()
+
+
+def test_spool_replayed(sync_threads, tmpdir):
+    publisher = FakePublisher()
+    publisher.fail = True
+    settings = {'SPOOL_ENABLED': True, 'SPOOL_DIR': str(tmpdir), 'SPOOL_SEGMENT_RECORDS': 10}
+    pipeline = pubsub_pipeline(publisher, **settings)
+    # Items are returned once spooled, the sink is down
+    assert len(run(pipeline, items(25))) == 25
+    spool = os.path.join(str(tmpdir), 'g1', 'GooglePubSubPipeline')
+    assert len(os.listdir(spool)) == 3
+    assert pipeline.stats.get_value('google/pubsub/spool/retry_count') == 1
+
+    publisher.fail = False
+    pipeline = pubsub_pipeline(publisher, **settings)
+    run(pipeline, [])
+    assert not os.listdir(spool)
+    assert pipeline.stats.get_value('google/pubsub/spool/replayed_segments') == 3
+    assert sum(len(batch) for batch in publisher.topics['ze.g1.newsarticle'].batches) == 25
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import types
+import pytest
+from scrapy.utils.test import get_crawler
+from ze.spiders.estadodeminas import EstadodeMinasSpider
+
+
+class FakeEngine(object):
+
+    def __init__(self):
+        self.requests = []
+
+    def crawl(self, request, spider):
+        self.requests.append(request.url)
+
+
+class FakeGoogleScraper(types.ModuleType):
+    """GoogleScraper reading the jobs of a keyword file, with canned results."""
+
+    GoogleSearchError = Exception
+
+    def __init__(self, results, engine):
+        super(FakeGoogleScraper, self).__init__('GoogleScraper')
+        self.results = results
+        self.engine = engine
+        self.calls = []
+
+    def scrape_with_config(self, config):
+        # Imported the way GoogleScraper does
+        kwfile = config['keyword_file']
+        sys.path.append(os.path.dirname(kwfile))
+        modname = os.path.split(kwfile)[-1].rstrip('.py')
+        jobs = getattr(__import__(modname, fromlist=['scrape_jobs']), 'scrape_jobs')
+
+        self.calls.append((sorted(job['query'] for job in jobs), set(job['page_number'] for job in jobs),
+                           config['num_workers'], len(self.engine.requests)))
+        serps = [types.SimpleNamespace(
+                     query=job['query'], page_number=job['page_number'],
+                     links=[types.SimpleNamespace(link=link)
+                            for link in self.results.get((job['query'], job['page_number']), [])])
+                 for job in jobs]
+        return types.SimpleNamespace(serps=serps)
+
+
+@pytest.fixture
+def search(tmpdir, monkeypatch, sync_threads):
+    results = {
+        ('enem site:em.com.br', 1): ['http://em.com.br/a', 'http://em.com.br/b'],
+        ('enem site:em.com.br', 2): ['http://em.com.br/c'],
+        ('enem site:uai.com.br', 1): [],
+    }
+
+    def search():
+        settings = dict(SEARCH_CACHE_TTL=3600, SEARCH_CACHE_PATH=str(tmpdir.join('search.db')),
+                        SEARCH_CONCURRENCY=4)
+        spider = EstadodeMinasSpider.from_crawler(get_crawler(EstadodeMinasSpider, settings))
+        spider.crawler.engine = FakeEngine()
+        scraper = FakeGoogleScraper(results, spider.crawler.engine)
+        monkeypatch.setitem(sys.modules, 'GoogleScraper', scraper)
+
+        spider.start_time = time.time()
+        spider.search_domains({'query': 'enem', 'pages': 3})
+        assert spider.searching is None
+        spider.search_cache.close()
+        return spider.crawler.engine.requests, scraper.calls
+
+    return search
+
+
+def test_search_pages(search):
+    requests, calls = search()
+    assert requests == ['http://em.com.br/a', 'http://em.com.br/b', 'http://em.com.br/c']
+    # Both domains in one search, the links of a page scheduled before the next
+    # page is searched, and the queries without results not searched further
+    assert calls == [
+        (['enem site:em.com.br', 'enem site:uai.com.br'], {1}, 2, 0),
+        (['enem site:em.com.br'], {2}, 1, 2),
+        (['enem site:em.com.br'], {3}, 1, 3),
+    ]
+    # Keyword files removed
+    assert not [path for path in sys.path if 'ze-search-' in path]
+
+
+def test_search_cached(search):
+    search()
+    requests, calls = search()
+    assert requests == ['http://em.com.br/a', 'http://em.com.br/b', 'http://em.com.br/c']
+    assert calls == []
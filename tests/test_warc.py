@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+import os
+import glob
+import hashlib
+from ze.utils.warc import WarcWriter, WarcIndex, iter_records, read_record, segments
+
+HEADERS = [(b'Content-Type', b'text/html; charset=utf-8'), (b'Content-Encoding', b'gzip')]
+
+
+def write(writer, n, body=b'<html>%d</html>'):
+    return writer.write('http://g1.globo.com/%d' % n, 200, HEADERS, body % n, [('Ze-Callback', 'parse')])
+
+
+def test_round_trip(tmpdir):
+    writer = WarcWriter(str(tmpdir))
+    assert write(writer, 0) > 0
+    writer.close()
+
+    files = segments(str(tmpdir))
+    assert len(files) == 1 and not files[0].endswith('.open.warc.gz')
+    records = list(iter_records(files[0]))
+    assert [r.type for r in records] == ['warcinfo', 'response']
+    assert records[1].url == 'http://g1.globo.com/0'
+    assert records[1].fields['Ze-Callback'] == 'parse'
+    status, headers, body = records[1].http()
+    assert (status, body) == (200, b'<html>0</html>')
+    # The body is decoded, its encoding and length are rewritten
+    assert dict(headers) == {b'Content-Type': b'text/html; charset=utf-8', b'Content-Length': b'14'}
+
+    index = WarcIndex(str(tmpdir))
+    record = read_record(str(tmpdir), *index.get('http://g1.globo.com/0'))
+    assert record.http()[2] == b'<html>0</html>'
+
+
+def test_duplicates_and_segments(tmpdir):
+    writer = WarcWriter(str(tmpdir), segment_records=2)
+    for n in range(5):
+        write(writer, n)
+    assert write(writer, 4) == 0
+    assert write(writer, 4, b'<html>%d changed</html>') > 0
+    writer.close()
+
+    files = segments(str(tmpdir))
+    assert len(files) == 3
+    assert sum(len(list(iter_records(f))) for f in files) == 3 + 6
+    # Named after their content
+    assert all(os.path.basename(f).split('.')[0] == sha1(f) for f in files)
+
+
+def test_recovery(tmpdir):
+    writer = WarcWriter(str(tmpdir))
+    for n in range(3):
+        write(writer, n)
+    writer.file.flush()
+    segment = writer.file.name
+
+    # Locked while written, not recovered by another writer
+    WarcWriter(str(tmpdir)).close()
+    assert os.path.exists(segment)
+
+    # Crash in the middle of the last record, with the same process
+    with open(segment, 'r+b') as f:
+        f.truncate(os.path.getsize(segment) - 10)
+    writer.file.close()
+
+    recovered = WarcWriter(str(tmpdir))
+    assert not glob.glob(os.path.join(str(tmpdir), '*.open.warc.gz'))
+    files = segments(str(tmpdir))
+    assert [r.url for r in iter_records(files[0])] == [None, 'http://g1.globo.com/0', 'http://g1.globo.com/1']
+    assert recovered.index.get('http://g1.globo.com/2') is None
+    assert recovered.index.get('http://g1.globo.com/1')[0] == os.path.basename(files[0])
+    # The lost response is written again
+    assert write(recovered, 2) > 0
+    recovered.close()
+
+
+def sha1(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
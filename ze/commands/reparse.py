@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import logging
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from twisted.internet import defer, reactor
+from twisted.python.failure import Failure
+from scrapy.commands import ScrapyCommand
+from scrapy.crawler import Crawler
+from scrapy.exceptions import UsageError, IgnoreRequest, DropItem
+from scrapy.http import Headers, Request
+from scrapy.pipelines import ItemPipelineManager
+from scrapy.responsetypes import responsetypes
+from scrapy.settings import Settings
+from scrapy.spiderloader import SpiderLoader
+from scrapy.utils.conf import arglist_to_dict
+from scrapy.utils.spider import iterate_spider_output
+import ze.utils
+from ze.utils.warc import WarcIndex, iter_records, read_record, segments
+
+logger = logging.getLogger(__name__)
+
+# Settings of the spiders in the workers: no extension, and no state written
+# by several processes
+WORKER_SETTINGS = {
+    'EXTENSIONS': {},
+    'EXTENSIONS_BASE': {},
+    'FINGERPRINTS_ENABLED': False,
+    'SELECTOR_STATS_ENABLED': False,
+    'SEARCH_CACHE_TTL': 0,
+    'PROCESS_POOL_ENABLED': False,
+}
+
+
+class Command(ScrapyCommand):
+
+    requires_project = True
+
+    def syntax(self):
+        return '[options] <spider> <archive>'
+
+    def short_desc(self):
+        return 'Extract the items of archived responses again, without network'
+
+    def long_desc(self):
+        return ('Run the spider `parse` on the article responses of a WARC archive '
+                '(a directory of segments written by ze.middlewares.ArchiveMiddleware, '
+                'or one segment) in a pool of processes, and the items through the '
+                'item pipelines. Sub-requests (e.g. Estadão media) are answered from '
+                'the index of the archive.')
+
+    def add_options(self, parser):
+        ScrapyCommand.add_options(self, parser)
+        parser.add_option('-a', dest='spargs', action='append', default=[], metavar='NAME=VALUE',
+                          help='set spider argument (may be repeated)')
+        parser.add_option('-P', '--processes', type='int', default=0,
+                          help='worker processes (default: CPU count)')
+
+    def process_options(self, args, opts):
+        ScrapyCommand.process_options(self, args, opts)
+        try:
+            opts.spargs = arglist_to_dict(opts.spargs)
+        except ValueError:
+            raise UsageError('Invalid -a value, use -a NAME=VALUE', print_help=False)
+
+    def run(self, args, opts):
+        if len(args) != 2:
+            raise UsageError()
+        name, path = args
+        try:
+            spidercls = self.crawler_process.spider_loader.load(name)
+        except KeyError:
+            raise UsageError('Spider not found: %s' % name, print_help=False)
+        if os.path.isdir(path):
+            archive, files = path, segments(path)
+        else:
+            archive, files = os.path.dirname(path) or '.', [path]
+        if not files:
+            raise UsageError('No WARC segment in %s' % path, print_help=False)
+
+        crawler = self.crawler_process.create_crawler(spidercls)
+        reparse = Reparse(crawler, archive, opts.spargs, opts.processes or os.cpu_count())
+        d = reparse.run(files)
+        d.addBoth(lambda _: reactor.stop())
+        self.crawler_process.start(stop_after_crawl=False)
+        if crawler.stats.get_value('reparse/errors_count'):
+            self.exitcode = 1
+
+
+class Reparse(object):
+    """
+    Parse the segments of an archive in a pool of worker processes (see
+    `Reparser`), at most two segments by process at once, and send the items
+    to the item pipelines in the reactor. The stats of the workers are added
+    to the stats of the crawler.
+    """
+
+    def __init__(self, crawler, archive, spider_args, processes):
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.archive = archive
+        self.spider_args = spider_args
+        self.processes = processes
+        crawler.spider = crawler._create_spider(**spider_args)
+        self.spider = crawler.spider
+        self.itemproc = ItemPipelineManager.from_crawler(crawler)
+
+    @defer.inlineCallbacks
+    def run(self, files):
+        started = time.time()
+        self.stats.open_spider(self.spider)
+        yield self.itemproc.open_spider(self.spider)
+        logger.info('Reparsing %d segments of %s in %d processes' % (
+            len(files), self.archive, self.processes))
+
+        executor = ProcessPoolExecutor(self.processes)
+        settings = self.crawler.settings.copy_to_dict()
+        pending = deque()
+        files = iter(files)
+        try:
+            while True:
+                for segment in files:
+                    pending.append((segment, deferred_from_future(executor.submit(
+                        reparse_segment, self.spider.name, settings, self.spider_args,
+                        self.archive, segment))))
+                    if len(pending) >= self.processes * 2:
+                        break
+                if not pending:
+                    break
+                segment, d = pending.popleft()
+                try:
+                    items, stats = yield d
+                except Exception as e:
+                    logger.error('Segment %s not reparsed: %s' % (segment, e))
+                    self.stats.inc_value('reparse/errors_count')
+                    continue
+                merge_stats(self.stats, stats)
+                for item_class, values in items:
+                    yield self.process_item(ze.utils.import_class(item_class)(values))
+                logger.info('Segment %s: %d responses, %d items' % (
+                    segment, stats.get('reparse/response_count', 0), len(items)))
+        finally:
+            executor.shutdown(wait=False)
+            yield self.itemproc.close_spider(self.spider)
+            elapsed = time.time() - started
+            self.stats.set_value('reparse/elapsed', elapsed)
+            self.stats.set_value('reparse/responses_per_second',
+                                 self.stats.get_value('reparse/response_count', 0) / elapsed)
+            self.stats.close_spider(self.spider, reason='finished')
+
+    @defer.inlineCallbacks
+    def process_item(self, item):
+        try:
+            yield self.itemproc.process_item(item, self.spider)
+        except DropItem as e:
+            logger.debug('Dropped: %s' % e)
+            self.stats.inc_value('item_dropped_count')
+        except Exception as e:
+            logger.error('Error processing %s: %s' % (item.get('url'), e))
+            self.stats.inc_value('reparse/pipeline_errors_count')
+        else:
+            self.stats.inc_value('item_scraped_count')
+
+
+class Reparser(object):
+    """
+    The spider, without engine, in a worker process: `parse` runs on the
+    responses archived with the `parse` callback, and the requests it returns
+    are answered from the index of the archive (the errback is called with
+    IgnoreRequest when the response is not archived).
+    """
+
+    def __init__(self, spider_name, settings, spider_args, archive):
+        settings = Settings(settings)
+        settings.setdict(WORKER_SETTINGS, priority='cmdline')
+        spidercls = SpiderLoader.from_settings(settings).load(spider_name)
+        self.crawler = Crawler(spidercls, settings)
+        self.spider = self.crawler.spider = self.crawler._create_spider(**spider_args)
+        self.stats = self.crawler.stats
+        self.archive = archive
+        self.index = WarcIndex(archive) if os.path.exists(os.path.join(archive, 'index.db')) else None
+
+    def reparse(self, segment):
+        """Items ([(class path, values)]) and stats of the responses of `segment`."""
+        self.stats.set_stats({})
+        items = []
+        for record in iter_records(segment):
+            if record.type != 'response' or record.fields.get('Ze-Callback', 'parse') != 'parse':
+                continue
+            self.stats.inc_value('reparse/response_count')
+            try:
+                self.run(self.spider.parse, archived_response(record, Request(record.url)), items)
+            except Exception:
+                self.stats.inc_value('reparse/errors_count')
+                logger.exception('Error reparsing %s' % record.url)
+        return items, self.stats.get_stats()
+
+    def run(self, callback, result, items):
+        for output in iterate_spider_output(callback(result)):
+            if isinstance(output, Request):
+                self.follow(output, items)
+            elif output is not None:
+                item_class = type(output)
+                items.append(('%s.%s' % (item_class.__module__, item_class.__name__), dict(output)))
+
+    def follow(self, request, items):
+        location = self.index.get(request.url) if self.index is not None else None
+        if location is not None:
+            self.stats.inc_value('reparse/archived_requests_count')
+            response = archived_response(read_record(self.archive, *location), request)
+            self.run(request.callback or self.spider.parse, response, items)
+            return
+
+        self.stats.inc_value('reparse/missing_requests_count')
+        if request.errback:
+            failure = Failure(IgnoreRequest('Response not archived: %s' % request.url))
+            failure.request = request
+            self.run(request.errback, failure, items)
+
+
+# Reparser of the worker process, created on its first segment
+reparser = None
+
+
+def reparse_segment(spider_name, settings, spider_args, archive, segment):
+    global reparser
+    if reparser is None:
+        reparser = Reparser(spider_name, settings, spider_args, archive)
+    return reparser.reparse(segment)
+
+
+def archived_response(record, request):
+    status, headers, body = record.http()
+    headers = Headers(headers)
+    respcls = responsetypes.from_args(headers=headers, url=record.url, body=body)
+    return respcls(url=record.url, status=status, headers=headers, body=body, request=request)
+
+
+def deferred_from_future(future):
+    d = defer.Deferred()
+
+    def done(future):
+        if future.exception() is not None:
+            reactor.callFromThread(d.errback, future.exception())
+        else:
+            reactor.callFromThread(d.callback, future.result())
+    future.add_done_callback(done)
+    return d
+
+
+def merge_stats(stats, values):
+    for key, value in values.items():
+        if not isinstance(value, (int, float)) or isinstance(value, bool):
+            continue
+        if key.endswith('/max') or key.startswith('max_') or '/max_' in key:
+            stats.max_value(key, value)
+        else:
+            stats.inc_value(key, value, start=0)
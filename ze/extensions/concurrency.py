@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+import time
+import email.utils
+import logging
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+
+logger = logging.getLogger(__name__)
+
+# Responses asking to slow down, their Retry-After header is honored
+THROTTLE_CODES = (429, 503)
+
+
+class AdaptiveConcurrency(object):
+    """
+    Adjust the concurrency and delay of each download slot (a portal domain)
+    from its responses:
+
+    - 429 and 503 halve the concurrency and double the delay, at least to
+      the Retry-After of the response;
+    - a latency EWMA above ADAPTIVE_CONCURRENCY_TARGET_LATENCY or an error
+      rate EWMA above ADAPTIVE_CONCURRENCY_ERROR_RATE decrease the
+      concurrency by one;
+    - otherwise, after as many good responses as the concurrency, it grows
+      by one and the delay is halved.
+
+    Concurrency stays between ADAPTIVE_CONCURRENCY_MIN and
+    ADAPTIVE_CONCURRENCY_MAX, and the delay between DOWNLOAD_DELAY and
+    ADAPTIVE_CONCURRENCY_MAX_DELAY; spiders set their bounds with
+    `custom_settings`. The current values of each slot are kept in the stats
+    (`adaptive_concurrency/<slot>/...`).
+
+    CONCURRENT_REQUESTS_PER_IP is unset, the slots would be by IP and portals
+    sharing a CDN would be tuned together.
+    """
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        if not settings.getbool('ADAPTIVE_CONCURRENCY_ENABLED'):
+            raise NotConfigured
+        if settings.getint('CONCURRENT_REQUESTS_PER_IP'):
+            settings.set('CONCURRENT_REQUESTS_PER_IP', 0, priority='cmdline')
+            logger.info('CONCURRENT_REQUESTS_PER_IP unset, concurrency is adapted by domain')
+
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.min_concurrency = settings.getint('ADAPTIVE_CONCURRENCY_MIN', 1)
+        self.max_concurrency = settings.getint('ADAPTIVE_CONCURRENCY_MAX', 32)
+        self.min_delay = settings.getfloat('DOWNLOAD_DELAY')
+        self.max_delay = settings.getfloat('ADAPTIVE_CONCURRENCY_MAX_DELAY', 60)
+        self.target_latency = settings.getfloat('ADAPTIVE_CONCURRENCY_TARGET_LATENCY', 2)
+        self.max_error_rate = settings.getfloat('ADAPTIVE_CONCURRENCY_ERROR_RATE', 0.1)
+        self.alpha = settings.getfloat('ADAPTIVE_CONCURRENCY_EWMA_ALPHA', 0.3)
+        # Latency, error rate and good responses in a row by slot
+        self.slots = {}
+
+        crawler.signals.connect(self.response_downloaded, signal=signals.response_downloaded)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def response_downloaded(self, response, request, spider):
+        key = request.meta.get('download_slot')
+        slot = self.crawler.engine.downloader.slots.get(key)
+        latency = request.meta.get('download_latency')
+        if slot is None or latency is None:
+            return
+
+        state = self.slots.setdefault(key, {'latency': latency, 'error_rate': 0.0, 'good': 0})
+        error = response.status >= 500 or response.status in THROTTLE_CODES
+        state['latency'] = (1 - self.alpha) * state['latency'] + self.alpha * latency
+        state['error_rate'] = (1 - self.alpha) * state['error_rate'] + self.alpha * error
+
+        concurrency, delay = slot.concurrency, slot.delay
+        if response.status in THROTTLE_CODES:
+            state['good'] = 0
+            concurrency = concurrency // 2
+            delay = max(delay * 2 or 1, retry_after(response) or 0)
+            self.stats.inc_value('adaptive_concurrency/%s/throttled_count' % key)
+        elif state['latency'] > self.target_latency or state['error_rate'] > self.max_error_rate:
+            state['good'] = 0
+            concurrency -= 1
+        else:
+            state['good'] += 1
+            if state['good'] >= concurrency:
+                state['good'] = 0
+                concurrency += 1
+                delay = delay / 2 if delay / 2 > 0.01 else 0
+
+        slot.concurrency = max(self.min_concurrency, min(self.max_concurrency, concurrency))
+        slot.delay = max(self.min_delay, min(self.max_delay, delay))
+
+        self.stats.set_value('adaptive_concurrency/%s/concurrency' % key, slot.concurrency)
+        self.stats.set_value('adaptive_concurrency/%s/delay' % key, slot.delay)
+        self.stats.set_value('adaptive_concurrency/%s/latency' % key, state['latency'])
+        self.stats.set_value('adaptive_concurrency/%s/error_rate' % key, state['error_rate'])
+
+
+def retry_after(response):
+    """Seconds of the Retry-After header of `response` (seconds or HTTP date)."""
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    value = value.decode('latin-1').strip()
+    if value.isdigit():
+        return int(value)
+    try:
+        return max(0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError, IndexError):
+        return None
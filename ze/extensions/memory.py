@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import time
+import socket
+import resource
+import tracemalloc
+import urllib.request
+import logging
+from collections.abc import Mapping
+from twisted.internet import task, threads
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from ze.utils.stats import observe
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds, in bytes, of the item size histogram
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+class MemoryMonitor(object):
+    """
+    Memory usage of the crawl, checked every MEMORY_CHECK_INTERVAL seconds,
+    in the stats (`memory/...`):
+
+    - the current RSS of the process (`rss`, `rss_max` and `rss_startup`);
+    - the bytes of the responses being parsed and the items in the pipelines
+      (`inflight_response_bytes`, `inflight_items`), the requests being
+      downloaded and the scheduler queue (`downloading`, `scheduled`);
+    - the estimated size of every scraped item (`item_size` histogram).
+
+    Above MEMORY_WARNING_MB a report is logged, with the top allocation sites
+    since the spider opened when MEMORY_TRACEMALLOC is set (it slows down the
+    crawl), and posted as JSON to MEMORY_WEBHOOK_URL. Above MEMORY_PAUSE_MB the
+    engine stops scheduling requests until the RSS goes below
+    MEMORY_RESUME_MB. Freed memory is not always given back to the system:
+    when nothing is in flight anymore the crawl is resumed anyway, at most
+    MEMORY_PAUSE_MAX_RESUMES times, then pausing is disabled for the rest of
+    the crawl (`resume_count`, `idle_resume_count`). Above MEMORY_LIMIT_MB
+    the spider is closed. Thresholds of 0 are disabled.
+    """
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        if not settings.getbool('MEMORY_MONITOR_ENABLED'):
+            raise NotConfigured
+
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.interval = settings.getfloat('MEMORY_CHECK_INTERVAL', 10)
+        self.warning = settings.getint('MEMORY_WARNING_MB') * 1024 * 1024
+        self.pause = settings.getint('MEMORY_PAUSE_MB') * 1024 * 1024
+        self.resume = settings.getint('MEMORY_RESUME_MB') * 1024 * 1024 or int(self.pause * 0.9)
+        self.limit = settings.getint('MEMORY_LIMIT_MB') * 1024 * 1024
+        self.max_idle_resumes = settings.getint('MEMORY_PAUSE_MAX_RESUMES', 3)
+        self.webhook_url = settings.get('MEMORY_WEBHOOK_URL')
+        self.tracemalloc_frames = settings.getint('MEMORY_TRACEMALLOC') and \
+            settings.getint('MEMORY_TRACEMALLOC_FRAMES', 1)
+        self.tracemalloc_top = settings.getint('MEMORY_TRACEMALLOC_TOP', 10)
+        self.baseline = None
+        self.warned = False
+        self.paused = False
+        self.spider = None
+        self.task = None
+
+        crawler.signals.connect(self.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(self.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(self.item_scraped, signal=signals.item_scraped)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def spider_opened(self, spider):
+        self.spider = spider
+        self.stats.set_value('memory/rss_startup', rss())
+        if self.tracemalloc_frames:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(self.tracemalloc_frames)
+            self.baseline = tracemalloc.take_snapshot()
+        self.task = task.LoopingCall(self.check)
+        self.task.start(self.interval, now=True)
+
+    def spider_closed(self, spider):
+        if self.task is not None and self.task.running:
+            self.task.stop()
+        self.baseline = None
+
+    def item_scraped(self, item, spider):
+        size = estimate_size(item)
+        observe(self.stats, 'memory/item_size', size, SIZE_BUCKETS)
+
+    def usage(self):
+        engine = self.crawler.engine
+        usage = {'rss': rss()}
+        if engine.slot is not None:
+            usage['scheduled'] = len(engine.slot.scheduler)
+        usage['downloading'] = len(engine.downloader.active)
+        if engine.scraper.slot is not None:
+            usage['inflight_response_bytes'] = engine.scraper.slot.active_size
+            usage['inflight_items'] = engine.scraper.slot.itemproc_size
+        return usage
+
+    def check(self):
+        usage = self.usage()
+        for key, value in usage.items():
+            self.stats.set_value('memory/%s' % key, value)
+        self.stats.max_value('memory/rss_max', usage['rss'])
+        logger.debug('Memory usage: %s' % ', '.join('%s=%s' % item for item in sorted(usage.items())))
+
+        if self.limit and usage['rss'] > self.limit:
+            self.stats.set_value('memory/limit_reached', 1)
+            self.report('limit', usage)
+            self.crawler.engine.close_spider(self.spider, 'memory_exceeded')
+            return
+
+        if self.warning:
+            if usage['rss'] > self.warning and not self.warned:
+                self.warned = True
+                self.stats.inc_value('memory/warning_count')
+                self.report('warning', usage)
+            elif usage['rss'] < self.warning:
+                self.warned = False
+
+        if self.pause:
+            self.check_pause(usage)
+
+    def check_pause(self, usage):
+        engine = self.crawler.engine
+        # Pausing without requests nor items in flight frees nothing
+        idle = not usage['downloading'] and not usage.get('inflight_response_bytes') \
+            and not usage.get('inflight_items')
+        if not self.paused and usage['rss'] > self.pause and not idle:
+            self.paused = True
+            self.stats.inc_value('memory/paused_count')
+            if self.stats.get_value('memory/paused_count') == 1:
+                self.report('paused', usage)
+            else:
+                logger.info('Scheduling paused, %dMB used' % (usage['rss'] / 1024 / 1024))
+            engine.pause()
+        elif self.paused and usage['rss'] < self.resume:
+            self.stats.inc_value('memory/resume_count')
+            self.unpause('Scheduling resumed, %dMB used' % (usage['rss'] / 1024 / 1024))
+        elif self.paused and idle:
+            self.stats.inc_value('memory/resume_count')
+            self.stats.inc_value('memory/idle_resume_count')
+            if self.stats.get_value('memory/idle_resume_count') >= self.max_idle_resumes:
+                # The RSS does not go down by pausing, it would pause again and again
+                self.pause = 0
+                logger.warning('Scheduling resumed with nothing in flight %d times, %dMB used: '
+                               'pausing disabled' % (self.max_idle_resumes, usage['rss'] / 1024 / 1024))
+                self.unpause(None)
+            else:
+                self.unpause('Scheduling resumed, %dMB used and nothing in flight' % (
+                    usage['rss'] / 1024 / 1024))
+
+    def unpause(self, message):
+        if message:
+            logger.info(message)
+        self.paused = False
+        engine = self.crawler.engine
+        engine.unpause()
+        if engine.slot is not None:
+            engine.slot.nextcall.schedule()
+
+    def report(self, event, usage):
+        """Log `usage` on `event` (warning, paused, limit) and post it to the webhook."""
+        report = {
+            'event': event,
+            'spider': self.spider.name,
+            'host': socket.gethostname(),
+            'time': time.time(),
+            'usage': usage,
+            'rss_startup': self.stats.get_value('memory/rss_startup'),
+            'rss_max': self.stats.get_value('memory/rss_max'),
+            'top_allocations': self.top_allocations(),
+        }
+        log = logger.error if event == 'limit' else logger.warning
+        log('Memory %s at %dMB: %s' % (event, usage['rss'] / 1024 / 1024,
+            ', '.join('%s=%s' % item for item in sorted(usage.items()))))
+        for allocation in report['top_allocations']:
+            log('  %(size)d bytes in %(count)d blocks (%(size_diff)+d) at %(site)s' % allocation)
+
+        if self.webhook_url:
+            d = threads.deferToThread(post_json, self.webhook_url, report)
+            d.addCallback(lambda _: self.stats.inc_value('memory/webhook_count'))
+            d.addErrback(lambda f: logger.warning('Memory report not sent to %s: %s' % (
+                self.webhook_url, f.value)))
+
+    def top_allocations(self):
+        """Allocation sites growing the most since the spider opened, with MEMORY_TRACEMALLOC."""
+        if self.baseline is None or not tracemalloc.is_tracing():
+            return []
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        ))
+        return [{
+            'site': str(stat.traceback),
+            'size': stat.size,
+            'size_diff': stat.size_diff,
+            'count': stat.count,
+        } for stat in snapshot.compare_to(self.baseline, 'lineno')[:self.tracemalloc_top]]
+
+
+def rss():
+    """Current resident set size of the process, in bytes (the peak out of Linux)."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        size = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Bytes on Mac OS X, kilobytes on Linux
+        return size if sys.platform == 'darwin' else size * 1024
+
+
+def estimate_size(value):
+    """Approximate bytes held by an item: the length of its strings."""
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    if isinstance(value, Mapping):
+        return sum(len(k) + estimate_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sum(estimate_size(v) for v in value)
+    return 8
+
+
+def post_json(url, data):
+    request = urllib.request.Request(url, data=json.dumps(data).encode('utf-8'),
+                                     headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return response.status
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+
+import re
+import time
+import urllib.parse
+import logging
+from twisted.internet import reactor
+from twisted.internet.error import CannotListenError
+from twisted.web import resource, server
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from ze.utils.stats import TIME_BUCKETS, observe
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds, in seconds, of the stage histograms: CleanHTML and dates take
+# from microseconds to milliseconds
+STAGE_BUCKETS = (0.0001, 0.0005) + TIME_BUCKETS
+
+
+class StageTimer(object):
+    """
+    Histograms of the time spent in each stage of the crawl, in `stats`:
+    `timing/<stage>` and, with `by_domain`, `timing/<stage>/<domain>` (see
+    `ze.utils.stats.observe`). Set on the spider as `stage_timer`, and sent
+    to the processors in the loader context.
+    """
+
+    def __init__(self, stats, by_domain=True, buckets=STAGE_BUCKETS):
+        self.stats = stats
+        self.by_domain = by_domain
+        self.buckets = buckets
+        # (stage, domain or None) observed, for the export
+        self.series = set()
+
+    def observe(self, stage, seconds, url=None):
+        observe(self.stats, 'timing/' + stage, seconds, self.buckets)
+        self.series.add((stage, None))
+        if url and self.by_domain:
+            domain = urllib.parse.urlsplit(url).hostname
+            observe(self.stats, 'timing/%s/%s' % (stage, domain), seconds, self.buckets)
+            self.series.add((stage, domain))
+
+    def since(self, stage, started, url=None):
+        self.observe(stage, time.time() - started, url)
+
+
+class StageTiming(object):
+    """
+    Time the stages of the crawl, by spider (each crawler has its stats) and
+    by domain, recorded in the stats by a `StageTimer`:
+
+    - `search`: a search engine query, or a feed parsed by the `own` engine;
+    - `download`: the download latency of each response;
+    - `load_item`: `ZeSpider.load_item`, selectors and processors included;
+    - `clean_html` and `date_time`: CleanHTML and `process_date_time`;
+    - `process_pool`: an item in ProcessPoolPipeline, queue included. With
+      PROCESS_POOL_ENABLED `load_item` does not include the processors, which
+      are timed in the workers.
+
+    The batches of the Mongo and Pub/Sub pipelines are already timed by
+    their `flush_time` histograms. With TIMING_PROMETHEUS_PORT the histograms,
+    and the other numeric stats, are served in Prometheus text format at
+    `http://TIMING_PROMETHEUS_HOST:<port>/metrics` while the crawl runs.
+    """
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        if not settings.getbool('TIMING_ENABLED'):
+            raise NotConfigured
+
+        self.stats = crawler.stats
+        self.timer = StageTimer(crawler.stats, settings.getbool('TIMING_BY_DOMAIN', True))
+        self.port = settings.getint('TIMING_PROMETHEUS_PORT')
+        self.host = settings.get('TIMING_PROMETHEUS_HOST') or '127.0.0.1'
+        self.spider = None
+
+        crawler.signals.connect(self.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(self.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(self.response_downloaded, signal=signals.response_downloaded)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def spider_opened(self, spider):
+        self.spider = spider
+        spider.stage_timer = self.timer
+        if self.port:
+            exporter.add(self, self.port, self.host)
+
+    def spider_closed(self, spider):
+        if self.port:
+            exporter.remove(self)
+        for stage, domain in sorted(self.timer.series, key=lambda s: (s[0], s[1] or '')):
+            if domain is None:
+                key = 'timing/' + stage
+                count = self.stats.get_value(key + '/le_inf')
+                logger.info('%s: %d times, %.3fms mean, %.3fms max' % (
+                    stage, count, self.stats.get_value(key + '/sum') / count * 1000,
+                    self.stats.get_value(key + '/max') * 1000))
+
+    def response_downloaded(self, response, request, spider):
+        latency = request.meta.get('download_latency')
+        if latency is not None:
+            self.timer.observe('download', latency, response.url)
+
+    def metrics(self, families):
+        """Add the stats of the spider to `families`, {name: (type, lines)} of the Prometheus text format."""
+        spider = prometheus_label(self.spider.name if self.spider else '')
+        stats = self.stats.get_stats()
+        histograms = set()
+
+        for stage, domain in sorted(self.timer.series, key=lambda s: (s[0], s[1] or '')):
+            key = 'timing/%s/%s' % (stage, domain) if domain else 'timing/' + stage
+            labels = 'spider="%s",stage="%s"' % (spider, stage)
+            if domain:
+                labels += ',domain="%s"' % prometheus_label(domain)
+            family(families, 'ze_stage_seconds', 'histogram').extend(
+                histogram_lines('ze_stage_seconds', labels, key, self.timer.buckets, stats))
+            histograms.add(key)
+
+        # Histograms of `ze.utils.stats.observe` out of the stages (e.g. flush_time)
+        for key in sorted(stats):
+            if key.endswith('/le_inf') and not key.startswith('timing/'):
+                key = key[:-len('/le_inf')]
+                buckets = sorted(float(k[len(key) + 4:]) for k in stats
+                                 if k.startswith(key + '/le_') and k != key + '/le_inf')
+                name = 'ze_' + prometheus_name(key)
+                family(families, name, 'histogram').extend(
+                    histogram_lines(name, 'spider="%s"' % spider, key, buckets, stats))
+                histograms.add(key)
+
+        lines = family(families, 'ze_stat', 'gauge')
+        for key, value in sorted(stats.items()):
+            if isinstance(value, (int, float)) and not isinstance(value, bool) \
+                    and key.rsplit('/', 1)[0] not in histograms:
+                lines.append('ze_stat{spider="%s",name="%s"} %s' % (spider, prometheus_label(key), value))
+
+
+def family(families, name, type):
+    return families.setdefault(name, (type, []))[1]
+
+
+def histogram_lines(name, labels, key, buckets, stats):
+    count = stats.get(key + '/le_inf', 0)
+    lines = ['%s_bucket{%s,le="%s"} %s' % (name, labels, format_bound(bound),
+                                           stats.get('%s/le_%s' % (key, format_bound(bound)), 0))
+             for bound in buckets]
+    lines.append('%s_bucket{%s,le="+Inf"} %s' % (name, labels, count))
+    lines.append('%s_sum{%s} %s' % (name, labels, stats.get(key + '/sum', 0)))
+    lines.append('%s_count{%s} %s' % (name, labels, count))
+    return lines
+
+
+def format_bound(bound):
+    # As in the stats keys of `observe`: 1 and not 1.0
+    return str(int(bound)) if bound == int(bound) else str(bound)
+
+
+def prometheus_name(key):
+    return re.sub(r'[^a-zA-Z0-9_]', '_', key)
+
+
+def prometheus_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class MetricsResource(resource.Resource):
+
+    isLeaf = True
+
+    def __init__(self, exporter):
+        resource.Resource.__init__(self)
+        self.exporter = exporter
+
+    def render_GET(self, request):
+        if request.path != b'/metrics':
+            request.setResponseCode(404)
+            return b''
+        request.setHeader('Content-Type', 'text/plain; version=0.0.4')
+        return self.exporter.render()
+
+
+class PrometheusExporter(object):
+    """HTTP server of the metrics of the running `StageTiming`, one by process."""
+
+    def __init__(self):
+        self.timings = []
+        self.listening = None
+
+    def add(self, timing, port, host):
+        self.timings.append(timing)
+        if self.listening is None:
+            try:
+                self.listening = reactor.listenTCP(port, server.Site(MetricsResource(self)),
+                                                   interface=host)
+                logger.info('Metrics served at http://%s:%d/metrics' % (host, port))
+            except CannotListenError as e:
+                logger.warning('Metrics not served: %s' % e)
+
+    def remove(self, timing):
+        self.timings.remove(timing)
+        if not self.timings and self.listening is not None:
+            self.listening.stopListening()
+            self.listening = None
+
+    def render(self):
+        families = {}
+        for timing in self.timings:
+            timing.metrics(families)
+        lines = []
+        for name, (type, family_lines) in sorted(families.items()):
+            lines.append('# TYPE %s %s' % (name, type))
+            lines.extend(family_lines)
+        return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+exporter = PrometheusExporter()
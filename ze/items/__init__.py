@@ -4,22 +4,130 @@ from scrapy.loader.processors import TakeFirst, MapCompose
 from ze.processors.article import ArticleProcessor
 from ze.processors.common import CommonProcessor
 from ze.processors.html import CleanHTML
+import ze.utils
+from ze.items.plan import item_processors
+from ze.utils.stats import StageRecorder, StatsRecorder
 
 class ItemLoader(ScrapyItemLoader):
+
+    # Context values sent with a PendingItem, the others belong to the response
+    pending_context = ('allowed_domains', 'media')
+
+    def __init__(self, *args, **kwargs):
+        super(ItemLoader, self).__init__(*args, **kwargs)
+        # Values of the fallback selectors by field, with deferred processing
+        self.fallbacks = {}
     
     def get_collected_values(self, field_name):
         return (self._values[field_name]
                 if field_name in self._values
                 else self._values.default_factory())
 
+    def add_css(self, field_name, css, *processors, **kw):
+        # Fields holding HTML get the lxml elements of the response when the
+        # lxml backend is enabled, so CleanHTML does not parse them again
+        if self.context.get('clean_html_backend') == 'lxml' \
+                and not self.context.get('deferred_processing') \
+                and self.item.fields[field_name].get('html'):
+            self._check_selector_method()
+            values = [s.root for s in self.selector.css(css)]
+            self.add_value(field_name, values, *processors, **kw)
+        else:
+            super(ItemLoader, self).add_css(field_name, css, *processors, **kw)
+
     def add_fallback_css(self, field_name, css, *processors, **kw):
         if not any(self.get_collected_values(field_name)):
             self.add_css(field_name, css, *processors, **kw)
 
+    def add_compiled_css(self, field_name, compiled):
+        """
+        `add_css` with a `ze.items.plan.CompiledCss`, translated only once.
+        Returns the values selected.
+        """
+        self._check_selector_method()
+        if self.context.get('clean_html_backend') == 'lxml' \
+                and not self.context.get('deferred_processing') \
+                and self.item.fields[field_name].get('html'):
+            values = compiled.select(self.selector.root)
+        else:
+            values = compiled.extract(self.selector.root)
+        self.add_value(field_name, values)
+        return values
+
+    def add_fallback_compiled_css(self, field_name, compiled):
+        # Deferred processing keeps the values of every fallback, chosen after
+        # the input processors by `load_pending_item` as they would be here
+        if self.context.get('deferred_processing'):
+            self._check_selector_method()
+            # An invalid selector is raised only if the fallback is reached
+            values = compiled.error or compiled.extract(self.selector.root)
+            self.fallbacks.setdefault(field_name, []).append(values)
+            return values if compiled.error is None else []
+        if not any(self.get_collected_values(field_name)):
+            return self.add_compiled_css(field_name, compiled)
+
     def add_fallback_xpath(self, field_name, css, *processors, **kw):
         if not any(self.get_collected_values(field_name)):
             self.add_xpath(field_name, css, *processors, **kw)
 
+    def _process_input_value(self, field_name, value):
+        # Deferred processing keeps the extracted values, the input processors
+        # run later in ze.pipelines.ProcessPoolPipeline
+        if self.context.get('deferred_processing'):
+            return value
+        processor = item_processors(type(self), type(self.item))[0].get(field_name)
+        if processor is None:
+            return super(ItemLoader, self)._process_input_value(field_name, value)
+        return processor(value, self.context)
+
+    def get_output_value(self, field_name):
+        processor = item_processors(type(self), type(self.item))[1].get(field_name)
+        if processor is None:
+            return super(ItemLoader, self).get_output_value(field_name)
+        try:
+            return processor(self._values[field_name], self.context)
+        except Exception as e:
+            raise ValueError("Error with output processor: field=%r value=%r error='%s: %s'" % \
+                (field_name, self._values[field_name], type(e).__name__, str(e)))
+
+    def load_pending_item(self):
+        item_class = type(self.item)
+        return PendingItem(
+            item_class='%s.%s' % (item_class.__module__, item_class.__name__),
+            values=dict(self._values),
+            fallbacks=self.fallbacks,
+            context=dict((k, self.context[k]) for k in self.pending_context
+                         if k in self.context))
+
+
+class PendingItem(dict):
+    """Raw values of an item whose processors have not run yet, see `load_pending_item`."""
+
+
+def load_pending_item(item_class, values, context, fallbacks=None, timed=False):
+    """
+    Run the processors of a `PendingItem`, picklable to run in another
+    process. The values of the fallback selectors of a field are added in
+    order while it has no value after the input processors, as when loaded
+    inline. Returns the values of the item, the changes of the processors to
+    the crawler stats (see `ze.utils.stats.StatsRecorder`) and, when `timed`,
+    the stages they timed (see `ze.utils.stats.StageRecorder`).
+    """
+    recorder = StageRecorder() if timed else None
+    stats = StatsRecorder()
+    il = ItemLoader(item=ze.utils.import_class(item_class)(), stage_timer=recorder,
+                    crawler_stats=stats, **context)
+    for field_name, value in values.items():
+        il.add_value(field_name, value)
+    for field_name, candidates in (fallbacks or {}).items():
+        for value in candidates:
+            if any(il.get_collected_values(field_name)):
+                break
+            if isinstance(value, Exception):
+                raise value
+            il.add_value(field_name, value)
+    return dict(il.load_item()), stats.changes, recorder.observations if timed else []
+
 
 class ThingItem(Item):
     
@@ -14,6 +14,7 @@ class ArticleItem(CreativeWorkItem):
             CleanHTML(),
         ),
         output_processor=TakeFirst(),
+        html=True,
     )
     articleSection = Field()
     pageEnd = Field()
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+import functools
+from collections import namedtuple
+from lxml import etree
+from parsel.csstranslator import HTMLTranslator
+from scrapy.loader.processors import MapCompose
+from scrapy.utils.datatypes import MergeDict
+from scrapy.utils.misc import arg_to_iter
+from scrapy.utils.python import get_func_args
+import ze.utils
+import logging
+logger = logging.getLogger(__name__)
+
+# Namespaces of the parsel selectors, for the same XPath functions
+NAMESPACES = {
+    're': 'http://exslt.org/regular-expressions',
+    'set': 'http://exslt.org/sets',
+}
+
+# Extraction plan of one entry of `ZeSpider.parses`: the item class, the name
+# of the spider method loading it, the compiled selectors of each field (in
+# fallback order) and the original arguments
+ItemPlan = namedtuple('ItemPlan', ('item_class', 'load_method', 'fields', 'args'))
+
+
+class CompiledCss(object):
+    """CSS selector (with the `::text` and `::attr()` extensions) compiled to an XPath."""
+
+    translator = HTMLTranslator()
+
+    def __init__(self, css):
+        self.css = css
+        self.error = None
+        try:
+            self.xpath = etree.XPath(self.translator.css_to_xpath(css),
+                                     namespaces=NAMESPACES, smart_strings=False)
+        except Exception as e:
+            # Raised when used, as `Selector.css` does
+            logger.warning('Invalid selector %r: %s' % (css, e))
+            self.error = e
+
+    def select(self, root):
+        """Elements or strings selected in the lxml `root`."""
+        if self.error is not None:
+            raise self.error
+        result = self.xpath(root)
+        return result if isinstance(result, list) else [result]
+
+    def extract(self, root):
+        """Same values as `Selector.css(css).extract()`."""
+        return [serialize(value) for value in self.select(root)]
+
+
+def serialize(value):
+    try:
+        return etree.tostring(value, method='html', encoding='unicode', with_tail=False)
+    except (AttributeError, TypeError):
+        if value is True:
+            return u'1'
+        elif value is False:
+            return u'0'
+        return str(value)
+
+
+@functools.lru_cache(maxsize=None)
+def compile_css(css):
+    return CompiledCss(css)
+
+
+def compile_parses(parses):
+    """Compile the `parses` of a spider, see `ItemPlan`."""
+    plans = []
+    for p in parses:
+        for item_class, args in p.items():
+            plans.append(compile_item(ze.utils.import_class(item_class), args))
+    return tuple(plans)
+
+
+def compile_item(item_class, args):
+    return ItemPlan(
+        item_class=item_class,
+        load_method=args.get('load_method'),
+        fields=tuple((field, tuple(compile_css(css) for css in selectors))
+                     for field, selectors in args['fields'].items()),
+        args=args)
+
+
+def bind_processor(processor):
+    """
+    `processor` as a function of `(value, loader_context)`, with the functions
+    taking `loader_context` found once instead of on every call. Same result
+    as `wrap_loader_context(processor, context)(value)`.
+    """
+    if type(processor) is MapCompose:
+        functions = tuple((f, 'loader_context' in get_func_args(f)) for f in processor.functions)
+        default_context = processor.default_loader_context
+
+        def map_compose(value, loader_context):
+            context = MergeDict(loader_context, default_context) if loader_context else default_context
+            values = arg_to_iter(value)
+            for function, takes_context in functions:
+                next_values = []
+                for v in values:
+                    next_values += arg_to_iter(
+                        function(v, loader_context=context) if takes_context else function(v))
+                values = next_values
+            return values
+        return map_compose
+
+    if 'loader_context' in get_func_args(processor):
+        return lambda value, loader_context: processor(value, loader_context=loader_context)
+    return lambda value, loader_context: processor(value)
+
+
+@functools.lru_cache(maxsize=None)
+def item_processors(loader_class, item_class):
+    """Input and output processors of every field of `item_class`, bound."""
+    loader = loader_class(item=item_class())
+    return (dict((field, bind_processor(loader.get_input_processor(field)))
+                 for field in item_class.fields),
+            dict((field, bind_processor(loader.get_output_processor(field)))
+                 for field in item_class.fields))
@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import logging
+logger = logging.getLogger(__name__)
+from twisted.internet import reactor, threads
+from twisted.python.threadpool import ThreadPool
+from scrapy import signals
+from scrapy.exceptions import NotConfigured, IgnoreRequest
+from scrapy.utils.project import data_path
+import ze.utils
+import ze.utils.file
+from ze.utils.fingerprints import FingerprintStore, article_unchanged
+from ze.utils.proxies import ProxyPool
+from ze.utils.warc import WarcWriter
+
+
+class FingerprintMiddleware(object):
+    """
+    Downloader middleware ignoring the requests of articles already scraped,
+    by any spider and run, unless scraped more than FINGERPRINTS_REFRESH_AGE
+    seconds ago. Requests with `dont_filter` (feeds, media) are not checked.
+
+    Articles fetched again are requested with the validators of the last
+    response (If-None-Match, If-Modified-Since) when FINGERPRINTS_CONDITIONAL
+    is set, a 304 response is ignored. The spider skips the articles whose
+    raw body has the hash stored (see `ZeSpider.load_item`), so unchanged
+    articles are not cleaned and written again. Both refresh the last seen
+    time of the article, which is not fetched again before
+    FINGERPRINTS_REFRESH_AGE.
+
+    Every scraped item is recorded in the store with the hash of its raw body
+    and the validators of its response.
+    """
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not settings.getbool('FINGERPRINTS_ENABLED'):
+            raise NotConfigured
+        store = FingerprintStore(
+            settings.get('FINGERPRINTS_PATH') or data_path('fingerprints.db'),
+            bloom_capacity=settings.getint('FINGERPRINTS_BLOOM_CAPACITY'),
+            bloom_error_rate=settings.getfloat('FINGERPRINTS_BLOOM_ERROR_RATE', 0.01))
+        middleware = cls(store, crawler.stats, settings.getint('FINGERPRINTS_REFRESH_AGE'),
+                         settings.getbool('FINGERPRINTS_CONDITIONAL'))
+        crawler.signals.connect(middleware.item_scraped, signal=signals.item_scraped)
+        crawler.signals.connect(middleware.article_unchanged, signal=article_unchanged)
+        crawler.signals.connect(middleware.spider_closed, signal=signals.spider_closed)
+        return middleware
+
+    def __init__(self, store, stats, refresh_age=0, conditional=True):
+        self.store = store
+        self.stats = stats
+        self.refresh_age = refresh_age
+        self.conditional = conditional
+
+    def process_request(self, request, spider):
+        if request.dont_filter:
+            return None
+
+        key = ze.utils.url_key(request.url)
+        known = self.store.get(key)
+        if known is None:
+            return None
+        if self.refresh_age and time.time() - known['last_seen'] > self.refresh_age:
+            self.stats.inc_value('fingerprints/refresh_count')
+            request.meta['fingerprint'] = dict(known, key=key)
+            if self.conditional:
+                if known['etag']:
+                    request.headers.setdefault('If-None-Match', known['etag'])
+                if known['last_modified']:
+                    request.headers.setdefault('If-Modified-Since', known['last_modified'])
+                request.meta['handle_httpstatus_list'] = \
+                    list(request.meta.get('handle_httpstatus_list', [])) + [304]
+            return None
+
+        self.stats.inc_value('fingerprints/known_count')
+        raise IgnoreRequest('Article already scraped: %s' % request.url)
+
+    def process_response(self, request, response, spider):
+        if response.status == 304 and 'fingerprint' in request.meta:
+            self.stats.inc_value('fingerprints/not_modified_count')
+            self.store.touch(request.meta['fingerprint']['key'])
+            raise IgnoreRequest('Article not modified: %s' % request.url)
+        return response
+
+    def item_scraped(self, item, response, spider):
+        if not item.get('url'):
+            return
+        # Items loaded in the callback of a sub-request (Estadão media) belong
+        # to the response of their article
+        article = response.meta.get('article', response)
+        self.store.set(article_key(article),
+                       article.meta.get('raw_hash'),
+                       item.get('dateModified'),
+                       etag=header(article, 'ETag'),
+                       last_modified=header(article, 'Last-Modified'))
+        self.stats.inc_value('fingerprints/stored_count')
+
+    def article_unchanged(self, response, spider):
+        self.store.touch(response.meta['fingerprint']['key'])
+
+    def spider_closed(self, spider):
+        self.store.close()
+
+
+
+class ProxyMiddleware(object):
+    """
+    Send the requests through the proxies of PROXY_LIST (one URL by line),
+    loaded on the first request and picked by score, see `ProxyPool`.
+    Responses with a PROXY_BAN_CODES status and download errors put the proxy
+    on backoff and the request is retried with another proxy, at most
+    PROXY_MAX_RETRIES times. The scores are saved in PROXY_SCORES_PATH (default
+    .scrapy/proxies.json) when the spider closes, for the next run.
+
+    Requests with a `proxy` in meta set by the spider are not changed.
+    """
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('PROXY_ENABLED'):
+            raise NotConfigured
+        middleware = cls(crawler.settings, crawler.stats)
+        crawler.signals.connect(middleware.spider_closed, signal=signals.spider_closed)
+        return middleware
+
+    def __init__(self, settings, stats):
+        self.list_path = settings.get('PROXY_LIST')
+        self.scores_path = settings.get('PROXY_SCORES_PATH')
+        self.alpha = settings.getfloat('PROXY_EWMA_ALPHA', 0.3)
+        self.backoff = settings.getfloat('PROXY_BACKOFF', 60)
+        self.max_backoff = settings.getfloat('PROXY_MAX_BACKOFF', 3600)
+        self.max_retries = settings.getint('PROXY_MAX_RETRIES', 5)
+        self.ban_codes = set(int(code) for code in settings.getlist('PROXY_BAN_CODES'))
+        self.stats = stats
+        self.pool = None
+
+    def get_pool(self):
+        if self.pool is None:
+            self.scores_path = self.scores_path or data_path('proxies.json')
+            scores = {}
+            if os.path.exists(self.scores_path):
+                try:
+                    with open(self.scores_path) as f:
+                        scores = json.load(f)
+                except ValueError as e:
+                    logger.warning('Proxies scores %s not loaded: %s' % (self.scores_path, e))
+            self.pool = ProxyPool(ze.utils.file.load_lines(self.list_path), scores,
+                                  self.alpha, self.backoff, self.max_backoff)
+            logger.info('%d proxies loaded from %s' % (len(self.pool.proxies), self.list_path))
+        return self.pool
+
+    def process_request(self, request, spider):
+        if 'proxy' in request.meta and 'rotating_proxy' not in request.meta:
+            return None
+
+        proxy = self.get_pool().pick()
+        if proxy is None:
+            # Every proxy is on backoff, the request goes directly
+            self.stats.inc_value('proxies/exhausted_count')
+            request.meta.pop('proxy', None)
+            request.meta.pop('rotating_proxy', None)
+            return None
+        request.meta['proxy'] = request.meta['rotating_proxy'] = proxy
+        self.stats.inc_value('proxies/requests_count')
+
+    def process_response(self, request, response, spider):
+        proxy = request.meta.get('rotating_proxy')
+        if not proxy:
+            return response
+        if response.status in self.ban_codes:
+            return self.retry(request, proxy, 'banned') or response
+        self.pool.success(proxy, request.meta.get('download_latency', 0))
+        return response
+
+    def process_exception(self, request, exception, spider):
+        proxy = request.meta.get('rotating_proxy')
+        if proxy:
+            return self.retry(request, proxy, 'failed')
+
+    def retry(self, request, proxy, reason):
+        backoff = self.pool.failure(proxy)
+        self.stats.inc_value('proxies/%s_count' % reason)
+        logger.debug('Proxy %s %s, backoff of %ds' % (proxy, reason, backoff))
+
+        retries = request.meta.get('proxy_retries', 0)
+        if retries >= self.max_retries:
+            return None
+        self.stats.inc_value('proxies/retry_count')
+        retry = request.copy()
+        retry.meta['proxy_retries'] = retries + 1
+        retry.meta.pop('proxy', None)
+        retry.meta.pop('rotating_proxy', None)
+        retry.dont_filter = True
+        return retry
+
+    def spider_closed(self, spider):
+        if self.pool is None:
+            return
+        self.stats.set_value('proxies/alive', len(self.pool.alive()))
+        with open(self.scores_path, 'w') as f:
+            json.dump(self.pool.dump(), f)
+
+
+class ArchiveMiddleware(object):
+    """
+    Write the responses of the articles, and of their sub-requests (e.g.
+    Estadão media), to a `WarcWriter` in ARCHIVE_DIR/<spider> (default
+    .scrapy/archive/<spider>), so they can be extracted again without network
+    by `scrapy reparse`. The name of the callback of each request is kept in
+    the `Ze-Callback` field of its record. Feeds (`parse_feed`) and responses
+    other than 200 are not archived.
+
+    The records are compressed and written by a thread of their own, in
+    order, not to block the reactor; the spider closes once they are all
+    written.
+
+    Must run after HttpCompressionMiddleware (lower order) to archive the
+    decoded bodies.
+    """
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not settings.getbool('ARCHIVE_ENABLED'):
+            raise NotConfigured
+        middleware = cls(settings, crawler.stats)
+        crawler.signals.connect(middleware.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(middleware.spider_closed, signal=signals.spider_closed)
+        return middleware
+
+    def __init__(self, settings, stats):
+        self.dir = settings.get('ARCHIVE_DIR')
+        self.segment_records = settings.getint('ARCHIVE_SEGMENT_RECORDS', 1000)
+        self.segment_bytes = settings.getint('ARCHIVE_SEGMENT_MB', 100) * 1024 * 1024
+        self.compress_level = settings.getint('ARCHIVE_COMPRESS_LEVEL', 6)
+        self.stats = stats
+        self.writer = None
+        # One thread: the writer is not thread safe, and keeps the records in order
+        self.threadpool = ThreadPool(1, 1, 'ArchiveMiddleware')
+
+    def spider_opened(self, spider):
+        path = os.path.join(self.dir, spider.name) if self.dir else \
+            data_path(os.path.join('archive', spider.name), createdir=True)
+        self.writer = WarcWriter(path, self.segment_records, self.segment_bytes, self.compress_level)
+        self.threadpool.start()
+
+    def process_response(self, request, response, spider):
+        callback = getattr(request.callback, '__name__', 'parse')
+        if response.status != 200 or callback == 'parse_feed':
+            return response
+
+        headers = [(name, value) for name, values in response.headers.items() for value in values]
+        d = threads.deferToThreadPool(reactor, self.threadpool, self.writer.write, response.url,
+                                      response.status, headers, response.body,
+                                      [('Ze-Callback', callback)])
+        d.addCallbacks(self.written, lambda f: logger.error('Response %s not archived: %s' % (
+            response.url, f.value)))
+        return response
+
+    def written(self, size):
+        if size:
+            self.stats.inc_value('archive/written_count')
+            self.stats.inc_value('archive/written_bytes', size)
+        else:
+            self.stats.inc_value('archive/duplicate_count')
+
+    def spider_closed(self, spider):
+        d = threads.deferToThreadPool(reactor, self.threadpool, self.writer.close)
+        d.addErrback(lambda f: logger.error('Archive not closed: %s' % f.value))
+        d.addBoth(lambda _: self.threadpool.stop())
+        return d
+
+
+def article_key(response):
+    """Fingerprint key of the article of `response`, the URL it was requested with."""
+    return ze.utils.url_key(response.meta.get('redirect_urls', [response.url])[0])
+
+
+def header(response, name):
+    value = response.headers.get(name)
+    return value.decode('latin-1') if value else None
@@ -3,10 +3,20 @@
 import os
 import json
 import logging; logger = logging.getLogger(__name__)
-from google.cloud import pubsub
-from pymongo import MongoClient
+import time
+from concurrent.futures import ProcessPoolExecutor
+from twisted.internet import defer, task, threads
+from twisted.internet.defer import Deferred
 import scrapy
+from scrapy.exceptions import NotConfigured
 from scrapy.selector import Selector
+from scrapy.utils.project import data_path
+import ze.utils
+from ze.items import PendingItem, load_pending_item
+from ze.utils.spool import Spool
+from ze.utils.stats import observe, replay
+
+BATCH_SIZE_BUCKETS = (1, 10, 50, 100, 500, 1000)
 
 class BasePipeline(object):
 
@@ -17,53 +27,431 @@ class BasePipeline(object):
     def __init__(self, settings, stats): raise NotImplementError
 
 
-class MongoPipeline(BasePipeline):
+class ProcessPoolPipeline(BasePipeline):
+    """
+    Run the item loader processors (CleanHTML, dates, authors...) of the items
+    loaded with PROCESS_POOL_ENABLED in a pool of processes, so they use every
+    core and do not hold the reactor thread. Must run before other pipelines.
+
+    The stats of the processors in the workers (e.g. the date tiers) are added
+    to the crawler stats. With TIMING_ENABLED, the stages they timed are added
+    to the timer of the spider, and the time of each item in the pool, queue
+    included, to the `process_pool` stage.
+    """
 
     def __init__(self, settings, stats):
-        self.mongo_uri = settings.get('MONGO_URI'),
-        self.mongo_db = settings.get('MONGO_DATABASE', 'ze-the-scraper')
-        self.client = None
-        
+        if not settings.getbool('PROCESS_POOL_ENABLED'):
+            raise NotConfigured
+        self.pool_size = settings.getint('PROCESS_POOL_SIZE') or os.cpu_count()
+        self.executor = None
+        self.queue_depth = 0
+
+        self.stats = stats
+        self.stats.set_value('process_pool/size', self.pool_size)
+        self.stats.set_value('process_pool/queue_depth', 0)
+        self.stats.set_value('process_pool/max_queue_depth', 0)
+
+
+    def open_spider(self, spider):
+        self.executor = ProcessPoolExecutor(self.pool_size)
+
+
+    def close_spider(self, spider):
+        self.executor.shutdown(wait=True)
+
+    def process_item(self, item, spider):
+        if not isinstance(item, PendingItem):
+            return item
+
+        from twisted.internet import reactor
+        d = Deferred()
+        timer = getattr(spider, 'stage_timer', None)
+        started = time.time()
+        future = self.executor.submit(load_pending_item,
+            item['item_class'], item['values'], item['context'], item.get('fallbacks'),
+            timer is not None)
+        future.add_done_callback(
+            lambda f: reactor.callFromThread(self._processed, f, item, d, timer, started))
+
+        self.queue_depth += 1
+        self.stats.set_value('process_pool/queue_depth', self.queue_depth)
+        self.stats.max_value('process_pool/max_queue_depth', self.queue_depth)
+        return d
+
+    def _processed(self, future, item, d, timer, started):
+        self.queue_depth -= 1
+        self.stats.set_value('process_pool/queue_depth', self.queue_depth)
+        try:
+            values, changes, stages = future.result()
+        except Exception as e:
+            self.stats.inc_value('process_pool/erros_count')
+            d.errback(e)
+        else:
+            self.stats.inc_value('process_pool/items_count')
+            replay(self.stats, changes)
+            if timer is not None:
+                # Stages timed by the processors in the worker
+                for stage, seconds in stages:
+                    timer.observe(stage, seconds, values.get('url'))
+                timer.since('process_pool', started, values.get('url'))
+            d.callback(ze.utils.import_class(item['item_class'])(values))
+
+
+class BatchPipeline(BasePipeline):
+    """
+    Buffer items and write them in batches from a worker thread, when
+    `batch_size` items (or `batch_bytes`) are buffered or every `flush_interval`
+    seconds, with at most `max_in_flight` batches being written at once.
+    When `buffer_size` items are waiting to be written, new items are held
+    until a flush makes room.
+
+    With SPOOL_ENABLED, items are appended to a `Spool` on disk instead and
+    returned at once. Every `flush_interval` seconds the sealed segments are
+    written in batches from a worker thread and removed; when the sink fails
+    they are retried with exponential backoff (up to SPOOL_MAX_BACKOFF seconds)
+    and segments left by a previous run are replayed. Items are delivered at
+    least once.
+
+    Subclasses implement `write(batch)`, called in a worker thread, which
+    returns the number of items written and the list of error codes of the
+    items rejected, and raises when the sink is not available. Those whose
+    sink may not be configured at all override `configured()`: nothing is
+    buffered nor drained then, the spool is kept for the next run.
+    """
+
+    stats_prefix = None
+    written_stat = 'written_count'
+    errors_stat = 'erros_count'
+
+    def __init__(self, settings, stats, batch_size=100, flush_interval=5,
+                 buffer_size=1000, batch_bytes=None, max_in_flight=4):
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.flush_interval = flush_interval
+        self.buffer_size = buffer_size
+        self.max_in_flight = max_in_flight
+        self.buffer = []
+        self.buffer_sizes = []
+        self.buffer_bytes = 0
+        # Items buffered or being written
+        self.pending = 0
+        self.flushes = []
+        self.waiting = []
+        self.flush_loop = task.LoopingCall(self.flush)
+
+        self.spool_enabled = settings.getbool('SPOOL_ENABLED')
+        self.spool_dir = settings.get('SPOOL_DIR')
+        self.spool_segment_records = settings.getint('SPOOL_SEGMENT_RECORDS', 1000)
+        self.spool_fsync_records = settings.getint('SPOOL_FSYNC_RECORDS', 100)
+        self.spool_max_backoff = settings.getfloat('SPOOL_MAX_BACKOFF', 300)
+        self.spool = None
+        self.draining = None
+        self.retries = 0
+        self.retry_at = 0
+
         self.stats = stats
-        self.stats.set_value('items/mongodb/insert_count', 0)
-        self.stats.set_value('items/mongodb/insert_erros_count', 0)
+        self.stats.set_value(self.stats_prefix + self.written_stat, 0)
+        self.stats.set_value(self.stats_prefix + self.errors_stat, 0)
 
 
     def open_spider(self, spider):
-        self.client = MongoClient(self.mongo_uri)
+        if not self.configured():
+            logger.warning('%s not configured, items are not written%s' % (
+                type(self).__name__, ' and the spool is not drained' if self.spool_enabled else ''))
+            return
+        if self.spool_enabled:
+            self.spool = Spool(
+                os.path.join(self.spool_dir or data_path('spool', createdir=True),
+                             spider.name, type(self).__name__),
+                segment_records=self.spool_segment_records,
+                fsync_records=self.spool_fsync_records)
+            replayed = len(self.spool.sealed())
+            if replayed:
+                logger.info('Replaying %d spool segments of %s' % (replayed, type(self).__name__))
+                self.stats.set_value(self.stats_prefix + 'spool/replayed_segments', replayed)
+            self.flush_loop = task.LoopingCall(self.drain)
+        self.flush_loop.start(self.flush_interval, now=False)
+
+    def configured(self):
+        return True
+
+
+    def close_spider(self, spider):
+        if self.flush_loop.running:
+            self.flush_loop.stop()
+        if self.spool is not None:
+            return self.close_spool()
+        # Ignore max_in_flight, everything left is written now
+        while self.buffer:
+            self.flush(force=True)
+        return defer.DeferredList(list(self.flushes))
+
+    def buffer_item(self, item, value, size=0):
+        if self.spool is not None:
+            self.spool.write(self.encode(value))
+            self.stats.inc_value(self.stats_prefix + 'spool/written_count')
+            return item
+
+        self.buffer.append(value)
+        self.buffer_sizes.append(size)
+        self.buffer_bytes += size
+        self.pending += 1
+
+        if len(self.buffer) >= self.batch_size or \
+                (self.batch_bytes and self.buffer_bytes >= self.batch_bytes):
+            self.flush()
+
+        if self.pending > self.buffer_size:
+            d = defer.Deferred()
+            self.waiting.append((d, item))
+            return d
+        return item
+
+    def flush(self, force=False):
+        if not self.buffer or (len(self.flushes) >= self.max_in_flight and not force):
+            return defer.succeed(None)
+
+        batch, self.buffer = self.buffer[:self.batch_size], self.buffer[self.batch_size:]
+        self.buffer_sizes = self.buffer_sizes[self.batch_size:]
+        self.buffer_bytes = sum(self.buffer_sizes)
+        d = threads.deferToThread(self.write, batch)
+        d.addCallbacks(self.flushed, self.flush_failed,
+                       callbackArgs=(len(batch), time.time()), errbackArgs=(len(batch),))
+        self.flushes.append(d)
+        d.addBoth(lambda _: self.flushes.remove(d))
+        return d
+
+    def write(self, batch):
+        raise NotImplementedError
+
+    def encode(self, value):
+        return json.dumps(value).encode('utf-8')
+
+    def decode(self, record):
+        return json.loads(record.decode('utf-8'))
+
+    def flushed(self, result, size, started):
+        self.record_batch(result, size, started)
+        self.release(size)
+
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def flush_failed(self, failure, size):
+        logger.error('Failed to flush items of %s: %s' % (type(self).__name__, failure.value))
+        code = getattr(failure.value, 'code', None) or type(failure.value).__name__
+        self.stats.inc_value(self.stats_prefix + self.errors_stat, size)
+        self.stats.inc_value('%serros/%s' % (self.stats_prefix, code), size)
+        self.release(size)
+
+    def record_batch(self, result, size, started):
+        written, errors = result
+
+        self.stats.inc_value(self.stats_prefix + self.written_stat, written)
+        self.stats.inc_value(self.stats_prefix + self.errors_stat, len(errors))
+        for code in errors:
+            self.stats.inc_value('%serros/%s' % (self.stats_prefix, code))
+        self.stats.inc_value(self.stats_prefix + 'batch_count')
+        observe(self.stats, self.stats_prefix + 'batch_size', size, BATCH_SIZE_BUCKETS)
+        observe(self.stats, self.stats_prefix + 'flush_time', time.time() - started)
+
+    def release(self, size):
+        self.pending -= size
+        while self.waiting and self.pending <= self.buffer_size:
+            d, item = self.waiting.pop(0)
+            d.callback(item)
+
+    def drain(self, force=False):
+        """
+        Write the sealed spool segments, oldest first, from a worker thread.
+        Does nothing while a drain is running or a retry is not due.
+        """
+        if self.draining is not None or (time.time() < self.retry_at and not force):
+            return None
+        # Seal on every drain, items do not wait for a full segment
+        self.spool.seal()
+        segments = self.spool.sealed()
+        self.stats.set_value(self.stats_prefix + 'spool/segments', len(segments))
+        if not segments:
+            return None
+
+        self.draining = threads.deferToThread(self.drain_segments, segments)
+        self.draining.addCallbacks(self.drained, self.drain_failed)
+        return self.draining
+
+    def drain_segments(self, segments):
+        from twisted.internet import reactor
+        for segment in segments:
+            records = [self.decode(record) for record in self.spool.read(segment)]
+            for i in range(0, len(records), self.batch_size):
+                batch = records[i:i + self.batch_size]
+                started = time.time()
+                result = self.write(batch)
+                reactor.callFromThread(self.record_batch, result, len(batch), started)
+            # A failure before this point writes the segment again
+            self.spool.remove(segment)
+            reactor.callFromThread(self.stats.inc_value,
+                                   self.stats_prefix + 'spool/drained_segments')
+
+    def drained(self, _):
+        self.draining = None
+        self.retries = 0
+        self.retry_at = 0
+        self.stats.set_value(self.stats_prefix + 'spool/segments', len(self.spool.sealed()))
+
+    def drain_failed(self, failure):
+        self.draining = None
+        self.retries += 1
+        backoff = min(self.flush_interval * 2 ** self.retries, self.spool_max_backoff)
+        self.retry_at = time.time() + backoff
+        self.stats.inc_value(self.stats_prefix + 'spool/retry_count')
+        logger.warning('Failed to drain spool of %s, retry in %ds: %s'
+                       % (type(self).__name__, backoff, failure.value))
+
+    def close_spool(self):
+        """Drain what is left, segments that fail are replayed on the next run."""
+        d = self.draining or defer.succeed(None)
+        d.addCallback(lambda _: self.drain(force=True))
+        d.addBoth(lambda _: self.spool.close())
+        return d
+
+
+class MongoPipeline(BatchPipeline):
+    """
+    Insert items with `insert_many` in batches, see `BatchPipeline` and the
+    MONGO_BATCH_SIZE, MONGO_FLUSH_INTERVAL and MONGO_BUFFER_SIZE settings.
+
+    With MONGO_UPSERT, documents are unique by `url_key` (see `ze.utils.url_key`)
+    and only replaced when their `dateModified` is newer. The documents stored
+    are queried by batch, so known articles are skipped without a write; a
+    document stored meanwhile by another crawl makes the replace fail with a
+    duplicate key, also counted as skipped (stale).
+    """
+
+    # pymongo is imported when the spider opens, not when the pipeline is loaded
+    client_class = 'pymongo.MongoClient'
+    stats_prefix = 'items/mongodb/'
+    written_stat = 'insert_count'
+    errors_stat = 'insert_erros_count'
+
+    def __init__(self, settings, stats):
+        super(MongoPipeline, self).__init__(settings, stats,
+            batch_size=settings.getint('MONGO_BATCH_SIZE', 100),
+            flush_interval=settings.getfloat('MONGO_FLUSH_INTERVAL', 5),
+            buffer_size=settings.getint('MONGO_BUFFER_SIZE', 1000))
+        self.mongo_uri = settings.get('MONGO_URI')
+        self.mongo_db = settings.get('MONGO_DATABASE') or 'ze-the-scraper'
+        self.upsert = settings.getbool('MONGO_UPSERT')
+        self.client = None
+
+
+    def open_spider(self, spider):
+        self.client = load_class(self.client_class)(self.mongo_uri)
         self.db = self.client[self.mongo_db]
         self.stats.set_value('items/mongodb/database_name', self.db.name)
+        super(MongoPipeline, self).open_spider(spider)
+
+        if self.upsert:
+            return threads.deferToThread(self.db['NewsArticle'].create_index, 'url_key', unique=True)
 
 
     def close_spider(self, spider):
-        self.client.close()
+        d = super(MongoPipeline, self).close_spider(spider)
+        d.addBoth(lambda _: self.client.close())
+        return d
 
     def process_item(self, item, spider):
+        doc = dict(item)
+        if self.upsert:
+            doc['url_key'] = ze.utils.url_key(doc['url'])
+        return self.buffer_item(item, doc)
+
+    def write(self, batch):
+        from pymongo.errors import BulkWriteError
         # TODO: Get collection name via item name
+        # Unavailable server errors are raised, so the batch is retried
         try:
-            self.db['NewsArticle'].insert(dict(item))
-            self.stats.inc_value('items/mongodb/insert_count')
-        except Exception as e:
-            self.stats.inc_value('items/mongodb/insert_erros_count')
-            pass
-        
-        return item
+            if self.upsert:
+                batch = self.newer(batch)
+                if not batch:
+                    return 0, []
+                result = self.db['NewsArticle'].bulk_write(
+                    [self.upsert_request(doc) for doc in batch], ordered=False)
+                return result.upserted_count + result.modified_count, []
+            result = self.db['NewsArticle'].insert_many(batch, ordered=False)
+            return len(result.inserted_ids), []
+        except BulkWriteError as e:
+            details = e.details
+            codes = [err.get('code') for err in details.get('writeErrors', [])]
+            if self.upsert:
+                # The stored document is newer
+                self.skipped(codes.count(11000))
+                codes = [code for code in codes if code != 11000]
+            return (details.get('nInserted', 0) + details.get('nUpserted', 0) + details.get('nModified', 0),
+                    codes)
+
+    def newer(self, batch):
+        """Documents of `batch` newer than the stored ones, the last one by `url_key`."""
+        docs = dict((doc['url_key'], doc) for doc in batch)
+        stored = dict((doc['url_key'], doc.get('dateModified') or '') for doc in self.db['NewsArticle'].find(
+            {'url_key': {'$in': list(docs)}}, {'url_key': 1, 'dateModified': 1}))
+        newer = [doc for key, doc in docs.items()
+                 if key not in stored or (doc.get('dateModified') or '') > stored[key]]
+        self.skipped(len(batch) - len(newer))
+        return newer
+
+    def skipped(self, count):
+        # Called in the worker thread
+        from twisted.internet import reactor
+        if count:
+            reactor.callFromThread(self.stats.inc_value, 'items/mongodb/skipped_count', count)
+
+    def upsert_request(self, doc):
+        from pymongo import ReplaceOne, UpdateOne
+        if not doc.get('dateModified'):
+            return UpdateOne({'url_key': doc['url_key']}, {'$setOnInsert': doc}, upsert=True)
+        # A newer stored document makes the upsert fail with a duplicate key (11000)
+        return ReplaceOne({
+            'url_key': doc['url_key'],
+            '$or': [
+                {'dateModified': {'$lt': doc['dateModified']}},
+                {'dateModified': {'$in': [None, '']}},
+            ]
+        }, doc, upsert=True)
 
 
-class GooglePubSubPipeline(BasePipeline):
+class GooglePubSubPipeline(BatchPipeline):
+    """
+    Publish items to the `<PROJECT_NAME>.<spider>.newsarticle` topic, resolved
+    (and created) once when the spider opens. Messages are published in
+    batches, by count, size or latency (PUBSUB_BATCH_SIZE, PUBSUB_BATCH_BYTES,
+    PUBSUB_BATCH_LATENCY), with at most PUBSUB_MAX_IN_FLIGHT batches at once.
+
+    Set PUBSUB_EMULATOR_HOST to use the local emulator, `client_class` (a class or
+    its path) can be replaced by an in-process fake.
+    """
+
+    # Imported only with GOOGLE_CLOUD_ENABLED
+    client_class = 'google.cloud.pubsub.Client'
+    stats_prefix = 'google/pubsub/'
+    written_stat = 'published_count'
+    errors_stat = 'erros_count'
 
     def __init__(self, settings, stats):
+        super(GooglePubSubPipeline, self).__init__(settings, stats,
+            batch_size=settings.getint('PUBSUB_BATCH_SIZE', 100),
+            batch_bytes=settings.getint('PUBSUB_BATCH_BYTES', 1024 * 1024),
+            flush_interval=settings.getfloat('PUBSUB_BATCH_LATENCY', 1),
+            buffer_size=settings.getint('PUBSUB_BUFFER_SIZE', 1000),
+            max_in_flight=settings.getint('PUBSUB_MAX_IN_FLIGHT', 4))
         self.google_cloud_enabled = settings.getbool('GOOGLE_CLOUD_ENABLED')
         self.settings = {
             'project_name': settings.get('PROJECT_NAME')
         }
-        self.topics = {}
-        self.stats = stats
-        self.stats.set_value('google/pubsub/published_count', 0)
-        self.stats.set_value('google/pubsub/erros_count', 0)
+        self.topic = None
 
         if self.google_cloud_enabled:
-            self.client = pubsub.Client()
+            self.client = load_class(self.client_class)()
             logger.info('Google Cloud Pub/Sub client initiated with success')
         else:
             logger.warning('Google Cloud is not enabled, check Google Cloud extension configuration')
@@ -73,33 +461,50 @@ class GooglePubSubPipeline(BasePipeline):
         if self.google_cloud_enabled:
             try:
                 # TODO: Use multiples topics {} and create topic for using spider and item nam
-                self.topic = self.client.topic('ze-the-scraper.'+spider.name+'.newsarticle')
+                self.topic = self.client.topic('%s.%s.%s' % (self.settings['project_name'], spider.name, 'newsarticle'))
                 if not self.topic.exists():
                     self.topic.create()
             except Exception as e:
+                self.topic = None
                 logger.warning('Failed to get or create topic in Google Cloud Pub/Sub: %s' % e)
+        self.started = time.time()
+        super(GooglePubSubPipeline, self).open_spider(spider)
 
 
+    def close_spider(self, spider):
+        d = super(GooglePubSubPipeline, self).close_spider(spider)
+        d.addBoth(self.report_throughput)
+        return d
+
+    def configured(self):
+        return self.topic is not None
+
+    def report_throughput(self, _):
+        elapsed = time.time() - self.started
+        if elapsed > 0:
+            self.stats.set_value('google/pubsub/throughput',
+                self.stats.get_value('google/pubsub/published_count', 0) / elapsed)
+
     def process_item(self, item, spider):
-        if self.google_cloud_enabled:
-            try:
-                topic_name = '%s.%s.%s' % (self.settings['project_name'], spider.name, 'newsarticle')
-                topic = None
-                
-                if topic_name in self.topics:
-                    topic = self.topics[topic_name] 
-                else:
-                    self.topics[topic_name] = self.client.topic(topic_name)
-                    
-                    if not self.topics[topic_name].exists():
-                        self.topics[topic_name].create()
-                    
-                    topic = self.topics[topic_name]
-                
-                topic.publish(json.dumps(dict(item)))
-                
-                self.stats.inc_value('google/pubsub/published_count')
-            except Exception as e:
-                logger.error('Failed publish item to Google Cloud Pub/Sub: %s' % e)
-                self.stats.inc_value('google/pubsub/erros_count')
+        if self.topic is not None:
+            message = json.dumps(dict(item)).encode('utf-8')
+            return self.buffer_item(item, message, len(message))
         return item
+
+    def write(self, batch):
+        with self.topic.batch() as topic_batch:
+            for message in batch:
+                topic_batch.publish(message)
+        return len(batch), []
+
+    # Messages are JSON already
+    def encode(self, value):
+        return value
+
+    def decode(self, record):
+        return record
+
+
+def load_class(cls):
+    """`cls`, imported when given by its path."""
+    return ze.utils.import_class(cls) if isinstance(cls, str) else cls
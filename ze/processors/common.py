@@ -1,37 +1,140 @@
 # -*- coding: utf-8 -*-
 
-import dateparser
+import re
+import datetime
+import functools
+import time
 import logging
 logger = logging.getLogger(__name__)
 
+ISO_DATE_TIME_RE = re.compile(
+    r'^(\d{4})-(\d{2})-(\d{2})'
+    r'(?:[T ](\d{2}):(\d{2})(?::(\d{2})(?:[.,](\d{1,6})\d*)?)?)?'
+    r'\s*(Z|[+-]\d{2}:?\d{2})?$')
+
+PT_DATE_TIME_RE = re.compile(
+    r'^(\d{1,2})(?:\s+de)?\s+([^\W\d_]+)\.?(?:\s+de)?\s+(\d{4})'
+    r'(?:\s*(?:às)?\s*(\d{1,2}):(\d{2}))?$', re.I)
+
+HOUR_RE = re.compile(r'(\d{1,2})\s*h\s*(\d{2})?\b')
+
+NUMERIC_DATE_TIME_RE = re.compile(
+    r'^(\d{1,2})/(\d{1,2})/(\d{4})(?:\s*(?:às)?\s*(\d{1,2}):(\d{2}))?$')
+
+PT_MONTHS = {
+    'janeiro': 1, 'jan': 1,
+    'fevereiro': 2, 'fev': 2,
+    'março': 3, 'marco': 3, 'mar': 3,
+    'abril': 4, 'abr': 4,
+    'maio': 5, 'mai': 5,
+    'junho': 6, 'jun': 6,
+    'julho': 7, 'jul': 7,
+    'agosto': 8, 'ago': 8,
+    'setembro': 9, 'set': 9,
+    'outubro': 10, 'out': 10,
+    'novembro': 11, 'nov': 11,
+    'dezembro': 12, 'dez': 12,
+}
+
 class CommonProcessor():
 
     @staticmethod
-    def process_date_time(value):
+    def process_date_time(value, loader_context=None):
+        timer = (loader_context or {}).get('stage_timer')
+        started = time.time()
+        value, tier = CommonProcessor.parse_date_time(value)
+        if timer is not None:
+            response = loader_context.get('response')
+            timer.since('date_time', started, response.url if response is not None else None)
+
+        stats = (loader_context or {}).get('crawler_stats')
+        if stats:
+            stats.inc_value('processors/date_time/%s_count' % tier)
+
+        return value
+
+    @staticmethod
+    @functools.lru_cache(maxsize=4096)
+    def parse_date_time(value):
+        """
+        ISO 8601 formatted `value` and the tier that parsed it: `iso`, `pt`
+        (fixed Portuguese patterns), `dateparser` or `failed`, when `value` is
+        returned cleaned but not parsed. Results are memoized.
+        """
+        date_time = CommonProcessor.parse_iso_date_time(value.strip())
+        if date_time:
+            return date_time.isoformat(), 'iso'
 
         value = value.replace('Atualizado:', '') \
                     .replace(' | ', ' ') \
-                    .replace('h', ':') \
-                    .replace('h ', ':') \
                     .replace(', ', '') \
                     .replace('  ', ' ') \
                     .strip()
+        # 10h30 and 10h, not the h of the months (junho, julho)
+        value = HOUR_RE.sub(lambda m: '%s:%s' % (m.group(1), m.group(2) or '00'), value)
         date_formats = (
             '%d %B %Y %H:%M',
             '%d de %B de %Y %Hh%M',
             '%d/%m/%Y %H:%M',
         )
-        
+
+        date_time = CommonProcessor.parse_pt_date_time(value)
+        if date_time:
+            return date_time.isoformat(), 'pt'
+
+        # Slow to import, only needed by the dates not matching the patterns
+        import dateparser
         try:
-            return dateparser.parse(value, 
-                        date_formats=['%d %B %Y %H:%M'], 
+            return dateparser.parse(value,
+                        date_formats=['%d %B %Y %H:%M'],
                         languages=['pt']) \
-                        .isoformat()
+                        .isoformat(), 'dateparser'
         except Exception as e:
             logger.warning('Date %s not processed with none of formats: %s' % (value, ', '.join(date_formats)))
             pass
 
-        return value
+        return value, 'failed'
+
+    @staticmethod
+    def parse_iso_date_time(value):
+        m = ISO_DATE_TIME_RE.match(value)
+        if not m:
+            return None
+
+        year, month, day, hour, minute, second, fraction, tz = m.groups()
+        tzinfo = None
+        if tz == 'Z':
+            tzinfo = datetime.timezone.utc
+        elif tz:
+            offset = datetime.timedelta(hours=int(tz[1:3]), minutes=int(tz[-2:]))
+            tzinfo = datetime.timezone(-offset if tz[0] == '-' else offset)
+
+        try:
+            return datetime.datetime(int(year), int(month), int(day),
+                int(hour or 0), int(minute or 0), int(second or 0),
+                int((fraction or '0').ljust(6, '0')), tzinfo)
+        except ValueError:
+            return None
+
+    @staticmethod
+    def parse_pt_date_time(value):
+        m = PT_DATE_TIME_RE.match(value)
+        if m:
+            day, month, year, hour, minute = m.groups()
+            month = PT_MONTHS.get(month.lower())
+            if not month:
+                return None
+        else:
+            m = NUMERIC_DATE_TIME_RE.match(value)
+            if not m:
+                return None
+            day, month, year, hour, minute = m.groups()
+
+        try:
+            return datetime.datetime(int(year), int(month), int(day),
+                int(hour or 0), int(minute or 0))
+        except ValueError:
+            return None
 
     # @staticmethod
     # def process_clean(value):
@@ -1,201 +1,620 @@
 # -*- coding: utf-8 -*-
 
+import copy
 import json
-import requests
+import time
 import logging
-from bs4 import BeautifulSoup, Comment
+import urllib.parse
+from collections import defaultdict
+from bs4 import BeautifulSoup, Comment, Tag
+from cssselect import HTMLTranslator
+from lxml import etree
+from ze.utils.css import compile_selector
 
 logger = logging.getLogger(__name__)
 
-class CleanHTML(object):
+# Selector of the rules applied to the HTML comments of the document
+COMMENTS = 'comment()'
 
-    estadao_media_url = 'http://mdw-mm.estadao.com.br/middlewareAgile/rest/conteudo?tipo_midia={tipo}&idAgile={id}&produto=estadao'
 
-    def __call__(self, value, context={}):
-        self.stats = context.get('crawler_stats')
-        html = BeautifulSoup(value, 'html.parser')
-
-        # cartacapital
-        for el in html.select('.image-inline'):
-            fg = html.new_tag('figure')
-            fg.append(html.new_tag('img', src=el.select('img')[0]['data-src']))
-            fc = html.new_tag('figcaption')
-            fc.string = el.select('.image-caption')[0].string
-            fg.append(fc)
-            
-            el.replace_with(fg)
-        
-        for i, el in enumerate(html.select('.tile-rights')):
-            fg = html.new_tag('figure')
-            img = html.select('.canvasImg img')[i]
-            fg.append(html.new_tag('img', src=img['data-src']))
-            fc = html.new_tag('figcaption')
-            fc.string = el.select('span')[0].string
-            fg.append(fc)
-            
-            el.replace_with(fg)
+class Rule(object):
+    """
+    A CSS selector bound to the name of the action applied to the elements it matches.
+
+    Actions are looked up by name in the backend actions (`SoupActions` or
+    `LxmlActions`) and called once per walk as
+    `action(doc, elements, matches, context)`, where `elements` yields the
+    matched elements still attached to the document and `matches` gives access
+    to the other rules' elements of the same walk. Rules without action only
+    collect elements for other rules.
+    """
+
+    def __init__(self, selector, action=None):
+        self.selector = selector
+        self.action = action
+
+
+class RuleSet(object):
+    """Rules resolved together against the document before any of them is applied."""
+
+    def __init__(self, rules, actions):
+        self.rules = rules
+        self.actions = dict((r.selector, getattr(actions, r.action))
+                            for r in rules if r.action)
+
+    def walk(self, doc):
+        raise NotImplementedError
+
+    def attached(self, doc, el):
+        raise NotImplementedError
+
+    def apply(self, doc, context):
+        matches = Matches(self, doc, self.walk(doc))
+        for rule in self.rules:
+            if rule.action:
+                self.actions[rule.selector](doc, matches[rule.selector], matches, context)
+
+
+class SoupRuleSet(RuleSet):
+    """
+    BeautifulSoup rule set, resolved with a single walk over the document.
+
+    Selectors are indexed by the id, class or name of their rightmost compound,
+    so every tag is only tested against the selectors that could match it.
+    """
+
+    def __init__(self, rules, actions):
+        super(SoupRuleSet, self).__init__(rules, actions)
+        self._by_id = defaultdict(list)
+        self._by_class = defaultdict(list)
+        self._by_name = defaultdict(list)
+        self._any = []
+        self._comments = []
+
+        for i, rule in enumerate(rules):
+            if rule.selector == COMMENTS:
+                self._comments.append(i)
+                continue
+            for s in compile_selector(rule.selector):
+                key = s.key()
+                if key is None:
+                    self._any.append((i, s))
+                elif key[0] == 'id':
+                    self._by_id[key[1]].append((i, s))
+                elif key[0] == 'class':
+                    self._by_class[key[1]].append((i, s))
+                else:
+                    self._by_name[key[1]].append((i, s))
+
+    def _candidates(self, tag):
+        candidates = self._by_name.get(tag.name, [])
+        attrs = tag.attrs
+        if self._by_id and 'id' in attrs:
+            candidates = candidates + self._by_id.get(attrs['id'], [])
+        if self._by_class and 'class' in attrs:
+            for c in attrs['class']:
+                candidates = candidates + self._by_class.get(c, [])
+        return candidates + self._any if self._any else candidates
+
+    def walk(self, doc):
+        buckets = [[] for _ in self.rules]
+
+        for node in doc.descendants:
+            if isinstance(node, Tag):
+                matched = set()
+                for i, s in self._candidates(node):
+                    if i not in matched and s.match(node):
+                        matched.add(i)
+                        buckets[i].append(node)
+            elif self._comments and isinstance(node, Comment):
+                for i in self._comments:
+                    buckets[i].append(node)
+
+        return buckets
+
+    def attached(self, doc, el):
+        parent = el
+        while parent is not None:
+            if parent is doc:
+                return True
+            # Decomposed elements have their attributes cleared
+            parent = getattr(parent, 'parent', None)
+        return False
+
+
+class LxmlRuleSet(RuleSet):
+    """lxml rule set, every selector is translated once to a compiled XPath."""
+
+    translator = HTMLTranslator()
+
+    def __init__(self, rules, actions):
+        super(LxmlRuleSet, self).__init__(rules, actions)
+        # `*` is only used to strip attributes, done by `etree.strip_attributes`
+        # without creating a Python proxy for every element
+        self.xpaths = [None if r.selector == '*' else
+                       etree.XPath('descendant::comment()') if r.selector == COMMENTS else
+                       lxml_xpath(r.selector)
+                       for r in rules]
+
+    def walk(self, doc):
+        return [xpath(doc) if xpath is not None else [] for xpath in self.xpaths]
+
+    def attached(self, doc, el):
+        parent = el
+        while parent is not None:
+            if parent is doc:
+                return True
+            parent = parent.getparent()
+        return False
+
+
+def estadao_media_key(data_config):
+    """Key of the media of an Estadão `data-config` attribute: `tipo:id`."""
+    return '{tipo}:{id}'.format(**json.loads(data_config))
+
+
+_lxml_xpaths = {}
+
+def lxml_xpath(css):
+    """Compiled XPath of a CSS selector over the descendants of an lxml element."""
+    if css not in _lxml_xpaths:
+        _lxml_xpaths[css] = etree.XPath(
+            LxmlRuleSet.translator.css_to_xpath(css, prefix='descendant::'))
+    return _lxml_xpaths[css]
+
+
+class Matches(object):
+    """Elements found by a rule set walk, looked up by rule selector."""
+
+    def __init__(self, rule_set, doc, buckets):
+        self.rule_set = rule_set
+        self.doc = doc
+        self._buckets = dict((r.selector, b) for r, b in zip(rule_set.rules, buckets))
+
+    def __getitem__(self, selector):
+        # Filtered lazily, so elements removed by a previous action are skipped
+        return (el for el in self._buckets[selector]
+                if self.rule_set.attached(self.doc, el))
+
+
+class SoupActions(object):
+    """Rule actions over a `BeautifulSoup` document."""
+
+    def __init__(self, cleaner):
+        self.cleaner = cleaner
+
+    def figure(self, html, src, caption):
+        fg = html.new_tag('figure')
+        fg.append(html.new_tag('img', src=src))
+        fc = html.new_tag('figcaption')
+        fc.string = caption
+        fg.append(fc)
+        return fg
+
+    # cartacapital
+    def cartacapital_image_inline(self, html, elements, matches, context):
+        for el in elements:
+            el.replace_with(self.figure(html,
+                el.select('img')[0]['data-src'],
+                el.select('.image-caption')[0].string))
+
+    def cartacapital_tile_rights(self, html, elements, matches, context):
+        for i, el in enumerate(elements):
+            img = list(matches['.canvasImg img'])[i]
+            el.replace_with(self.figure(html, img['data-src'], el.select('span')[0].string))
             img.parent.decompose()
-        
-        # veja
-        for el in html.select('.featured-image'):
-            fg = html.new_tag('figure')
-            fg.append(html.new_tag('img', src=el.select('img')[0]['data-src']))
-            fc = html.new_tag('figcaption')
-            fc.string = el.select('p')[0].string
-            fg.append(fc)
-            
-            el.replace_with(fg)
-            
-        for el in html.select('p span iframe[src*="https://www.youtubel.com/embed"]'):    
-            video_id = el['data-lazy-src'].split('/')[4]
-            fm = html.new_tag('iframe', src='https://www.youtubel.com/embed/%s?rel=0' % video_id,
-                width='1280', height='720', frameborder='0', allowfullscreen='true')
-        
-        # g1
-        for el in html.select('[data-block-type="backstage-photo"]'):
-            fg = html.new_tag('figure')
-            fg.append(html.new_tag('img', src=el.select('img.content-media__image')[0]['data-src']))
-            fc = html.new_tag('figcaption')
-            fc.string = el.select('img.content-media__image')[0]['alt']
-            fg.append(fc)
-            
-            el.replace_with(fg)
-        
-        for el in html.select('[data-block-type="backstage-video"]'):
+
+    # veja
+    def veja_featured_image(self, html, elements, matches, context):
+        for el in elements:
+            el.replace_with(self.figure(html,
+                el.select('img')[0]['data-src'],
+                el.select('p')[0].string))
+
+    # g1
+    def g1_backstage_photo(self, html, elements, matches, context):
+        for el in elements:
+            img = el.select('img.content-media__image')[0]
+            el.replace_with(self.figure(html, img['data-src'], img['alt']))
+
+    def g1_backstage_video(self, html, elements, matches, context):
+        for el in elements:
             video_id = el.select('[data-video-id]')[0]['data-video-id']
-            fg = html.new_tag('figure')
-            fg.append(html.new_tag('img', src='https://s02.video.glbimg.com/x720/%s.jpg' % video_id))
-            fc = html.new_tag('figcaption')
-            fc.string = el.select('[itemprop="caption"]')[0]['content']
-            fg.append(fc)
             a = html.new_tag('a', href='https://globoplay.globo.com/v/%s/' % video_id)
-            a.append(fg)
-            
+            a.append(self.figure(html,
+                'https://s02.video.glbimg.com/x720/%s.jpg' % video_id,
+                el.select('[itemprop="caption"]')[0]['content']))
             el.replace_with(a)
-        
-        # estadao
-        for el in html.select('[data-config]'):
-            media_doc = json.loads(el['data-config'])
-            media_url =  self.estadao_media_url if not context.get('media_img_url') else context.get('media_img_url')
-            media_url = media_url.format(**media_doc)
-            results = requests.get(media_url).json()['resultadoConteudo']['conteudos']
-            
-            img_src = ''
-            for presset in results[0]['pressets']:
-                if presset['class'] == 'full':
-                    img_src = presset['file']
-                    break
-            
-            fg = html.new_tag('figure')
-            fg.append(html.new_tag('img', src=img_src))
-            fc = html.new_tag('figcaption')
-            fc.string = '{} '.format(results[0]['titulo'])
-            s = html.new_tag('small', rel='credits') 
-            s.string = results[0]['credito']
-            fc.append(s)
-            fg.append(fc)
-            
-            el.replace_with(fg)
-        
-        # for el in html.select('.documento'):
-        #     [e.decompose() for eLin el.select('span')]
-        #     el.select('h3')[0].name = 'strong'
-        
-        # All
-        for el in html.select('.wp-caption'):
-            fg = html.new_tag('figure')
-            fg.append(html.new_tag('img', src=el.select('img')[0]['src']))
-            fc = html.new_tag('figcaption')
-            fc.string = el.select('.wp-caption-text')[0].string
-            fg.append(fc)
-            
+
+    # estadao
+    def estadao_media(self, html, elements, matches, context):
+        for el in elements:
+            media = self.cleaner.estadao_media(el['data-config'], context)
+            if media is None:
+                continue
+
+            fg = self.figure(html, media['src'], '{} '.format(media['titulo']))
+            s = html.new_tag('small', rel='credits')
+            s.string = media['credito']
+            fg.figcaption.append(s)
+
             el.replace_with(fg)
-        
-        for el in html.select('p iframe[data-lazy-src*="https://www.youtubel.com/embed"]'):
+
+    # All
+    def wp_caption(self, html, elements, matches, context):
+        for el in elements:
+            el.replace_with(self.figure(html,
+                el.select('img')[0]['src'],
+                el.select('.wp-caption-text')[0].string))
+
+    def youtube_iframe(self, html, elements, matches, context):
+        for el in elements:
             # TODO: Use Regex?
             video_id = el['data-lazy-src'].split('/')[4]
             fm = html.new_tag('iframe', src='https://www.youtubel.com/embed/%s?rel=0' % video_id,
                 width='1280', height='720', frameborder='0', allowfullscreen='true')
-            
+
             el.parent.replace_with(fm)
-        
-        el_to_uwrap = [ 
-            'main', 
-            'p span', 
-            'p em span', 
-            '#content-core', 
-            '#mobile1stparagraph', 
-            '#textstructured', 
-            '.content', 
-            '.content-text', 
-            '.article-content', 
-            '.content-intertitle', 
-            '.td-post-content', 
-            '.td-post-featured-image', 
-            '.video-container', 
-            '[data-block-type=unstyled]', 
-            '[itemprop="articleBody"]', 
-        ] if not context.get('el_to_uwrap') else context.get('el_to_uwrap')
-        [el.unwrap() for el in html.select(','.join(el_to_uwrap))]
-            
-        el_to_decompose = {
-            'geral': [
-                'style', 
-                'script', 
-                '#column-middle', 
-                '#liveblog-container', 
-                '.content-head', 
-                '.content-share-bar', 
-                '[data-block-type="related-articles"]', 
-                '.mc-side-item__container', 
-                '.mc-show-later', 
-                '.content-share-bar', 
-                '.content-ads', 
-                '.comments', 
-                '.tags', 
-                '.widget-news', 
-            ],
-            'empty': ['p', 'div',]
-        } if not context.get('el_to_decompose') else context.get('el_to_decompose')
-        [el.decompose() for el in html.select(','.join(el_to_decompose['geral']))]
-        [el.decompose() for el in html.select(','.join(el_to_decompose['empty'])) if not el.contents]
-        
+
+    def unwrap(self, html, elements, matches, context):
+        [el.unwrap() for el in elements]
+
+    def decompose(self, html, elements, matches, context):
+        [el.decompose() for el in elements]
+
+    def decompose_empty(self, html, elements, matches, context):
+        [el.decompose() for el in elements if not el.contents]
+
+    def decompose_previous(self, html, elements, matches, context):
         # TODO: B4S bug
-        [el.previous_element.decompose() for el in html.select('p + br + p')]
-        
-        attrs_to_remove = [
-            'alt', 
-            'title', 
-            'class', 
-            'data-block-type', 
-            'data-track-category', 
-            'data-track-links',
-            'width', 
-            'height', 
-            'style', 
-            'data-sizes', 
-            'rel', 
-            'data-width', 
-            'type',
-            'cellpadding', 
-            'cellspacing', 
-            'valign', 
-        ] if not context.get('attrs_to_remove') else context.get('attrs_to_remove')
-        for t in html.find_all():
+        [el.previous_element.decompose() for el in elements]
+
+    def strip_attrs(self, html, elements, matches, context):
+        attrs_to_remove = context.get('attrs_to_remove') or self.cleaner.attrs_to_remove
+        for t in elements:
             for a in attrs_to_remove:
-                if t.has_attr(a): del t[a] 
-                else: pass
-        
-        for el in html.select('td p s'):
+                if a in t.attrs: del t[a]
+
+    def td_strikethrough(self, html, elements, matches, context):
+        for el in elements:
             el.parent.parent.string = el.string
-        
-        for el in html.select('p > strong'):
+
+    def strong_to_h2(self, html, elements, matches, context):
+        for el in elements:
             h2 = html.new_tag('h2')
             h2.string = el.string
             el.parent.replace_with(h2)
-        
-        [c.extract() for c in html.findAll(text=lambda text:isinstance(text, Comment))]
-        
-        html_new = html.prettify()
-        
-        return html_new
\ No newline at end of file
+
+    def extract(self, html, elements, matches, context):
+        [c.extract() for c in elements]
+
+
+class LxmlActions(object):
+    """Rule actions over a detached `lxml.html` tree."""
+
+    def __init__(self, cleaner):
+        self.cleaner = cleaner
+
+    def element(self, doc, tag, text=None, **attrs):
+        el = doc.makeelement(tag, attrs)
+        el.text = text
+        return el
+
+    def figure(self, doc, src, caption):
+        fg = self.element(doc, 'figure')
+        fg.append(self.element(doc, 'img', src=src))
+        fg.append(self.element(doc, 'figcaption', caption))
+        return fg
+
+    def replace(self, el, new):
+        new.tail, el.tail = el.tail, None
+        el.getparent().replace(el, new)
+
+    def text(self, el):
+        return el.text_content() if el is not None else None
+
+    def select(self, el, css):
+        return lxml_xpath(css)(el)
+
+    # cartacapital
+    def cartacapital_image_inline(self, doc, elements, matches, context):
+        for el in elements:
+            self.replace(el, self.figure(doc,
+                self.select(el, 'img')[0].get('data-src'),
+                self.text(self.select(el, '.image-caption')[0])))
+
+    def cartacapital_tile_rights(self, doc, elements, matches, context):
+        for i, el in enumerate(elements):
+            img = list(matches['.canvasImg img'])[i]
+            self.replace(el, self.figure(doc, img.get('data-src'),
+                self.text(self.select(el, 'span')[0])))
+            img.getparent().drop_tree()
+
+    # veja
+    def veja_featured_image(self, doc, elements, matches, context):
+        for el in elements:
+            self.replace(el, self.figure(doc,
+                self.select(el, 'img')[0].get('data-src'),
+                self.text(self.select(el, 'p')[0])))
+
+    # g1
+    def g1_backstage_photo(self, doc, elements, matches, context):
+        for el in elements:
+            img = self.select(el, 'img.content-media__image')[0]
+            self.replace(el, self.figure(doc, img.get('data-src'), img.get('alt')))
+
+    def g1_backstage_video(self, doc, elements, matches, context):
+        for el in elements:
+            video_id = self.select(el, '[data-video-id]')[0].get('data-video-id')
+            a = self.element(doc, 'a', href='https://globoplay.globo.com/v/%s/' % video_id)
+            a.append(self.figure(doc,
+                'https://s02.video.glbimg.com/x720/%s.jpg' % video_id,
+                self.select(el, '[itemprop="caption"]')[0].get('content')))
+            self.replace(el, a)
+
+    # estadao
+    def estadao_media(self, doc, elements, matches, context):
+        for el in elements:
+            media = self.cleaner.estadao_media(el.get('data-config'), context)
+            if media is None:
+                continue
+
+            fg = self.figure(doc, media['src'], '{} '.format(media['titulo']))
+            fg[-1].append(self.element(doc, 'small', media['credito'], rel='credits'))
+
+            self.replace(el, fg)
+
+    # All
+    def wp_caption(self, doc, elements, matches, context):
+        for el in elements:
+            self.replace(el, self.figure(doc,
+                self.select(el, 'img')[0].get('src'),
+                self.text(self.select(el, '.wp-caption-text')[0])))
+
+    def youtube_iframe(self, doc, elements, matches, context):
+        for el in elements:
+            video_id = el.get('data-lazy-src').split('/')[4]
+            fm = self.element(doc, 'iframe', src='https://www.youtubel.com/embed/%s?rel=0' % video_id,
+                width='1280', height='720', frameborder='0', allowfullscreen='true')
+
+            self.replace(el.getparent(), fm)
+
+    def unwrap(self, doc, elements, matches, context):
+        [el.drop_tag() for el in elements]
+
+    def decompose(self, doc, elements, matches, context):
+        [el.drop_tree() for el in elements]
+
+    def decompose_empty(self, doc, elements, matches, context):
+        [el.drop_tree() for el in elements if not len(el) and not el.text]
+
+    def decompose_previous(self, doc, elements, matches, context):
+        [el.getprevious().drop_tree() for el in elements]
+
+    def strip_attrs(self, doc, elements, matches, context):
+        attrs_to_remove = context.get('attrs_to_remove') or self.cleaner.attrs_to_remove
+        etree.strip_attributes(doc, *attrs_to_remove)
+
+    def td_strikethrough(self, doc, elements, matches, context):
+        for el in elements:
+            td = el.getparent().getparent()
+            for child in list(td):
+                td.remove(child)
+            td.text = el.text_content()
+
+    def strong_to_h2(self, doc, elements, matches, context):
+        for el in elements:
+            self.replace(el.getparent(), self.element(doc, 'h2', el.text_content()))
+
+    def extract(self, doc, elements, matches, context):
+        [c.drop_tree() for c in elements]
+
+
+class CleanHTML(object):
+    """
+    Clean the HTML of an article body.
+
+    Values can be HTML strings, cleaned with BeautifulSoup, or `lxml.html`
+    elements taken directly from the response tree (see `CLEAN_HTML_BACKEND`),
+    which skips serializing and parsing the fragment again.
+
+    Both give the same elements and text, not the same string: BeautifulSoup
+    output is prettified, lxml output is serialized with `method='html'`.
+    """
+
+    cartacapital_rules = [
+        Rule('.image-inline', 'cartacapital_image_inline'),
+        Rule('.canvasImg img'),
+        Rule('.tile-rights', 'cartacapital_tile_rights'),
+    ]
+
+    # Transforms of a single portal, keyed by domain
+    site_rules = {
+        'cartacapital.com.br': cartacapital_rules,
+        'cartaeducacao.com.br': cartacapital_rules,
+        'veja.abril.com.br': [
+            Rule('.featured-image', 'veja_featured_image'),
+        ],
+        'g1.globo.com': [
+            Rule('[data-block-type="backstage-photo"]', 'g1_backstage_photo'),
+            Rule('[data-block-type="backstage-video"]', 'g1_backstage_video'),
+        ],
+        'estadao.com.br': [
+            Rule('[data-config]', 'estadao_media'),
+        ],
+    }
+
+    # Transforms of every portal, applied after the site ones
+    generic_rules = [
+        Rule('.wp-caption', 'wp_caption'),
+        Rule('p iframe[data-lazy-src*="https://www.youtubel.com/embed"]', 'youtube_iframe'),
+    ]
+
+    el_to_uwrap = [
+        'main',
+        'p span',
+        'p em span',
+        '#content-core',
+        '#mobile1stparagraph',
+        '#textstructured',
+        '.content',
+        '.content-text',
+        '.article-content',
+        '.content-intertitle',
+        '.td-post-content',
+        '.td-post-featured-image',
+        '.video-container',
+        '[data-block-type=unstyled]',
+        '[itemprop="articleBody"]',
+    ]
+
+    el_to_decompose = {
+        'geral': [
+            'style',
+            'script',
+            '#column-middle',
+            '#liveblog-container',
+            '.content-head',
+            '.content-share-bar',
+            '[data-block-type="related-articles"]',
+            '.mc-side-item__container',
+            '.mc-show-later',
+            '.content-share-bar',
+            '.content-ads',
+            '.comments',
+            '.tags',
+            '.widget-news',
+        ],
+        'empty': ['p', 'div',]
+    }
+
+    attrs_to_remove = [
+        'alt',
+        'title',
+        'class',
+        'data-block-type',
+        'data-track-category',
+        'data-track-links',
+        'width',
+        'height',
+        'style',
+        'data-sizes',
+        'rel',
+        'data-width',
+        'type',
+        'cellpadding',
+        'cellspacing',
+        'valign',
+    ]
+
+    def __init__(self):
+        self._compiled = {}
+        self.backends = {
+            'bs4': (SoupRuleSet, SoupActions(self)),
+            'lxml': (LxmlRuleSet, LxmlActions(self)),
+        }
+
+    def rules(self, sites, el_to_uwrap, el_to_decompose):
+        """Rules grouped by walk, in the order they are applied."""
+        site_rules = []
+        for site in sites:
+            site_rules += [r for r in self.site_rules[site] if r not in site_rules]
+
+        return [
+            site_rules + self.generic_rules,
+            [
+                Rule(','.join(el_to_uwrap), 'unwrap'),
+            ],
+            [
+                Rule(','.join(el_to_decompose['geral']), 'decompose'),
+            ] + [
+                # One rule per selector, applied in order: the children emptied
+                # by a selector are removed before the parents are tested
+                Rule(selector, 'decompose_empty') for selector in el_to_decompose['empty']
+            ],
+            [
+                Rule('p + br + p', 'decompose_previous'),
+                Rule('*', 'strip_attrs'),
+                Rule('td p s', 'td_strikethrough'),
+                Rule('p > strong', 'strong_to_h2'),
+                Rule(COMMENTS, 'extract'),
+            ],
+        ]
+
+    def sites(self, context):
+        """
+        Keys of `site_rules` matching the spider domains (`allowed_domains` in
+        loader context) or, failing that, the response host. All sites when
+        the origin of the value is unknown.
+        """
+        domains = context.get('allowed_domains')
+        if not domains and context.get('response') is not None:
+            domains = [urllib.parse.urlparse(context.get('response').url).hostname or '']
+        if not domains:
+            return tuple(sorted(self.site_rules))
+
+        return tuple(sorted(site for site in self.site_rules
+                            if any(d == site or d.endswith('.' + site) for d in domains)))
+
+    def compile(self, backend, sites, el_to_uwrap, el_to_decompose):
+        """
+        Build the rule sets of a backend, one tree walk each. Rule sets are
+        cached, so every combination of sites and overrides given by context
+        is compiled only once.
+        """
+        key = (backend, sites, tuple(el_to_uwrap), tuple(el_to_decompose['geral']),
+               tuple(el_to_decompose['empty']))
+        if key not in self._compiled:
+            RuleSetClass, actions = self.backends[backend]
+            self._compiled[key] = [RuleSetClass(rules, actions)
+                                   for rules in self.rules(sites, el_to_uwrap, el_to_decompose)]
+        return self._compiled[key]
+
+    def estadao_media(self, data_config, context):
+        """
+        Media of an Estadão `data-config` element, resolved by the spider before
+        the item is loaded (`media` in loader context), None when unresolved.
+        """
+        key = estadao_media_key(data_config)
+        media = (context.get('media') or {}).get(key)
+        if media is None:
+            logger.debug('Estadão media %s not resolved, element kept' % key)
+        return media
+
+    def __call__(self, value, loader_context=None):
+        context = loader_context or {}
+        timer = context.get('stage_timer')
+        if timer is None:
+            return self.clean(value, context)
+
+        started = time.time()
+        html = self.clean(value, context)
+        response = context.get('response')
+        timer.since('clean_html', started, response.url if response is not None else None)
+        return html
+
+    def clean(self, value, context):
+        self.stats = context.get('crawler_stats')
+        backend = 'lxml' if isinstance(value, etree._Element) else 'bs4'
+        rule_sets = self.compile(backend, self.sites(context),
+            context.get('el_to_uwrap') or self.el_to_uwrap,
+            context.get('el_to_decompose') or self.el_to_decompose)
+
+        if backend == 'lxml':
+            # Work on a copy, the element still belongs to the response tree
+            doc = value.makeelement('div', {})
+            doc.append(copy.deepcopy(value))
+            doc[0].tail = None
+        else:
+            doc = BeautifulSoup(value, 'html.parser')
+
+        for rule_set in rule_sets:
+            rule_set.apply(doc, context)
+
+        if backend == 'lxml':
+            return (doc.text or '') + ''.join(
+                etree.tostring(el, encoding='unicode', method='html') for el in doc)
+
+        html_new = doc.prettify()
+
+        return html_new
@@ -13,6 +13,7 @@ import ze.utils.file
 PROJECT_NAME = 'ze-the-scraper'
 SPIDER_MODULES = ['ze.spiders']
 NEWSPIDER_MODULE = 'ze.spiders'
+COMMANDS_MODULE = 'ze.commands'
 
 DUPEFILTER_DEBUG = True
 
@@ -51,32 +52,199 @@ CONCURRENT_REQUESTS_PER_IP=16
 # Enable or disable downloader middlewares
 # See http://scrapy.readthedocs.org/en/latest/topics/downloader-middleware.html
 DOWNLOADER_MIDDLEWARES = {
+    'ze.middlewares.FingerprintMiddleware': 50,
+    'ze.middlewares.ArchiveMiddleware': 60,
+    'ze.middlewares.ProxyMiddleware': 610,
 #     'rotating_proxies.middlewares.RotatingProxyMiddleware': 610,
 #     'rotating_proxies.middlewares.BanDetectionMiddleware': 620,
 }
 
 # ROTATING_PROXY_LIST = ze.utils.file.load_lines('./proxies-list.txt')
 
+# Rotate the proxies of PROXY_LIST, picked by the EWMA of their success and
+# latency (PROXY_EWMA_ALPHA). Failing or banned proxies are not used for
+# PROXY_BACKOFF seconds, doubled on each failure up to PROXY_MAX_BACKOFF.
+# Scores are kept between runs in PROXY_SCORES_PATH (default .scrapy/proxies.json)
+PROXY_ENABLED = False
+PROXY_LIST = './proxies-list.txt'
+# PROXY_SCORES_PATH = ''
+PROXY_EWMA_ALPHA = 0.3
+PROXY_BACKOFF = 60
+PROXY_MAX_BACKOFF = 3600
+PROXY_MAX_RETRIES = 5
+PROXY_BAN_CODES = [403, 407, 429, 503]
+
+# Count the tries and matches of each fallback selector of the spiders `parses`,
+# kept between runs in SELECTOR_STATS_DIR/<spider>.json (default
+# .scrapy/selectors), so the spiders running at once do not share a file.
+# Selectors that never matched in SELECTOR_STATS_MIN_TRIES tries are reported
+# when the spider closes. SELECTOR_REORDER tries first the selectors matching
+# most often (order recomputed every SELECTOR_REORDER_INTERVAL tries); the first
+# selector matching wins, so the item can change if several match
+SELECTOR_STATS_ENABLED = False
+# SELECTOR_STATS_DIR = ''
+SELECTOR_STATS_MIN_TRIES = 100
+SELECTOR_REORDER = False
+SELECTOR_REORDER_INTERVAL = 100
+
+# Skip the articles already scraped by any spider in previous runs, recorded
+# by canonical URL in .scrapy/fingerprints.db (or FINGERPRINTS_PATH). Articles
+# scraped more than FINGERPRINTS_REFRESH_AGE seconds ago are fetched again (0
+# never). A Bloom filter of FINGERPRINTS_BLOOM_CAPACITY keys avoids most lookups
+FINGERPRINTS_ENABLED = False
+# FINGERPRINTS_PATH = ''
+FINGERPRINTS_REFRESH_AGE = 0
+# Fetch the articles again with If-None-Match/If-Modified-Since, ignoring 304s
+FINGERPRINTS_CONDITIONAL = True
+FINGERPRINTS_BLOOM_CAPACITY = 1000000
+FINGERPRINTS_BLOOM_ERROR_RATE = 0.01
+
+# Archive the responses of the articles as WARC segments (gzip by record, named
+# after their SHA-1) in ARCHIVE_DIR/<spider> (default .scrapy/archive/<spider>),
+# sealed after ARCHIVE_SEGMENT_RECORDS records or ARCHIVE_SEGMENT_MB. Bodies
+# already archived for the same URL are skipped. Extract the items again with
+# `scrapy reparse <spider> <archive>`, see ze.commands.reparse
+ARCHIVE_ENABLED = False
+# ARCHIVE_DIR = ''
+ARCHIVE_SEGMENT_RECORDS = 1000
+ARCHIVE_SEGMENT_MB = 100
+ARCHIVE_COMPRESS_LEVEL = 6
+
 GOOGLE_CLOUD_ENABLED = True
 # Google Cloud Application Credentions used for many pipelines
 GOOGLE_APPLICATION_CREDENTIALS_JSON = ''
 # Enable or disable extensions
 # See http://scrapy.readthedocs.org/en/latest/topics/extensions.html
 EXTENSIONS = {
-    'ze.extensions.google.GoogleCloud': 10
+    'ze.extensions.google.GoogleCloud': 10,
+    'ze.extensions.concurrency.AdaptiveConcurrency': 20,
+    'ze.extensions.timing.StageTiming': 30,
+    'ze.extensions.memory.MemoryMonitor': 40,
 }
 
+# RSS, in-flight responses and items, scheduler queue and item sizes in the
+# stats (`memory/...`) every MEMORY_CHECK_INTERVAL seconds, see
+# ze.extensions.memory.MemoryMonitor. Thresholds in MB, 0 to disable: reports
+# are logged and posted to MEMORY_WEBHOOK_URL above MEMORY_WARNING_MB, the
+# scheduling is paused above MEMORY_PAUSE_MB until MEMORY_RESUME_MB (90% of it
+# by default, or nothing in flight at most MEMORY_PAUSE_MAX_RESUMES times) and
+# the spider closed above MEMORY_LIMIT_MB
+MEMORY_MONITOR_ENABLED = False
+MEMORY_CHECK_INTERVAL = 10
+MEMORY_WARNING_MB = 0
+MEMORY_PAUSE_MB = 0
+MEMORY_RESUME_MB = 0
+MEMORY_PAUSE_MAX_RESUMES = 3
+MEMORY_LIMIT_MB = 0
+# MEMORY_WEBHOOK_URL = 'https://hooks.example.com/ze'
+# Top allocation sites since the spider opened in the reports (slows down the
+# crawl), with MEMORY_TRACEMALLOC_FRAMES frames by site
+MEMORY_TRACEMALLOC = False
+MEMORY_TRACEMALLOC_FRAMES = 1
+MEMORY_TRACEMALLOC_TOP = 10
+
+# Histograms of the time of each stage of the crawl (search, download,
+# load_item, clean_html, date_time) in the stats, as `timing/<stage>` and by
+# domain with TIMING_BY_DOMAIN, see ze.extensions.timing.StageTiming. With
+# TIMING_PROMETHEUS_PORT they are served in Prometheus text format at
+# http://TIMING_PROMETHEUS_HOST:<port>/metrics while the crawl runs
+TIMING_ENABLED = False
+TIMING_BY_DOMAIN = True
+# TIMING_PROMETHEUS_PORT = 9410
+TIMING_PROMETHEUS_HOST = '127.0.0.1'
+
+# Adjust the concurrency and delay of each download slot from its latency,
+# errors and 429/503 responses, between these bounds (spiders can override them
+# in `custom_settings`), see ze.extensions.concurrency.AdaptiveConcurrency. The
+# slots are by domain, CONCURRENT_REQUESTS_PER_IP is ignored
+ADAPTIVE_CONCURRENCY_ENABLED = False
+ADAPTIVE_CONCURRENCY_MIN = 1
+ADAPTIVE_CONCURRENCY_MAX = 16
+ADAPTIVE_CONCURRENCY_MAX_DELAY = 60
+# Seconds of latency and rate of errors (EWMA) above which concurrency decreases
+ADAPTIVE_CONCURRENCY_TARGET_LATENCY = 2
+ADAPTIVE_CONCURRENCY_ERROR_RATE = 0.1
+
 # MongoDB pipeline configuration
 MONGO_URI = None
 MONGO_DATABASE = None
+# Items are inserted in batches of MONGO_BATCH_SIZE, or every MONGO_FLUSH_INTERVAL
+# seconds, items wait for room when MONGO_BUFFER_SIZE items are not written yet
+MONGO_BATCH_SIZE = 100
+MONGO_FLUSH_INTERVAL = 5
+MONGO_BUFFER_SIZE = 1000
+# Keep one document per URL, replaced only when dateModified is newer
+MONGO_UPSERT = False
+
+# Run the item loader processors (CleanHTML, dates, authors) in a pool of
+# processes instead of the reactor thread. Pool size defaults to CPU count
+PROCESS_POOL_ENABLED = False
+PROCESS_POOL_SIZE = None
+
+# Google Cloud Pub/Sub messages are published in batches by count, bytes or
+# latency (seconds). Set PUBSUB_EMULATOR_HOST in environment to use the emulator
+PUBSUB_BATCH_SIZE = 100
+PUBSUB_BATCH_BYTES = 1024 * 1024
+PUBSUB_BATCH_LATENCY = 1
+PUBSUB_BUFFER_SIZE = 1000
+PUBSUB_MAX_IN_FLIGHT = 4
+
+# Spool the items of the Mongo and Pub/Sub pipelines to disk (gzip JSON lines
+# segments) and write them to the sinks in background, retrying when they fail.
+# Segments left by a previous run are replayed. Default dir: .scrapy/spool
+SPOOL_ENABLED = False
+# SPOOL_DIR = ''
+SPOOL_SEGMENT_RECORDS = 1000
+SPOOL_FSYNC_RECORDS = 100
+# Maximum seconds between retries of a failing sink
+SPOOL_MAX_BACKOFF = 300
 
 # Configure item pipelines
 # See http://scrapy.readthedocs.org/en/latest/topics/item-pipeline.html
 ITEM_PIPELINES = {
+    'ze.pipelines.ProcessPoolPipeline': 100,
     'ze.pipelines.GooglePubSubPipeline': 300,
     # 'ze.pipelines.MongoPipeline': 310,
 }
 
+# Google searches run one query per allowed domain, scraped together by
+# GoogleScraper one SERP page at a time with at most SEARCH_CONCURRENCY workers.
+# Result pages are cached for SEARCH_CACHE_TTL seconds (0 disables the cache),
+# so scheduled runs within this window do not search again. Default path:
+# .scrapy/search.db
+SEARCH_CONCURRENCY = 4
+SEARCH_CACHE_TTL = 60 * 60
+# SEARCH_CACHE_PATH = ''
+
+# Canonical URLs of the links discovered and of the items, rules by domain
+# (subdomains included) update the `default` ones, see ze.utils.DEFAULT_URL_RULES
+URL_CANONICAL_RULES = {
+    'cartacapital.com.br': {'trailing_slash': True,
+                            'hosts': {'m.cartacapital.com.br': 'www.cartacapital.com.br'}},
+    'cartaeducacao.com.br': {'trailing_slash': True},
+    # WordPress, redirects the URLs without the slash
+    'veja.abril.com.br': {'trailing_slash': True},
+    'folha.uol.com.br': {'hosts': {'m.folha.uol.com.br': 'www1.folha.uol.com.br'}},
+    'estadao.com.br': {'hosts': {'m.estadao.com.br': 'www.estadao.com.br'}},
+    'em.com.br': {'hosts': {'m.em.com.br': 'www.em.com.br'}},
+    'correiobraziliense.com.br': {
+        'hosts': {'m.correiobraziliense.com.br': 'www.correiobraziliense.com.br'}},
+}
+
+# Backend used by CleanHTML: `bs4` parses the extracted HTML string again,
+# `lxml` cleans a copy of the elements already parsed by the response. The
+# same elements are kept, but `articleBody` is serialized differently: bs4
+# prettifies it (one tag or text by line, `<img/>`), lxml keeps the original
+# whitespace (`<img>`)
+CLEAN_HTML_BACKEND = 'bs4'
+
+# Cache of the media embedded in articles, resolved by the spiders with
+# sub-requests (e.g. Estadão middlewareAgile). Default path: .scrapy/media.db
+# MEDIA_CACHE_PATH = ''
+MEDIA_CACHE_TTL = 7 * 24 * 60 * 60
+# Estadão middlewareAgile endpoint, `tipo` and `id` come from `data-config`
+# ESTADAO_MEDIA_URL = 'http://localhost:8000/conteudo?tipo_midia={tipo}&idAgile={id}'
+
 SPIDER_CONTRACTS = {
     'scrapy.contracts.default.UrlContract': 10,
     'scrapy.contracts.default.ReturnsContract': 20,
@@ -1,16 +1,73 @@
 # -*- coding: utf-8 -*-
+import os
+import sys
 import json
+import time
+import uuid
+import shutil
+import tempfile
 import urllib.parse
+from twisted.internet import defer, threads
 import scrapy
+from scrapy import signals
+from scrapy.exceptions import DontCloseSpider
 from scrapy.http import Request, HtmlResponse
+from scrapy.utils.gz import gunzip
+from scrapy.utils.project import data_path
+from scrapy.utils.sitemap import sitemap_urls_from_robots
 import ze
+from ze.utils.cache import TTLCache
+from ze.utils.feeds import iter_feed, last_update_seconds
+from ze.utils.fingerprints import content_hash, article_unchanged
+from ze.utils.selectors import SelectorStats
+from ze.items.plan import compile_parses, compile_item, serialize
+
+# GoogleScraper searches of the process, run one at a time
+search_lock = defer.DeferredLock()
+
+
+def search_pages(args):
+    return range(1, args.get('pages', 2) + 1)
+
+
+def search_cache_key(args, page):
+    # SERP pages are cached by engine, query, last_update and page
+    return json.dumps([args.get('engine', 'google'), args['query'], args.get('last_update', 'w'), page])
+
+
+def search_cache_keys(args):
+    return [search_cache_key(args, page) for page in search_pages(args)]
+
+
+def scrape_jobs_file(directory, queries, page):
+    """
+    GoogleScraper keyword file searching the SERP `page` of each query. Jobs
+    for a given page, not pages 1 to `num_pages_for_keyword`, can only be
+    given by a Python module defining `scrape_jobs`, imported by its name.
+    """
+    path = os.path.join(directory, 'jobs_%s.py' % uuid.uuid4().hex)
+    jobs = [{'query': query, 'search_engine': 'google', 'scrape_method': 'http', 'page_number': page}
+            for query in queries]
+    with open(path, 'w') as f:
+        f.write('scrape_jobs = %r\n' % jobs)
+    return path
 
-import GoogleScraper
 
 class ZeSpider(scrapy.Spider):
     
     allowed_domains = []
     parses = {}
+    # News sitemaps and RSS/Atom feeds read by the `own` search engine, the
+    # sitemaps of robots.txt of `allowed_domains` are used when empty
+    feeds = []
+    search_cache = None
+    # Tries and matches of the fallback selectors, see `load_item`
+    selector_stats = None
+    # Set by ze.extensions.timing.StageTiming
+    stage_timer = None
+    # Searches in progress, see `search_domains`
+    searching = None
+    start_time = None
     
     def __init__(self, name=None, **kwargs):
         self.args = kwargs
@@ -22,6 +79,8 @@ class ZeSpider(scrapy.Spider):
         self.__dict__.update(kwargs)
         if not hasattr(self, 'start_urls'):
             self.start_urls = []
+        # url_key of the links already scheduled
+        self.discovered = set()
     
     @classmethod
     def from_crawler(cls, crawler, *args, **kwargs):
@@ -31,27 +90,163 @@ class ZeSpider(scrapy.Spider):
                 
         spider = cls(*args, **kwargs)
         spider._set_crawler(crawler)
+        spider.plan = cls.extraction_plan() if spider.parses is cls.parses \
+            else compile_parses(spider.parses)
+
+        if crawler.settings.getint('SEARCH_CACHE_TTL'):
+            spider.search_cache = TTLCache(
+                crawler.settings.get('SEARCH_CACHE_PATH') or data_path('search.db'),
+                crawler.settings.getint('SEARCH_CACHE_TTL'))
+            crawler.signals.connect(spider.search_cache.close, signal=signals.spider_closed)
+        if crawler.settings.getbool('SELECTOR_STATS_ENABLED'):
+            spider.selector_stats = SelectorStats(
+                os.path.join(crawler.settings.get('SELECTOR_STATS_DIR') or data_path('selectors'),
+                             '%s.json' % spider.name),
+                reorder=crawler.settings.getbool('SELECTOR_REORDER'),
+                interval=crawler.settings.getint('SELECTOR_REORDER_INTERVAL', 100))
+            crawler.signals.connect(spider.close_selector_stats, signal=signals.spider_closed)
+        crawler.signals.connect(spider.spider_idle, signal=signals.spider_idle)
+        crawler.signals.connect(spider.item_scraped, signal=signals.item_scraped)
         return spider
 
     def start_requests(self):
-        urls = []
-        
+        self.start_time = time.time()
+
         if self.args.get('url'):
-            urls.append(self.args.get('url'))
+            yield scrapy.Request(self.args.get('url'))
         elif self.args['search']['engine'] in ['google']:
-            for d in self.allowed_domains:
-                self.args['search']['query'] = '%s site:%s' % (self.args['search']['query'], d)
-                urls = self.get_urls_from_search_engine(self.args['search'])
+            self.search_domains(self.args['search'])
         elif self.args['search']['engine'] == 'own':
-            self.make_request_from_onw_search_engine()
+            for request in self.make_request_from_onw_search_engine(self.args['search']):
+                yield request
         else:
             raise ValueError('search.provider is not valid, please search `google` or `own`')
-        
-        for u in urls:
-            yield scrapy.Request(u)
-    
-    def get_urls_from_search_engine(self, args={}):
+
+    def search_domains(self, args):
         """
+        Search each allowed domain with its own query (see `search`). The
+        spider is kept open until every search is done.
+        """
+        queries = [(d, '%s site:%s' % (args['query'], d)) for d in self.allowed_domains] \
+            or [(None, args['query'])]
+        self.searching = self.search(args, queries)
+        self.searching.addErrback(lambda f: self.logger.error('Search failed: %s' % f.value))
+        self.searching.addCallback(self.searched, len(queries))
+        return self.searching
+
+    @defer.inlineCallbacks
+    def search(self, args, queries):
+        """
+        Links of the `(domain, query)` searches, scheduled as they are found.
+        Searches cached for all their pages are read concurrently. The others
+        are scraped by GoogleScraper together, one SERP page at a time, with
+        at most SEARCH_CONCURRENCY workers, so the articles of a page are
+        downloaded while the next one is searched. A query without results
+        on a page is not searched further.
+        """
+        cached = yield defer.DeferredList(
+            [self.cached_search(dict(args, query=query), domain) for domain, query in queries],
+            consumeErrors=True)
+
+        missing = []
+        for query, (success, urls) in zip(queries, cached):
+            if success and urls is not None:
+                self.schedule_urls(urls)
+            else:
+                missing.append(query)
+
+        for page in search_pages(args):
+            if not missing:
+                break
+            started = time.time()
+            # GoogleScraper keeps its configuration in a module and its results
+            # in one database, it runs one search at a time in the process
+            found = yield search_lock.run(threads.deferToThread, self.get_urls_from_search_engine,
+                                          args, [query for _, query in missing], page)
+            if self.stage_timer is not None:
+                self.stage_timer.since('search', started)
+            for _, query in missing:
+                self.schedule_urls(found.get(query, []))
+            missing = [(domain, query) for domain, query in missing if found.get(query)]
+
+    def cached_search(self, args, domain=None):
+        """Links of a search found in the cache, read in a thread, or None."""
+        started = time.time()
+        d = threads.deferToThread(self.cached_search_results, args)
+        if self.stage_timer is not None:
+            url = 'http://%s/' % domain if domain else None
+            d.addBoth(lambda result: self.stage_timer.since('search', started, url) or result)
+        return d
+
+    def schedule_urls(self, urls):
+        for request in self.requests_from_urls(urls):
+            self.crawler.engine.crawl(request, self)
+
+    def requests_from_urls(self, urls):
+        """
+        Requests of the canonical `urls` not discovered yet, deduplicated by
+        `ze.utils.url_key`.
+        """
+        for url in urls:
+            url = self.canonical_url(url)
+            key = ze.utils.url_key(url)
+            if key in self.discovered:
+                continue
+            self.discovered.add(key)
+
+            if self.crawler.stats.get_value('search/time_to_first_request') is None:
+                self.crawler.stats.set_value('search/time_to_first_request',
+                                             time.time() - self.start_time)
+            yield scrapy.Request(url)
+
+    def canonical_url(self, url):
+        return ze.utils.canonical_url(url, self.settings.getdict('URL_CANONICAL_RULES'))
+
+    def searched(self, _, count):
+        self.searching = None
+        self.logger.info('%d unique links found by %d searches' % (len(self.discovered), count))
+
+    def spider_idle(self, spider):
+        if self.searching is not None:
+            raise DontCloseSpider
+
+    def close_selector_stats(self, spider):
+        min_tries = self.settings.getint('SELECTOR_STATS_MIN_TRIES', 100)
+        unused = list(self.selector_stats.unused(self.name, self.parses, min_tries))
+        for field, css, tries in unused:
+            self.logger.warning('Selector %r of %s never matched (%d tries)' % (css, field, tries))
+        self.crawler.stats.set_value('selectors/unused', len(unused))
+        self.selector_stats.save()
+
+    def item_scraped(self, item, spider):
+        if self.start_time and self.crawler.stats.get_value('time_to_first_item') is None:
+            self.crawler.stats.set_value('time_to_first_item', time.time() - self.start_time)
+
+    def cached_search_results(self, args):
+        """
+        Links of the search found in the cache for all its pages, up to the
+        first one without results, or None.
+        """
+        if self.search_cache is None:
+            return None
+        urls = []
+        for key in search_cache_keys(args):
+            page = self.search_cache.get(key)
+            if page is None:
+                self.crawler.stats.inc_value('search/cache_misses')
+                return None
+            urls.extend(page)
+            if not page:
+                break
+        self.crawler.stats.inc_value('search/cache_hits')
+        self.logger.info('Search results of `%s` found in cache' % args['query'])
+        return urls
+
+    def get_urls_from_search_engine(self, args={}, queries=None, page=1):
+        """
+        Links of the SERP `page` of each query (`args['query']` by default),
+        by query. Pages with results are cached.
+
         args['config']['last_update']
             Applications: tbm=app
             Blogs: tbm=blg
@@ -65,21 +260,19 @@ class ZeSpider(scrapy.Spider):
             Shopping: tbm=shop
             Video: tbm=vid
         """ 
-    
-        def fix_urls(url):
-            url = url.replace('/amp/', '') if '/amp/' in url else url
-            url = urllib.parse.urljoin('http://', url) if 'http://' not in url else url
-            return url
-        
+
+        engine = args.get('engine', 'google')
+        queries = queries or [args['query']]
+        directory = tempfile.mkdtemp(prefix='ze-search-')
+
         # TODO: implement quantity arg
-        if args.get('engine', 'google') == 'google':
+        if engine == 'google':
             config = {
                 'use_own_ip': 'True',
-                'keywords': [args['query']],
+                'keyword_file': scrape_jobs_file(directory, queries, page),
                 'google_search_url': 'https://www.google.com/search?tbs=qdr:%s&' % args.get('last_update', 'w'),
                 'num_results_per_page': args.get('results_per_page', 50),
-                'num_pages_for_keyword': args.get('pages', 2),
-                'num_workers': 1,
+                'num_workers': min(self.settings.getint('SEARCH_CONCURRENCY', 4), len(queries)),
                 'search_engines': ['google',],
                 'search_type': 'normal',
                 'scrape_method': 'http',
@@ -91,37 +284,145 @@ class ZeSpider(scrapy.Spider):
         
         self.logger.info('Google Search scrapping start with this configuration: %s' % config)
         
+        # Imported on the first search, it loads SQLAlchemy and selenium
+        import GoogleScraper
         try:
             search = GoogleScraper.scrape_with_config(config)
         except GoogleScraper.GoogleSearchError as e:
             self.logger.error(str(e))
+            return {}
+        finally:
+            # The keyword file is imported from its directory, added to sys.path
+            sys.modules.pop(os.path.basename(config['keyword_file'])[:-3], None)
+            if directory in sys.path:
+                sys.path.remove(directory)
+            shutil.rmtree(directory, ignore_errors=True)
         
-        urls = []
+        found = dict((query, []) for query in queries)
         for serp in search.serps:
-            [urls.append(fix_urls(r.link)) for r in serp.links]
+            # Links are made canonical when scheduled, see `requests_from_urls`
+            found.setdefault(serp.query, []).extend(r.link for r in serp.links)
+
+        # A query without SERP was blocked, it is not cached
+        if self.search_cache is not None:
+            for query in set(serp.query for serp in search.serps):
+                self.search_cache.set(search_cache_key(dict(args, query=query), page), found[query])
         
-        self.logger.info('Google Search scrapped with success: %d links extracted' % len(urls))
+        urls = [url for query in queries for url in found[query]]
+        self.logger.info('Google Search page %d scrapped with success: %d links extracted' % (page, len(urls)))
         self.logger.info('List of link extracted from Google Search: %s' % urls)
         
-        return urls
+        return found
 
     def make_request_from_onw_search_engine(self, args={}):
-        raise NotImplementedError
+        """
+        Requests of the news sitemaps and feeds of the portal (`args['feeds']`,
+        `feeds`, or robots.txt of each allowed domain), read by `parse_feed`.
+        """
+        feeds = args.get('feeds') or self.feeds or \
+            ['http://%s/robots.txt' % d for d in self.allowed_domains]
+        since = time.time() - last_update_seconds(args.get('last_update', 'w'))
+
+        for url in feeds:
+            yield self.feed_request(url, since)
+
+    def feed_request(self, url, since):
+        # Feeds can be hosted out of allowed_domains
+        return scrapy.Request(url, callback=self.parse_feed, dont_filter=True,
+                              priority=1, meta={'since': since})
+
+    def parse_feed(self, response):
+        """
+        Follow the sitemaps of robots.txt and sitemap indexes, and crawl the
+        articles of sitemaps and feeds updated since `meta['since']`. Entries
+        without date are kept.
+        """
+        since = response.meta['since']
+        stats = self.crawler.stats
+        started = time.time()
+
+        try:
+            if response.url.endswith('/robots.txt'):
+                for url in sitemap_urls_from_robots(response.text, base_url=response.url):
+                    yield self.feed_request(url, since)
+                return
+
+            body = gunzip(response.body) if response.body[:2] == b'\x1f\x8b' else response.body
+            for kind, url, timestamp in iter_feed(body):
+                stats.inc_value('search/own/%s_count' % kind)
+                if timestamp is not None and timestamp < since:
+                    stats.inc_value('search/own/outdated_count')
+                    continue
+                if kind == 'sitemap':
+                    yield self.feed_request(url, since)
+                else:
+                    for request in self.requests_from_urls([url]):
+                        yield request
+        finally:
+            if self.stage_timer is not None:
+                self.stage_timer.since('search', started, response.url)
+
+    @classmethod
+    def extraction_plan(cls):
+        """`parses` compiled once by spider class, see `ze.items.plan`."""
+        if '_extraction_plan' not in cls.__dict__:
+            cls._extraction_plan = compile_parses(cls.parses)
+        return cls._extraction_plan
 
     def parse(self, response):
-        for p in self.parses:
-            for i, a in p.items():
-                ItemClass = ze.utils.import_class(i)
-                load_method = self[a.get('load_method')] if a.get('load_method') else self.load_item
-                yield load_method(response, ItemClass, a)
-
-    def load_item(self, response, ItemClass=None, args=None):
-        il = ze.items.ItemLoader(item=ItemClass(), response=response)
+        for plan in self.plan:
+            if plan.load_method:
+                yield getattr(self, plan.load_method)(response, plan.item_class, plan.args)
+            else:
+                yield self.load_item(response, plan.item_class, plan.args, plan)
+
+    def load_item(self, response, ItemClass=None, args=None, plan=None):
+        started = time.time()
+        plan = plan or compile_item(ItemClass, args)
+        body = self.raw_article_body(response, dict(plan.fields).get('articleBody', ())) \
+            if self.settings.getbool('FINGERPRINTS_ENABLED') else None
+        if body is not None:
+            # Unchanged articles fetched again are not processed, see FingerprintMiddleware
+            response.meta['raw_hash'] = content_hash(body)
+            known = response.meta.get('fingerprint')
+            if known and known['hash'] == response.meta['raw_hash']:
+                self.crawler.stats.inc_value('fingerprints/hash_hits')
+                self.crawler.signals.send_catch_log(article_unchanged, response=response, spider=self)
+                return None
+
+        il = ze.items.ItemLoader(item=ItemClass(), response=response,
+            crawler_stats=self.crawler.stats,
+            allowed_domains=self.allowed_domains,
+            media=response.meta.get('media', {}),
+            clean_html_backend=self.settings.get('CLEAN_HTML_BACKEND', 'bs4'),
+            deferred_processing=self.settings.getbool('PROCESS_POOL_ENABLED'),
+            stage_timer=self.stage_timer)
         
-        for field, selectors in args['fields'].items():
-            for i, s in enumerate(selectors):
-                il.add_css(field, s) if i == 0 else il.add_fallback_css(field, s)
+        for field, selectors in plan.fields:
+            if self.selector_stats is None:
+                for i, s in enumerate(selectors):
+                    il.add_compiled_css(field, s) if i == 0 else il.add_fallback_compiled_css(field, s)
+                continue
+            # Deferred processing chooses the fallback later, every selector
+            # is tried and its hits are counted on the values not processed
+            for i, s in enumerate(self.selector_stats.order(self.name, field, selectors)):
+                values = il.add_compiled_css(field, s) if i == 0 else il.add_fallback_compiled_css(field, s)
+                hit = any(values) if il.context['deferred_processing'] else \
+                    any(il.get_collected_values(field))
+                self.selector_stats.record(self.name, field, s.css, hit)
+                if hit and not il.context['deferred_processing']:
+                    break
         
-        il.add_value('url', response.url)
+        il.add_value('url', self.canonical_url(response.url))
+
+        item = il.load_pending_item() if il.context['deferred_processing'] else il.load_item()
+        if self.stage_timer is not None:
+            self.stage_timer.since('load_item', started, response.url)
+        return item
 
-        return il.load_item()
\ No newline at end of file
+    def raw_article_body(self, response, selectors):
+        for selector in selectors:
+            values = selector.select(response.selector.root)
+            if values:
+                return serialize(values[0])
+        return None
@@ -1,11 +1,19 @@
 # -*- coding: utf-8 -*-
 
+import json
+from scrapy import signals
+from scrapy.http import Request
+from scrapy.utils.project import data_path
 from ze.spiders import ZeSpider
+from ze.processors.html import estadao_media_key
+from ze.utils.cache import TTLCache
 
 class EstadaoSpider(ZeSpider):
 
     name = 'estadao'
     allowed_domains = ['estadao.com.br']
+    custom_settings = {'ADAPTIVE_CONCURRENCY_MAX': 32}
+    media_url = 'http://mdw-mm.estadao.com.br/middlewareAgile/rest/conteudo?tipo_midia={tipo}&idAgile={id}&produto=estadao'
     parses = [{
         "ze.items.creativework.ArticleItem": {
             "fields": { 
@@ -45,3 +53,84 @@ class EstadaoSpider(ZeSpider):
             }
         }
     }]
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super(EstadaoSpider, cls).from_crawler(crawler, *args, **kwargs)
+        spider.media_url = crawler.settings.get('ESTADAO_MEDIA_URL') or cls.media_url
+        spider.media_cache = TTLCache(
+            crawler.settings.get('MEDIA_CACHE_PATH') or data_path('media.db'),
+            crawler.settings.getint('MEDIA_CACHE_TTL'))
+        crawler.signals.connect(spider.media_cache.close, signal=signals.spider_closed)
+        return spider
+
+    def parse(self, response):
+        """
+        Resolve the media of the `[data-config]` elements of the article body
+        through the downloader, one sub-request at a time, before loading the
+        item. Resolved media are kept in the persistent cache.
+        """
+        media = response.meta.setdefault('media', {})
+
+        for data_config in self.media_configs(response):
+            key = estadao_media_key(data_config)
+            if key in media:
+                continue
+
+            cached = self.media_cache.get(key)
+            if cached is not None:
+                self.crawler.stats.inc_value('estadao/media/cache_hits')
+                media[key] = cached
+                continue
+
+            self.crawler.stats.inc_value('estadao/media/requests')
+            yield Request(self.media_url.format(**json.loads(data_config)),
+                callback=self.parse_media, errback=self.media_failed,
+                dont_filter=True, priority=1,
+                meta={'article': response, 'media_key': key})
+            return
+
+        for item in super(EstadaoSpider, self).parse(response):
+            yield item
+
+    def media_configs(self, response):
+        for css in self.parses[0]['ze.items.creativework.ArticleItem']['fields']['articleBody']:
+            body = response.css(css)
+            if body:
+                return body[0].css('[data-config]::attr(data-config)').extract()
+        return []
+
+    def parse_media(self, response):
+        article, key = response.meta['article'], response.meta['media_key']
+        try:
+            results = json.loads(response.text)['resultadoConteudo']['conteudos']
+
+            img_src = ''
+            for presset in results[0]['pressets']:
+                if presset['class'] == 'full':
+                    img_src = presset['file']
+                    break
+
+            media = {
+                'src': img_src,
+                'titulo': results[0]['titulo'],
+                'credito': results[0]['credito'],
+            }
+        except (ValueError, KeyError, IndexError) as e:
+            self.logger.warning('Invalid Estadão media %s: %s' % (key, e))
+            self.crawler.stats.inc_value('estadao/media/errors')
+            media = None
+        else:
+            self.media_cache.set(key, media)
+        article.meta['media'][key] = media
+
+        return self.parse(article)
+
+    def media_failed(self, failure):
+        article, key = failure.request.meta['article'], failure.request.meta['media_key']
+        self.logger.warning('Failed to resolve Estadão media %s: %s' % (key, failure.value))
+        self.crawler.stats.inc_value('estadao/media/errors')
+        # Unresolved media are kept as is by CleanHTML
+        article.meta['media'][key] = None
+
+        return self.parse(article)
@@ -6,6 +6,7 @@ class FolhaDeSaoPauloSpider(ZeSpider):
 
     name = 'folhadesp'
     allowed_domains = ['folha.uol.com.br']
+    feeds = ['http://feeds.folha.uol.com.br/emcimadahora/rss091.xml']
     parses = [{
         "ze.items.creativework.ArticleItem": {
             "fields": { 
@@ -6,6 +6,7 @@ class G1Spider(ZeSpider):
 
     name = 'g1'
     allowed_domains = ['g1.globo.com']
+    feeds = ['http://g1.globo.com/dynamo/rss2.xml']
     parses = [{
         "ze.items.creativework.ArticleItem": {
             "fields": { 
@@ -6,6 +6,8 @@ class UolSpider(ZeSpider):
 
     name = 'uol'
     allowed_domains = ['uol.com.br']
+    custom_settings = {'ADAPTIVE_CONCURRENCY_MAX': 32}
+    feeds = ['http://rss.uol.com.br/feed/noticias.xml']
     parses = [{
         "ze.items.creativework.ArticleItem": {
             "fields": {
@@ -1,6 +1,9 @@
+import re
 import sys
+import fnmatch
 import importlib
 import difflib
+import urllib.parse
 from pprint import pprint
 
 def import_class(class_full_path):
@@ -11,3 +14,87 @@ def import_class(class_full_path):
 def diff_str(str1='', str2=''):
     splitlines = lambda s: s.splitlines(keepends=True)
     return list(difflib.Differ().compare(splitlines(str1), splitlines(str2)))
+
+def url_key(url):
+    """
+    Key identifying the page of `url`: host in lower case, path and query,
+    without scheme, default port, fragment and trailing slash.
+    """
+    parts = urllib.parse.urlsplit(url.strip())
+    host = (parts.hostname or '').lower()
+    if parts.port and parts.port not in (80, 443):
+        host = '%s:%d' % (host, parts.port)
+    key = host + (parts.path.rstrip('/') or '')
+    return key + '?' + parts.query if parts.query else key
+
+DEFAULT_URL_RULES = {
+    # Scheme of the canonical URL, None keeps the original
+    'scheme': None,
+    # Canonical host by host, e.g. {'m.site.com.br': 'www1.site.com.br'}
+    'hosts': {},
+    # Mobile host prefixes, replaced by `mobile_host_prefix` if not in `hosts`:
+    # m.noticias.site.com.br is noticias.site.com.br, www. hosts are mapped
+    # in `hosts`
+    'mobile_prefixes': ('m.', 'mobile.'),
+    'mobile_host_prefix': '',
+    # Query parameters removed, shell-style patterns
+    'strip_params': ('utm_*', 'fbclid', 'gclid', 'xtor', 'cmpid'),
+    # Remove /amp path segments and amp query parameters
+    'amp': True,
+    # False removes the trailing slash, True adds it (to paths without
+    # extension) and None keeps it
+    'trailing_slash': False,
+}
+
+def url_rules(host, rules):
+    """
+    Canonicalization rules of `host`: the defaults updated by `rules['default']`
+    and by the rules of the longest domain of `rules` matching `host`.
+    """
+    merged = dict(DEFAULT_URL_RULES)
+    merged.update(rules.get('default', {}))
+    domains = [d for d in rules if d != 'default' and (host == d or host.endswith('.' + d))]
+    if domains:
+        merged.update(rules[max(domains, key=len)])
+    return merged
+
+def canonical_url(url, rules={}):
+    """
+    Canonical form of `url`, collapsing the variants of a page (scheme, mobile
+    host, AMP, tracking parameters, fragment and trailing slash) with the
+    `rules` by domain of URL_CANONICAL_RULES, see `DEFAULT_URL_RULES`.
+    """
+    url = url.strip()
+    if '://' not in url:
+        url = 'http://' + url.lstrip('/')
+    parts = urllib.parse.urlsplit(url)
+    host = (parts.hostname or '').lower()
+    rule = url_rules(host, rules)
+
+    if host in rule['hosts']:
+        host = rule['hosts'][host]
+    else:
+        for prefix in rule['mobile_prefixes']:
+            if host.startswith(prefix):
+                host = rule['mobile_host_prefix'] + host[len(prefix):]
+                break
+    if parts.port and parts.port not in (80, 443):
+        host = '%s:%d' % (host, parts.port)
+
+    path = parts.path
+    # Parameters are filtered without decoding, the others are kept as they are
+    params = [p for p in parts.query.split('&') if p]
+    if rule['amp']:
+        path = re.sub(r'/amp(?=/|$)', '', path)
+        params = [p for p in params if p not in ('amp', 'amp=1', 'outputType=amp')]
+    params = [p for p in params if not any(fnmatch.fnmatchcase(p.split('=', 1)[0].lower(), pattern)
+                                           for pattern in rule['strip_params'])]
+
+    if rule['trailing_slash'] is False:
+        path = path.rstrip('/')
+    elif rule['trailing_slash'] and not path.endswith('/') and \
+            '.' not in path.rsplit('/', 1)[-1]:
+        path += '/'
+
+    return urllib.parse.urlunsplit((rule['scheme'] or parts.scheme.lower(), host,
+                                    path or '/', '&'.join(params), ''))
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import sqlite3
+import threading
+
+
+class TTLCache(object):
+    """
+    Persistent key/value cache, values are JSON serializable and expire after
+    `ttl` seconds. Stored in a SQLite file shared between runs, can be used
+    from many threads.
+    """
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS cache '
+                        '(key TEXT PRIMARY KEY, value TEXT, expires REAL)')
+        self.db.commit()
+
+    def get(self, key, default=None):
+        with self.lock:
+            row = self.db.execute('SELECT value, expires FROM cache WHERE key = ?',
+                                  (key,)).fetchone()
+        if row is None or row[1] < time.time():
+            return default
+        return json.loads(row[0])
+
+    def set(self, key, value):
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)',
+                            (key, json.dumps(value), time.time() + self.ttl))
+            self.db.commit()
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def purge(self):
+        """Remove the expired entries."""
+        with self.lock:
+            self.db.execute('DELETE FROM cache WHERE expires < ?', (time.time(),))
+            self.db.commit()
+
+    def close(self):
+        self.purge()
+        self.db.close()
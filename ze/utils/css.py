@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+"""
+Small CSS selector compiler for BeautifulSoup tags.
+
+`BeautifulSoup.select` walks the whole tree on every call. The selectors in
+here are parsed once and only answer "does this tag match?", so a caller can
+walk the tree a single time and test every tag against many selectors.
+
+Supported syntax is the subset `bs4.select` understands: type, `#id`,
+`.class`, `[attr]`, `[attr=v]`, `[attr~=v]`, `[attr|=v]`, `[attr^=v]`,
+`[attr$=v]`, `[attr*=v]` and the ` `, `>`, `+` and `~` combinators.
+"""
+
+import re
+
+_TOKEN_RE = re.compile(r'''
+    \s*(?P<combinator>[>+~])\s*
+    | (?P<descendant>\s+)
+    | (?P<name>[\w-]+|\*)
+    | \#(?P<id>[\w-]+)
+    | \.(?P<cls>[\w-]+)
+    | \[\s*(?P<attr>[\w:-]+)\s*
+        (?:(?P<op>[~|^$*]?=)\s*(?P<value>"[^"]*"|'[^']*'|[^\]\s]+)\s*)?
+      \]
+''', re.X)
+
+_ATTR_OPS = {
+    None: lambda v, e: True,
+    '=': lambda v, e: v == e,
+    '~=': lambda v, e: e in v.split(),
+    '|=': lambda v, e: v == e or v.startswith(e + '-'),
+    '^=': lambda v, e: v.startswith(e),
+    '$=': lambda v, e: v.endswith(e),
+    '*=': lambda v, e: e in v,
+}
+
+
+class Compound(object):
+    """A run of simple selectors with no combinator between them, e.g. `p.lead[id]`."""
+
+    def __init__(self):
+        self.name = None
+        self.id = None
+        self.classes = []
+        self.attrs = []
+
+    def match(self, tag):
+        if self.name is not None and tag.name != self.name:
+            return False
+        attrs = tag.attrs
+        if self.id is not None and attrs.get('id') != self.id:
+            return False
+        if self.classes:
+            classes = attrs.get('class') or ()
+            for c in self.classes:
+                if c not in classes:
+                    return False
+        for name, op, expected in self.attrs:
+            if name not in attrs:
+                return False
+            value = attrs[name]
+            if isinstance(value, list):
+                value = ' '.join(value)
+            if not _ATTR_OPS[op](value, expected):
+                return False
+        return True
+
+    def key(self):
+        """Cheapest attribute to index this compound by in a dispatch table."""
+        if self.id is not None:
+            return ('id', self.id)
+        if self.classes:
+            return ('class', self.classes[0])
+        if self.name is not None:
+            return ('name', self.name)
+        return None
+
+
+class CompiledSelector(object):
+    """One selector of a group, matched right to left against a tag."""
+
+    def __init__(self, selector):
+        self.selector = selector
+        # [(combinator to the previous compound, compound), ...]
+        self.parts = []
+        self._parse(selector.strip())
+
+    def _parse(self, selector):
+        compound, combinator, pos = None, None, 0
+        while pos < len(selector):
+            m = _TOKEN_RE.match(selector, pos)
+            if not m or m.end() == pos:
+                raise ValueError('Unsupported CSS selector: %r' % self.selector)
+            pos = m.end()
+
+            if m.group('combinator') or m.group('descendant'):
+                if compound is None:
+                    raise ValueError('Unsupported CSS selector: %r' % self.selector)
+                combinator = m.group('combinator') or ' '
+                compound = None
+                continue
+
+            if compound is None:
+                compound = Compound()
+                self.parts.append((combinator, compound))
+                combinator = None
+
+            if m.group('name'):
+                compound.name = None if m.group('name') == '*' else m.group('name')
+            elif m.group('id'):
+                compound.id = m.group('id')
+            elif m.group('cls'):
+                compound.classes.append(m.group('cls'))
+            else:
+                value = m.group('value')
+                if value and value[0] in '"\'':
+                    value = value[1:-1]
+                compound.attrs.append((m.group('attr'), m.group('op'), value))
+
+        if compound is None:
+            raise ValueError('Unsupported CSS selector: %r' % self.selector)
+
+    def key(self):
+        return self.parts[-1][1].key()
+
+    def match(self, tag):
+        return self._match(tag, len(self.parts) - 1)
+
+    def _match(self, tag, i):
+        combinator, compound = self.parts[i]
+        if not compound.match(tag):
+            return False
+        if i == 0:
+            return True
+
+        if combinator == ' ':
+            for parent in _parents(tag):
+                if self._match(parent, i - 1):
+                    return True
+        elif combinator == '>':
+            parent = tag.parent
+            return parent is not None and parent.parent is not None \
+                and self._match(parent, i - 1)
+        elif combinator == '+':
+            sibling = tag.find_previous_sibling(True)
+            return sibling is not None and self._match(sibling, i - 1)
+        elif combinator == '~':
+            for sibling in tag.find_previous_siblings(True):
+                if self._match(sibling, i - 1):
+                    return True
+        return False
+
+
+def _parents(tag):
+    # The BeautifulSoup object itself is the last parent and never matches
+    parent = tag.parent
+    while parent is not None and parent.parent is not None:
+        yield parent
+        parent = parent.parent
+
+
+def compile_selector(selector):
+    """Compile a selector group (`a, b > c`) into a list of `CompiledSelector`."""
+    return [CompiledSelector(s) for s in selector.split(',') if s.strip()]
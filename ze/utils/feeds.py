@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+import io
+import re
+import datetime
+import email.utils
+from lxml import etree
+from ze.processors.common import CommonProcessor
+
+ENTRY_TAGS = ('sitemap', 'url', 'item', 'entry')
+DATE_TAGS = ('lastmod', 'publication_date', 'pubDate', 'date', 'updated', 'published')
+
+# Google `qdr` values: h, d, w, m, y, optionally with a count (e.g. 24h, d3)
+LAST_UPDATE_RE = re.compile(r'^(\d*)\s*([hdwmy])\s*(\d*)$', re.I)
+LAST_UPDATE_SECONDS = {
+    'h': 60 * 60,
+    'd': 24 * 60 * 60,
+    'w': 7 * 24 * 60 * 60,
+    'm': 31 * 24 * 60 * 60,
+    'y': 366 * 24 * 60 * 60,
+}
+
+
+def last_update_seconds(value):
+    """Seconds of a `last_update` search window, e.g. `w`, `24H` or `d3`."""
+    m = LAST_UPDATE_RE.match(str(value).strip())
+    if not m:
+        raise ValueError('last_update %s is not valid, use h, d, w, m or y' % value)
+    count = int(m.group(1) or m.group(3) or 1)
+    return count * LAST_UPDATE_SECONDS[m.group(2).lower()]
+
+
+def feed_timestamp(value):
+    """POSIX time of an ISO 8601 (sitemaps, Atom) or RFC 822 (RSS) date."""
+    value = (value or '').strip()
+    if not value:
+        return None
+    date = CommonProcessor.parse_iso_date_time(value)
+    if date is None:
+        try:
+            date = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError, IndexError):
+            return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return date.timestamp()
+
+
+def iter_feed(body):
+    """
+    Parse incrementally a sitemap index, sitemap (news sitemaps included), RSS
+    or Atom `body`, yielding `(kind, url, timestamp)` for each entry: kind is
+    `sitemap` for the sitemaps of an index and `page` otherwise, timestamp is
+    the most recent of its dates or None.
+    """
+    for _, el in etree.iterparse(io.BytesIO(body), events=('end',), recover=True,
+                                 resolve_entities=False, no_network=True):
+        if not isinstance(el.tag, str) or etree.QName(el).localname not in ENTRY_TAGS:
+            continue
+
+        tag = etree.QName(el).localname
+        url, timestamp = None, None
+        for child in el.iterdescendants():
+            if not isinstance(child.tag, str):
+                continue
+            name = etree.QName(child).localname
+            if name == 'loc' or (name == 'link' and child.text and child.text.strip()):
+                url = url or child.text.strip()
+            elif name == 'link' and child.get('rel', 'alternate') == 'alternate':
+                url = url or child.get('href')
+            elif name in DATE_TAGS:
+                date = feed_timestamp(child.text)
+                if date is not None and (timestamp is None or date > timestamp):
+                    timestamp = date
+
+        if url:
+            yield ('sitemap' if tag == 'sitemap' else 'page'), url, timestamp
+
+        # Entries already parsed are freed
+        el.clear()
+        while el.getprevious() is not None:
+            del el.getparent()[0]
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+import os
+import math
+import time
+import struct
+import hashlib
+import sqlite3
+import threading
+import logging
+logger = logging.getLogger(__name__)
+
+# Sent by the spiders with the `response` of an article fetched again whose
+# raw body has the hash stored, see FingerprintMiddleware
+article_unchanged = object()
+
+
+class BloomFilter(object):
+    """
+    In memory set of strings with false positives (at `error_rate` when
+    holding `capacity` keys) and no false negatives.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def positions(self, key):
+        # Double hashing, k positions from the two halves of one digest
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(key.encode('utf-8')).digest())
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for p in self.positions(key):
+            self.bits[p >> 3] |= 1 << (p & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[p >> 3] & (1 << (p & 7)) for p in self.positions(key))
+
+
+def content_hash(value):
+    return hashlib.sha1((value or '').encode('utf-8')).hexdigest()
+
+
+class FingerprintStore(object):
+    """
+    Content hash, dateModified, last seen time and HTTP validators (ETag and
+    Last-Modified) of the articles scraped, by canonical URL (see
+    `ze.utils.url_key`), in a SQLite file shared by all the spiders and runs.
+    Each write is committed at once (in WAL mode, without fsync), so other
+    crawls are never locked out of the file. With `bloom_capacity`, a Bloom
+    filter loaded from the file answers for most of the unknown URLs without
+    a query.
+    """
+
+    def __init__(self, path, bloom_capacity=None, bloom_error_rate=0.01):
+        self.path = path
+        if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS fingerprints '
+                        '(key TEXT PRIMARY KEY, hash TEXT, date_modified TEXT, last_seen REAL, '
+                        'etag TEXT, last_modified TEXT)')
+        self.db.commit()
+
+        self.bloom = None
+        if bloom_capacity:
+            self.bloom = BloomFilter(bloom_capacity, bloom_error_rate)
+            count = 0
+            for (key,) in self.db.execute('SELECT key FROM fingerprints'):
+                self.bloom.add(key)
+                count += 1
+            logger.info('%d fingerprints loaded from %s' % (count, path))
+
+    def get(self, key):
+        if self.bloom is not None and key not in self.bloom:
+            return None
+        with self.lock:
+            row = self.db.execute('SELECT hash, date_modified, last_seen, etag, last_modified '
+                                  'FROM fingerprints WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(('hash', 'date_modified', 'last_seen', 'etag', 'last_modified'), row))
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def set(self, key, hash, date_modified=None, etag=None, last_modified=None):
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO fingerprints '
+                            '(key, hash, date_modified, last_seen, etag, last_modified) '
+                            'VALUES (?, ?, ?, ?, ?, ?)',
+                            (key, hash, date_modified, time.time(), etag, last_modified))
+            self.db.commit()
+        if self.bloom is not None:
+            self.bloom.add(key)
+
+    def touch(self, key):
+        """Set the last seen time of an unchanged article to now."""
+        with self.lock:
+            self.db.execute('UPDATE fingerprints SET last_seen = ? WHERE key = ?', (time.time(), key))
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+import time
+import heapq
+import random
+
+# Score of the proxies never used, optimistic so they are tried
+INITIAL_STATE = {'latency': 1.0, 'success': 0.5, 'failures': 0, 'dead_until': 0}
+
+
+class ProxyPool(object):
+    """
+    Proxies picked at random, weighted by their score: the EWMA of their
+    success over the EWMA of their latency. A failing proxy (error or ban) is
+    not picked for a backoff that doubles on each consecutive failure, up to
+    `max_backoff` seconds. `scores` are the states dumped by a previous run.
+
+    Picks take O(log N): the scores of the proxies are kept in a Fenwick tree
+    of partial sums (0 while on backoff), and the proxies on backoff in a
+    heap by end of backoff, put back in the tree when it is over.
+    """
+
+    def __init__(self, proxies, scores=None, alpha=0.3, backoff=60, max_backoff=3600):
+        self.alpha = alpha
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.proxies = dict((proxy, dict(INITIAL_STATE)) for proxy in proxies)
+        for proxy, state in (scores or {}).items():
+            if proxy in self.proxies:
+                self.proxies[proxy].update(state)
+
+        self.order = list(self.proxies)
+        self.index = dict((proxy, i) for i, proxy in enumerate(self.order))
+        self.weights = [0.0] * len(self.order)
+        # (dead_until, proxy), entries of earlier backoffs are skipped
+        self.backoffs = []
+        now = time.time()
+        for i, proxy in enumerate(self.order):
+            state = self.proxies[proxy]
+            if state['dead_until'] <= now:
+                self.weights[i] = self.score(state)
+            else:
+                self.backoffs.append((state['dead_until'], proxy))
+        heapq.heapify(self.backoffs)
+        self.build()
+
+    def score(self, state):
+        return state['success'] / max(state['latency'], 0.01)
+
+    def build(self):
+        """Fenwick tree of `weights`: `tree[i]` sums the weights of (i - lowbit(i), i]."""
+        self.tree = [0.0] + self.weights
+        for i in range(1, len(self.tree)):
+            parent = i + (i & -i)
+            if parent < len(self.tree):
+                self.tree[parent] += self.tree[i]
+
+    def update(self, proxy, weight):
+        i = self.index[proxy]
+        delta = weight - self.weights[i]
+        self.weights[i] = weight
+        i += 1
+        while i < len(self.tree):
+            self.tree[i] += delta
+            i += i & -i
+
+    def total(self):
+        i, total = len(self.weights), 0.0
+        while i:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+    def find(self, r):
+        """Index of the first proxy whose cumulative weight is above `r`."""
+        i, bit = 0, 1 << len(self.weights).bit_length()
+        while bit:
+            if i + bit < len(self.tree) and self.tree[i + bit] <= r:
+                i += bit
+                r -= self.tree[i]
+            bit >>= 1
+        return i
+
+    def revive(self, now):
+        while self.backoffs and self.backoffs[0][0] <= now:
+            _, proxy = heapq.heappop(self.backoffs)
+            state = self.proxies[proxy]
+            if state['dead_until'] <= now:
+                self.update(proxy, self.score(state))
+
+    def alive(self):
+        now = time.time()
+        return [proxy for proxy, state in self.proxies.items() if state['dead_until'] <= now]
+
+    def pick(self):
+        self.revive(time.time())
+        total = self.total()
+        if total <= 0:
+            return None
+
+        i = self.find(random.random() * total)
+        if i >= len(self.weights) or not self.weights[i]:
+            # Rounding errors accumulated by the updates of the sums
+            self.build()
+            i = min(self.find(random.random() * self.total()), len(self.weights) - 1)
+        return self.order[i]
+
+    def success(self, proxy, latency):
+        state = self.proxies[proxy]
+        state['latency'] = (1 - self.alpha) * state['latency'] + self.alpha * latency
+        state['success'] = (1 - self.alpha) * state['success'] + self.alpha
+        state['failures'] = 0
+        if state['dead_until'] <= time.time():
+            self.update(proxy, self.score(state))
+
+    def failure(self, proxy):
+        """Put `proxy` on backoff, returns its duration in seconds."""
+        state = self.proxies[proxy]
+        state['success'] = (1 - self.alpha) * state['success']
+        state['failures'] += 1
+        backoff = min(self.backoff * 2 ** (state['failures'] - 1), self.max_backoff)
+        state['dead_until'] = time.time() + backoff
+        self.update(proxy, 0.0)
+        heapq.heappush(self.backoffs, (state['dead_until'], proxy))
+        return backoff
+
+    def dump(self):
+        return dict((proxy, dict(state)) for proxy, state in self.proxies.items())
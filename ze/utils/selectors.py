@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import logging
+logger = logging.getLogger(__name__)
+
+
+class SelectorStats(object):
+    """
+    Number of times each fallback selector of the `parses` was tried and
+    matched (gave a value to its field), by spider and field. Saved in a JSON
+    file between runs, replaced at once.
+
+    With `reorder`, `order` sorts the selectors of a field by their rate of
+    matches (Laplace smoothed, so new selectors are tried), recomputed every
+    `interval` records. Stable: selectors with the same rate keep the order of
+    the `parses`.
+    """
+
+    def __init__(self, path, reorder=False, interval=100):
+        self.path = path
+        self.reorder = reorder
+        self.interval = interval
+        self.records = 0
+        self.orders = {}
+        # {spider: {field: {css: [tries, hits]}}}
+        self.counts = {}
+        if os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.counts = json.load(f)
+            except ValueError as e:
+                logger.warning('Selectors stats %s not loaded: %s' % (path, e))
+
+    def record(self, spider, field, css, hit):
+        counts = self.counts.setdefault(spider, {}).setdefault(field, {}).setdefault(css, [0, 0])
+        counts[0] += 1
+        counts[1] += bool(hit)
+        self.records += 1
+        if self.records % self.interval == 0:
+            self.orders.clear()
+
+    def rate(self, spider, field, css):
+        tries, hits = self.counts.get(spider, {}).get(field, {}).get(css, (0, 0))
+        return (hits + 1.0) / (tries + 2.0)
+
+    def order(self, spider, field, selectors):
+        """`selectors` (having a `css`) in the order to try them."""
+        if not self.reorder or len(selectors) < 2:
+            return selectors
+        key = (spider, field, selectors)
+        if key not in self.orders:
+            self.orders[key] = tuple(sorted(
+                selectors, key=lambda s: -self.rate(spider, field, s.css)))
+        return self.orders[key]
+
+    def unused(self, spider, parses, min_tries=100):
+        """
+        Selectors of `parses` (field, css, tries) that never matched in at
+        least `min_tries` tries, or never tried while their field was tried
+        `min_tries` times (always shadowed by another selector).
+        """
+        fields = self.counts.get(spider, {})
+        for p in parses:
+            for args in p.values():
+                for field, selectors in args['fields'].items():
+                    counts = fields.get(field, {})
+                    field_tries = max([tries for tries, _ in counts.values()] or [0])
+                    for css in selectors:
+                        tries, hits = counts.get(css, (0, 0))
+                        if not hits and max(tries, field_tries) >= min_tries:
+                            yield field, css, tries
+
+    def save(self):
+        if os.path.dirname(self.path) and not os.path.exists(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(self.counts, f)
+        os.replace(self.path + '.tmp', self.path)
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+import os
+import glob
+import gzip
+import zlib
+import logging
+logger = logging.getLogger(__name__)
+
+
+class Spool(object):
+    """
+    Append-only on-disk queue of records (bytes without new lines), stored as
+    gzip compressed JSON lines segments in `path`.
+
+    Records are appended to an open segment, synced to disk every
+    `fsync_records` records, and the segment is sealed after
+    `segment_records` records or by `seal()`. Sealed segments are read and
+    removed by the consumer, in order. Segments left open by a crash are
+    sealed on start, so they are replayed.
+    """
+
+    def __init__(self, path, segment_records=1000, fsync_records=100):
+        self.path = path
+        self.segment_records = segment_records
+        self.fsync_records = fsync_records
+        self.file = None
+        self.count = 0
+        self.unsynced = 0
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+        for segment in glob.glob(os.path.join(path, '*.open.gz')):
+            os.rename(segment, segment.replace('.open.gz', '.jsonl.gz'))
+        segments = self.sealed()
+        self.seq = int(os.path.basename(segments[-1]).split('.')[0]) + 1 if segments else 0
+
+    def write(self, record):
+        if self.file is None:
+            self.file = gzip.open(self.segment_path('open'), 'ab')
+        self.file.write(record + b'\n')
+        self.count += 1
+        self.unsynced += 1
+
+        if self.count >= self.segment_records:
+            self.seal()
+        elif self.unsynced >= self.fsync_records:
+            self.sync()
+
+    def sync(self):
+        if self.file is not None and self.unsynced:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.unsynced = 0
+
+    def seal(self):
+        """Close the open segment, it can be read by the consumer from now on."""
+        if self.file is None:
+            return
+        self.sync()
+        self.file.close()
+        os.rename(self.segment_path('open'), self.segment_path('jsonl'))
+        self.file = None
+        self.count = 0
+        self.seq += 1
+
+    def segment_path(self, state):
+        return os.path.join(self.path, '%012d.%s.gz' % (self.seq, state))
+
+    def sealed(self):
+        return sorted(glob.glob(os.path.join(self.path, '*.jsonl.gz')))
+
+    def read(self, segment):
+        records = []
+        try:
+            with gzip.open(segment, 'rb') as f:
+                for line in f:
+                    # A line without end was not completely written
+                    if line.endswith(b'\n') and len(line) > 1:
+                        records.append(line[:-1])
+        except (EOFError, zlib.error, OSError) as e:
+            # Segment truncated by a crash, the complete lines are kept
+            logger.warning('Spool segment %s truncated after %d records: %s'
+                           % (segment, len(records), e))
+        return records
+
+    def remove(self, segment):
+        os.remove(segment)
+
+    def close(self):
+        self.seal()
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+# Upper bounds, in seconds, of the histogram buckets
+TIME_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+
+
+def observe(stats, key, value, buckets=TIME_BUCKETS):
+    """
+    Record `value` in the histogram `key` of the crawler stats: cumulative
+    `key/le_<bound>` buckets (`key/le_inf` is the count), `key/sum` and `key/max`.
+    """
+    for bound in buckets:
+        if value <= bound:
+            stats.inc_value('%s/le_%s' % (key, bound))
+    stats.inc_value('%s/le_inf' % key)
+    stats.inc_value('%s/sum' % key, value)
+    stats.max_value('%s/max' % key, value)
+
+
+class StageRecorder(object):
+    """
+    `ze.extensions.timing.StageTimer` of another process: keeps the
+    (stage, seconds) observed, replayed in the timer of the spider.
+    """
+
+    def __init__(self):
+        self.observations = []
+
+    def observe(self, stage, seconds, url=None):
+        self.observations.append((stage, seconds))
+
+    def since(self, stage, started, url=None):
+        self.observe(stage, time.time() - started)
+
+
+class StatsRecorder(object):
+    """
+    Crawler stats of another process: keeps the values incremented, set and
+    maximized, in order, merged in the stats of the crawler by `replay`.
+    """
+
+    def __init__(self):
+        self.changes = []
+
+    def inc_value(self, key, count=1, start=0):
+        self.changes.append(('inc_value', key, count))
+
+    def set_value(self, key, value):
+        self.changes.append(('set_value', key, value))
+
+    def max_value(self, key, value):
+        self.changes.append(('max_value', key, value))
+
+    def min_value(self, key, value):
+        self.changes.append(('min_value', key, value))
+
+
+def replay(stats, changes):
+    """Apply the `changes` kept by a `StatsRecorder` to the crawler `stats`."""
+    for method, key, value in changes:
+        getattr(stats, method)(key, value)
@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+
+import os
+import glob
+import fcntl
+import gzip
+import zlib
+import uuid
+import base64
+import hashlib
+import sqlite3
+import logging
+from collections import namedtuple
+from datetime import datetime
+from twisted.web.http import RESPONSES
+logger = logging.getLogger(__name__)
+
+# Fields of the HTTP block rewritten from the decoded body
+SKIP_HEADERS = (b'content-length', b'content-encoding', b'transfer-encoding')
+
+
+class WarcRecord(namedtuple('WarcRecord', 'fields block')):
+    """WARC record read from a segment: `fields` by name, and the raw block."""
+
+    @property
+    def type(self):
+        return self.fields.get('WARC-Type')
+
+    @property
+    def url(self):
+        return self.fields.get('WARC-Target-URI')
+
+    def http(self):
+        """Status, headers ([(name, value)] as bytes) and body of a `response` record."""
+        head, _, body = self.block.partition(b'\r\n\r\n')
+        lines = head.split(b'\r\n')
+        status = int(lines[0].split(b' ', 2)[1])
+        headers = [tuple(v.strip() for v in line.split(b':', 1)) for line in lines[1:] if b':' in line]
+        return status, headers, body
+
+
+class WarcIndex(object):
+    """
+    SQLite index (`index.db`) of the records of an archive: segment, offset
+    and compressed length of each response, by URL and payload digest. Each
+    record is committed, in WAL mode so the readers are not blocked (and
+    without fsync, the index of a segment is rebuilt when recovered).
+    """
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(os.path.join(path, 'index.db'), check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS records (url TEXT, digest TEXT, segment TEXT, '
+                        '"offset" INTEGER, length INTEGER, PRIMARY KEY (url, digest))')
+        self.db.commit()
+
+    def add(self, url, digest, segment, offset, length):
+        self.db.execute('INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?)',
+                        (url, digest, segment, offset, length))
+        self.db.commit()
+
+    def contains(self, url, digest):
+        return self.db.execute('SELECT 1 FROM records WHERE url = ? AND digest = ?',
+                               (url, digest)).fetchone() is not None
+
+    def get(self, url):
+        """(segment, offset, length) of the last response archived for `url`."""
+        return self.db.execute('SELECT segment, "offset", length FROM records WHERE url = ? '
+                               'ORDER BY rowid DESC LIMIT 1', (url,)).fetchone()
+
+    def rename(self, segment, name):
+        self.db.execute('UPDATE records SET segment = ? WHERE segment = ?', (name, segment))
+        self.db.commit()
+
+    def remove(self, segment):
+        self.db.execute('DELETE FROM records WHERE segment = ?', (segment,))
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+class WarcWriter(object):
+    """
+    Append-only archive of HTTP responses in `path`, as WARC/1.0 `response`
+    records each compressed as a gzip member (readable by the WARC tools, and
+    by offset with `read_record`). Not thread safe, see ArchiveMiddleware.
+
+    Records are appended to an open segment (`<uuid>.open.warc.gz`, locked
+    with `flock` while written), sealed after `segment_records` records or
+    `segment_bytes` bytes and renamed after their SHA-1 (`<sha1>.warc.gz`). A
+    response whose body is already archived for its URL is not written again
+    (see `WarcIndex`). Open segments not locked on start were left by a
+    crash: they are truncated after their last complete record, indexed
+    again and sealed.
+    """
+
+    def __init__(self, path, segment_records=1000, segment_bytes=100 * 1024 * 1024,
+                 compress_level=6):
+        self.path = path
+        self.segment_records = segment_records
+        self.segment_bytes = segment_bytes
+        self.compress_level = compress_level
+        self.file = None
+        self.name = None
+        self.count = 0
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.index = WarcIndex(path)
+        for segment in glob.glob(os.path.join(path, '*.open.warc.gz')):
+            self.recover(segment)
+
+    def write(self, url, status, headers, body, fields=()):
+        """
+        Archive a response, `headers` as [(name, value)] in bytes and `fields`
+        extra WARC fields. Returns the compressed size, 0 for a duplicate.
+        """
+        digest = 'sha1:' + base32_sha1(body)
+        if self.index.contains(url, digest):
+            return 0
+
+        reason = RESPONSES.get(status, b'Unknown')
+        block = b''.join([b'HTTP/1.1 %d %s\r\n' % (status, reason)] +
+                         [name + b': ' + value + b'\r\n' for name, value in headers
+                          if name.lower() not in SKIP_HEADERS] +
+                         [b'Content-Length: %d\r\n\r\n' % len(body), body])
+        record = warc_record('response', block, [
+            ('WARC-Target-URI', url),
+            ('WARC-Payload-Digest', digest),
+            ('WARC-Block-Digest', 'sha1:' + base32_sha1(block)),
+            ('Content-Type', 'application/http; msgtype=response'),
+        ] + list(fields))
+
+        if self.file is None:
+            self.open()
+        data = gzip.compress(record, self.compress_level)
+        offset = self.file.tell()
+        self.file.write(data)
+        self.index.add(url, digest, self.name, offset, len(data))
+        self.count += 1
+
+        if self.count >= self.segment_records or self.file.tell() >= self.segment_bytes:
+            self.seal()
+        return len(data)
+
+    def open(self):
+        self.name = '%s.open.warc.gz' % uuid.uuid4().hex
+        self.file = open(os.path.join(self.path, self.name), 'ab')
+        fcntl.flock(self.file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self.file.write(gzip.compress(warc_record('warcinfo', b'software: ze-the-scraper\r\n'
+                                                  b'format: WARC File Format 1.0\r\n', [
+            ('Content-Type', 'application/warc-fields')]), self.compress_level))
+
+    def seal(self):
+        """Close the open segment and name it after its content."""
+        if self.file is None:
+            return
+        self.file.flush()
+        # Renamed before the lock is released, so it is not recovered meanwhile
+        self.rename(self.name)
+        self.file.close()
+        self.file = None
+        self.name = None
+        self.count = 0
+
+    def recover(self, segment):
+        name = os.path.basename(segment)
+        try:
+            f = open(segment, 'r+b')
+        except FileNotFoundError:
+            # Sealed by its writer meanwhile
+            return
+        with f:
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Being written by a running crawl
+                return
+            if not os.path.exists(segment):
+                return
+
+            # Indexed again up to the last complete record
+            self.index.remove(name)
+            end = 0
+            try:
+                for offset, length, data in iter_members(f):
+                    record = parse_record(data)
+                    if record.type == 'response':
+                        self.index.add(record.url, record.fields.get('WARC-Payload-Digest'),
+                                       name, offset, length)
+                    end = offset + length
+            except (EOFError, zlib.error) as e:
+                logger.warning('WARC segment %s truncated after %d bytes: %s' % (segment, end, e))
+                f.truncate(end)
+            if end:
+                self.rename(name)
+            else:
+                os.remove(segment)
+
+    def rename(self, name):
+        segment = os.path.join(self.path, name)
+        sha1 = hashlib.sha1()
+        with open(segment, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                sha1.update(chunk)
+        sealed = '%s.warc.gz' % sha1.hexdigest()
+        os.rename(segment, os.path.join(self.path, sealed))
+        self.index.rename(name, sealed)
+
+    def close(self):
+        self.seal()
+        self.index.close()
+
+
+def base32_sha1(data):
+    return base64.b32encode(hashlib.sha1(data).digest()).decode('ascii')
+
+
+def warc_record(type, block, fields):
+    head = [('WARC-Type', type),
+            ('WARC-Record-ID', '<urn:uuid:%s>' % uuid.uuid4()),
+            ('WARC-Date', datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'))] + fields
+    head.append(('Content-Length', str(len(block))))
+    return b''.join([b'WARC/1.0\r\n'] +
+                    [('%s: %s\r\n' % field).encode('utf-8') for field in head] +
+                    [b'\r\n', block, b'\r\n\r\n'])
+
+
+def parse_record(data):
+    head, _, rest = data.partition(b'\r\n\r\n')
+    fields = dict(line.decode('utf-8').split(': ', 1) for line in head.split(b'\r\n')[1:])
+    return WarcRecord(fields, rest[:int(fields['Content-Length'])])
+
+
+def iter_members(f):
+    """(offset, compressed length, data) of each gzip member of the file `f`."""
+    offset = 0
+    buffer = b''
+    while True:
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        chunks = []
+        length = 0
+        while not decompressor.eof:
+            if not buffer:
+                buffer = f.read(64 * 1024)
+                if not buffer:
+                    if length:
+                        raise EOFError('Incomplete record at %d' % offset)
+                    return
+            chunks.append(decompressor.decompress(buffer))
+            length += len(buffer) - len(decompressor.unused_data)
+            buffer = decompressor.unused_data
+        yield offset, length, b''.join(chunks)
+        offset += length
+
+
+def iter_records(segment):
+    """Records of a segment, up to the last complete one."""
+    try:
+        with open(segment, 'rb') as f:
+            for _, _, data in iter_members(f):
+                yield parse_record(data)
+    except (EOFError, zlib.error) as e:
+        logger.warning('WARC segment %s truncated: %s' % (segment, e))
+
+
+def read_record(path, segment, offset, length):
+    with open(os.path.join(path, segment), 'rb') as f:
+        f.seek(offset)
+        return parse_record(gzip.decompress(f.read(length)))
+
+
+def segments(path):
+    """Sealed segments of the archive in `path`."""
+    return sorted(segment for segment in glob.glob(os.path.join(path, '*.warc.gz'))
+                  if not segment.endswith('.open.warc.gz'))
+